@@ -0,0 +1,113 @@
+"""
+Benchmark the cold start of a detector, from a fresh process to its first detections, for the ways to load a model:
+
+    rebuild: build resnet_fsaf + fsaf_bbox in python and load the snapshot weights by name.
+    load_model: models.load_model of an inference snapshot, with the custom objects.
+    frozen: utils.frozen.FrozenDetector of a graph exported by export.py, without keras.
+
+Every run happens in its own process, so nothing is imported or cached by a previous one.
+
+    python3 -m benchmarks.cold_start --snapshot snapshots/resnet50_pascal.h5 --num-classes 20 \
+        --frozen snapshots/resnet50_pascal.pb --runs 3
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def run_single(mode, path, backbone_name, num_classes, image_shape):
+    """
+    Load the model and detect the objects of one random image in the current process.
+
+    Returns
+        Dictionary with the seconds spent importing, loading and running the first image, and whether keras was
+        imported.
+    """
+    start = time.time()
+    image = np.random.RandomState(0).randint(0, 256, tuple(image_shape) + (3,)).astype(np.uint8)
+    if mode == 'frozen':
+        from utils.frozen import FrozenDetector
+        imported = time.time()
+        detector = FrozenDetector(path)
+        loaded = time.time()
+        detector.detect([image])
+    else:
+        import models
+        from utils.image import resize_image
+        from utils.inference import load_inference_model
+        imported = time.time()
+        if mode == 'rebuild':
+            model = load_inference_model(path, backbone_name=backbone_name, num_classes=num_classes)
+        else:
+            model = models.load_model(path, backbone_name=backbone_name)
+        loaded = time.time()
+        image, _ = resize_image(models.backbone(backbone_name).preprocess_image(image))
+        model.predict_on_batch(np.expand_dims(image, axis=0))
+    end = time.time()
+
+    return {
+        'mode': mode,
+        'import': imported - start,
+        'load': loaded - imported,
+        'first_run': end - loaded,
+        'total': end - start,
+        'keras_imported': 'keras' in sys.modules,
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the ways to load a model.')
+    parser.add_argument('--snapshot', help='Training snapshot, loaded by rebuilding the model.')
+    parser.add_argument('--inference-snapshot', help='Inference snapshot, loaded with models.load_model.')
+    parser.add_argument('--frozen', help='Frozen graph exported by export.py.')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes', help='Number of classes.', type=int, default=20)
+    parser.add_argument('--image-shape', help='Height and width of the random input image.', type=int, nargs=2,
+                        default=[480, 640])
+    parser.add_argument('--runs', help='Number of processes per way.', type=int, default=3)
+    parser.add_argument('--single', help=argparse.SUPPRESS, nargs=2, metavar=('MODE', 'PATH'))
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parsed_args = parse_args(args)
+
+    if parsed_args.single is not None:
+        result = run_single(parsed_args.single[0], parsed_args.single[1], parsed_args.backbone,
+                            parsed_args.num_classes, parsed_args.image_shape)
+        print(json.dumps(result))
+        return
+
+    modes = [(mode, path) for mode, path in [
+        ('rebuild', parsed_args.snapshot),
+        ('load_model', parsed_args.inference_snapshot),
+        ('frozen', parsed_args.frozen),
+    ] if path is not None]
+
+    print('{:>12} {:>10} {:>10} {:>12} {:>10} {:>8}'.format('mode', 'import s', 'load s', 'first run s', 'total s',
+                                                             'keras'))
+    for mode, path in modes:
+        for _ in range(parsed_args.runs):
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.cold_start',
+                '--single', mode, path,
+                '--backbone', parsed_args.backbone,
+                '--num-classes', str(parsed_args.num_classes),
+                '--image-shape', str(parsed_args.image_shape[0]), str(parsed_args.image_shape[1]),
+            ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            print('{:>12} {:>10.2f} {:>10.2f} {:>12.2f} {:>10.2f} {:>8}'.format(
+                result['mode'], result['import'], result['load'], result['first_run'], result['total'],
+                'yes' if result['keras_imported'] else 'no'))
+
+
+if __name__ == '__main__':
+    main()
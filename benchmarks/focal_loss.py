@@ -0,0 +1,127 @@
+"""
+Benchmark the peak memory and the step time of the focal loss and its gradient.
+
+Every (loss, image size) pair runs in its own process, so the peak memory of one run does not leak into the next one.
+
+    python3 -m benchmarks.focal_loss --image-sizes 800 1333
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def num_locations(image_side, pyramid_levels=(3, 4, 5, 6, 7)):
+    """
+    Number of locations of all pyramid levels for a square image.
+    """
+    from utils.anchors import guess_shapes
+    shapes = guess_shapes((image_side, image_side), pyramid_levels)
+    return int(sum(shape[0] * shape[1] for shape in shapes))
+
+
+def run_single(fused, image_side, batch_size, num_classes, steps):
+    """
+    Measure one configuration in the current process.
+
+    Returns
+        Dictionary with the peak device memory (if available), the peak RSS and the mean step time.
+    """
+    import tensorflow as tf
+    import keras.backend as K
+    from losses import focal_with_mask
+
+    rng = np.random.RandomState(0)
+    num_locs = num_locations(image_side)
+    # about 1% of the locations are positive and 10% are ignored
+    cls_target = np.zeros((batch_size, num_locs, num_classes), dtype=np.float32)
+    pos_mask = rng.rand(batch_size, num_locs) < 0.01
+    cls_target[pos_mask, rng.randint(0, num_classes, pos_mask.sum())] = 1
+    cls_mask = pos_mask | (rng.rand(batch_size, num_locs) < 0.9)
+    cls_num_pos = pos_mask.sum(axis=1).astype(np.float32)
+
+    logits = tf.Variable(rng.randn(batch_size, num_locs, num_classes).astype(np.float32))
+    y_pred = tf.sigmoid(logits)
+    loss = focal_with_mask(fused=fused)([tf.constant(cls_target), y_pred, tf.constant(cls_mask),
+                                         tf.constant(cls_num_pos)])
+    grads = tf.gradients(loss, logits)[0]
+    train_op = tf.reduce_sum(grads)
+
+    peak_bytes = None
+    if tf.test.is_gpu_available():
+        from tensorflow.contrib.memory_stats import MaxBytesInUse
+        peak_bytes = MaxBytesInUse()
+
+    session = K.get_session()
+    session.run(tf.global_variables_initializer())
+    # warm up
+    session.run(train_op)
+    start = time.time()
+    for _ in range(steps):
+        session.run(train_op)
+    step_time = (time.time() - start) / steps
+
+    return {
+        'loss': 'fused' if fused else 'reference',
+        'image_side': image_side,
+        'num_locations': num_locs,
+        'peak_device_bytes': int(session.run(peak_bytes)) if peak_bytes is not None else None,
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'step_time': step_time,
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the memory of the focal loss.')
+    parser.add_argument('--image-sizes', help='Sides of the square input images.', type=int, nargs='+',
+                        default=[800, 1333])
+    parser.add_argument('--batch-size', help='Size of the batches.', type=int, default=2)
+    parser.add_argument('--num-classes', help='Number of classes.', type=int, default=80)
+    parser.add_argument('--steps', help='Number of timed steps.', type=int, default=10)
+    parser.add_argument('--single', help=argparse.SUPPRESS, choices=['fused', 'reference'])
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parsed_args = parse_args(args)
+
+    if parsed_args.single is not None:
+        result = run_single(parsed_args.single == 'fused', parsed_args.image_sizes[0], parsed_args.batch_size,
+                            parsed_args.num_classes, parsed_args.steps)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for image_side in parsed_args.image_sizes:
+        for loss in ('reference', 'fused'):
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.focal_loss',
+                '--single', loss,
+                '--image-sizes', str(image_side),
+                '--batch-size', str(parsed_args.batch_size),
+                '--num-classes', str(parsed_args.num_classes),
+                '--steps', str(parsed_args.steps),
+            ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    print('{:>6} {:>10} {:>10} {:>14} {:>14} {:>10}'.format('side', 'loss', 'locations', 'device MiB', 'rss MiB',
+                                                            'step ms'))
+    for result in results:
+        device_mib = '-' if result['peak_device_bytes'] is None else '{:.1f}'.format(
+            result['peak_device_bytes'] / 2. ** 20)
+        print('{:>6} {:>10} {:>10} {:>14} {:>14.1f} {:>10.1f}'.format(
+            result['image_side'], result['loss'], result['num_locations'], device_mib,
+            result['peak_rss_bytes'] / 2. ** 20, result['step_time'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark the time per call of keras predict_on_batch against utils.predictor.SessionPredictor on CPU.
+
+    python3 -m benchmarks.predictor --model fsaf --image-sizes 128 256 512
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def build_model(model_name, num_classes):
+    if model_name == 'yolo':
+        from yolo.model import yolo_body
+        _, prediction_model = yolo_body(num_classes=num_classes)
+        return prediction_model
+    from models.resnet import resnet_fsaf
+    from models.retinanet import fsaf_bbox
+    return fsaf_bbox(resnet_fsaf(num_classes=num_classes, backbone='resnet50'))
+
+
+def time_calls(predict, batch_images, steps):
+    # warm up
+    predict(batch_images)
+    start = time.time()
+    for _ in range(steps):
+        predict(batch_images)
+    return (time.time() - start) / steps
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of predict_on_batch.')
+    parser.add_argument('--model', help='The prediction model.', choices=['fsaf', 'yolo'], default='fsaf')
+    parser.add_argument('--image-sizes', help='Sides of the square input images.', type=int, nargs='+',
+                        default=[128, 256, 512])
+    parser.add_argument('--batch-size', help='Size of the batches.', type=int, default=1)
+    parser.add_argument('--num-classes', help='Number of classes.', type=int, default=20)
+    parser.add_argument('--steps', help='Number of timed calls.', type=int, default=50)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parsed_args = parse_args(args)
+
+    # the overhead is measured on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    from utils.predictor import SessionPredictor
+
+    model = build_model(parsed_args.model, parsed_args.num_classes)
+    predictor = SessionPredictor(model)
+
+    print('{:>6} {:>22} {:>22} {:>14}'.format('side', 'predict_on_batch ms', 'SessionPredictor ms', 'overhead ms'))
+    for image_side in parsed_args.image_sizes:
+        batch_images = np.random.RandomState(0).rand(parsed_args.batch_size, image_side, image_side, 3).astype(
+            np.float32)
+        keras_time = time_calls(model.predict_on_batch, batch_images, parsed_args.steps)
+        predictor_time = time_calls(predictor.predict_on_batch, batch_images, parsed_args.steps)
+        print('{:>6} {:>22.2f} {:>22.2f} {:>14.2f}'.format(image_side, keras_time * 1000, predictor_time * 1000,
+                                                          (keras_time - predictor_time) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark the latency and the throughput of every rung of a resolution ladder (see utils.resolution) for several
+batch sizes, the curve the deadline of server.py --deadline-ms trades along.
+
+    python3 -m benchmarks.resolution --min-sides 800 640 512 --batch-sizes 1 2 4 8 --image-shape 480 640
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the rungs of a resolution ladder.')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes', help='Number of classes.', type=int, default=20)
+    parser.add_argument('--min-sides', help='Min sides of the rungs.', type=int, nargs='+', default=[800, 640, 512])
+    parser.add_argument('--image-min-side', help='Min side of the full resolution.', type=int, default=800)
+    parser.add_argument('--image-max-side', help='Max side of the full resolution.', type=int, default=1333)
+    parser.add_argument('--image-shape', help='Height and width of the random input images.', type=int, nargs=2,
+                        default=[480, 640])
+    parser.add_argument('--batch-sizes', help='Sizes of the batches.', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--steps', help='Number of timed batches.', type=int, default=20)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parsed_args = parse_args(args)
+
+    import models
+    from models.retinanet import fsaf_bbox
+    from utils.image import resize_image
+    from utils.inference import pad_images
+    from utils.resolution import make_rungs
+
+    model = fsaf_bbox(models.backbone(parsed_args.backbone).fsaf(parsed_args.num_classes, modifier=None))
+    preprocess_image = models.backbone(parsed_args.backbone).preprocess_image
+    raw_image = np.random.RandomState(0).randint(0, 256, tuple(parsed_args.image_shape) + (3,)).astype(np.uint8)
+
+    print('{:>10} {:>12} {:>6} {:>10} {:>10} {:>10}'.format('rung', 'input', 'batch', 'p50 ms', 'p90 ms',
+                                                           'images/s'))
+    for min_side, max_side in make_rungs(parsed_args.min_sides, min_side=parsed_args.image_min_side,
+                                         max_side=parsed_args.image_max_side):
+        image, _ = resize_image(preprocess_image(raw_image.copy()), min_side=min_side, max_side=max_side)
+        for batch_size in parsed_args.batch_sizes:
+            batch_images = pad_images([image] * batch_size)
+            # warm up
+            model.predict_on_batch(batch_images)
+            latencies = []
+            for _ in range(parsed_args.steps):
+                start = time.time()
+                model.predict_on_batch(batch_images)
+                latencies.append(time.time() - start)
+            p50, p90 = np.percentile(latencies, [50, 90]) * 1000.
+            print('{:>10} {:>12} {:>6d} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                '{}x{}'.format(min_side, max_side), '{}x{}'.format(*image.shape[:2]), batch_size, p50, p90,
+                batch_size / np.mean(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import keras
+import numpy as np
 from utils.eval import evaluate
 from utils.coco_eval import evaluate_coco
+from utils.level_cache import UNCACHED_LEVEL
 
 
 class Evaluate(keras.callbacks.Callback):
@@ -17,6 +19,7 @@ class Evaluate(keras.callbacks.Callback):
             save_path=None,
             tensorboard=None,
             weighted_average=False,
+            buckets=None,
             verbose=1
     ):
         """
@@ -30,6 +33,7 @@ class Evaluate(keras.callbacks.Callback):
             save_path: The path to save images with visualized detections to.
             tensorboard: Instance of keras.callbacks.TensorBoard used to log the mAP value.
             weighted_average: Compute the mAP using the weighted average of precisions among classes.
+            buckets: Optional utils.buckets.ShapeBuckets the images are padded to.
             verbose: Set the verbosity level, by default this is set to 1.
         """
         self.generator = generator
@@ -39,6 +43,7 @@ class Evaluate(keras.callbacks.Callback):
         self.save_path = save_path
         self.tensorboard = tensorboard
         self.weighted_average = weighted_average
+        self.buckets = buckets
         self.verbose = verbose
 
         super(Evaluate, self).__init__()
@@ -54,6 +59,7 @@ class Evaluate(keras.callbacks.Callback):
             score_threshold=self.score_threshold,
             max_detections=self.max_detections,
             visualize=False,
+            buckets=self.buckets,
         )
 
         # compute per class average precision
@@ -172,3 +178,74 @@ class CocoEval(keras.callbacks.Callback):
                 summary_value.tag = '{}. {}'.format(index + 1, coco_tag[index])
                 self.tensorboard.writer.add_summary(summary, epoch)
                 logs[coco_tag[index]] = result
+
+
+class LevelCacheRefresh(keras.callbacks.Callback):
+    """
+    Refresh a utils.level_cache.LevelCache with the levels selected online by the model.
+    """
+
+    def __init__(self, generator, level_cache, tensorboard=None, verbose=1):
+        """
+        LevelCacheRefresh callback initializer.
+
+        Args
+            generator: The training generator, which feeds the cached levels to the model.
+            level_cache: The utils.level_cache.LevelCache to refresh.
+            tensorboard: If given, the disagreement between the cached and the fresh levels will be written to it.
+            verbose: Set the verbosity level, by default this is set to 1.
+        """
+        self.generator = generator
+        self.level_cache = level_cache
+        self.tensorboard = tensorboard
+        self.verbose = verbose
+        self.level_function = None
+
+        super(LevelCacheRefresh, self).__init__()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        if not self.level_cache.should_refresh(epoch):
+            return
+
+        if self.level_function is None:
+            inputs = self.model.inputs
+            if self.model.uses_learning_phase:
+                inputs = inputs + [keras.backend.learning_phase()]
+            self.level_function = keras.backend.function(inputs, [self.model.get_layer('level_select').output])
+
+        num_compared = 0
+        num_changed = 0
+        for group in self.generator.groups:
+            group, image_group, annotations_group = self.generator.prepare_group(group)
+            if len(image_group) == 0:
+                continue
+            inputs = self.generator.compute_inputs(image_group, annotations_group)
+            batch_box_indices = [annotations['box_indices'] for annotations in annotations_group]
+            # force a fresh selection of every gt box
+            inputs.append(np.full_like(self.level_cache.lookup(group, batch_box_indices), UNCACHED_LEVEL))
+            if self.model.uses_learning_phase:
+                inputs.append(0)
+            batch_levels = self.level_function(inputs)[0]
+            batch_num_compared, batch_num_changed = self.level_cache.update(group, batch_box_indices, batch_levels)
+            num_compared += batch_num_compared
+            num_changed += batch_num_changed
+
+        # the disagreement is only known once the cache has been filled
+        if num_compared == 0:
+            return
+        disagreement = num_changed / float(num_compared)
+
+        if self.tensorboard is not None and self.tensorboard.writer is not None:
+            import tensorflow as tf
+            summary = tf.Summary()
+            summary_value = summary.value.add()
+            summary_value.simple_value = disagreement
+            summary_value.tag = "level_cache_disagreement"
+            self.tensorboard.writer.add_summary(summary, epoch)
+
+        logs['level_cache_disagreement'] = disagreement
+
+        if self.verbose == 1:
+            print('level cache disagreement: {:.4f} ({} of {} gt boxes)'.format(disagreement, num_changed,
+                                                                                 num_compared))
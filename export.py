@@ -0,0 +1,145 @@
+"""
+Export a fsaf snapshot as a frozen, self-contained inference graph, which utils.frozen.FrozenDetector runs without
+keras and the custom layers.
+
+The graph contains the preprocessing of the backbone, the backbone, the heads, the decoding of the boxes and the NMS.
+The training only parts (the gt inputs, LevelSelect, FSAFTarget and the losses) are stripped, the variables are
+converted to constants and folded.
+
+Example:
+    python3 export.py snapshots/resnet50_pascal.h5 snapshots/resnet50_pascal.pb --num-classes 20
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+import models
+from utils.frozen import metadata_path
+from utils.inference import load_inference_model
+from utils.keras_version import check_keras_version
+
+INPUT_NAME = 'images'
+OUTPUT_NAMES = ['boxes', 'scores', 'labels']
+
+
+def preprocessing_affine(preprocess_image):
+    """
+    Express the preprocessing of a backbone, a per channel scale and offset, as (scale, offset).
+    """
+    offset = preprocess_image(np.zeros((1, 1, 3), dtype=np.float32)).reshape(3)
+    scale = preprocess_image(np.ones((1, 1, 3), dtype=np.float32)).reshape(3) - offset
+    return scale, offset
+
+
+def freeze_model(model, preprocess_image, fold_constants=True):
+    """
+    Freeze an inference model, with the preprocessing in front of it, into a GraphDef.
+
+    Args
+        model: A keras.models.Model which takes a preprocessed image batch and outputs [boxes, scores, labels].
+        preprocess_image: The preprocessing function of the backbone.
+        fold_constants: Whether to fold the constants and the batch normalizations with the graph transforms of
+            tensorflow.
+
+    Returns
+        graph_def: The frozen GraphDef.
+        input_name: The name of the input node, INPUT_NAME unless the graph already has a node of that name.
+        output_names: The names of the output nodes, OUTPUT_NAMES unless the graph already has nodes of those names
+            (e.g. the 'boxes' RegressBoxes layer of fsaf_bbox without fused_postprocess, or of older snapshots).
+        pad_value: The raw pixel value which is zero after preprocessing.
+    """
+    session = keras.backend.get_session()
+    scale, offset = preprocessing_affine(preprocess_image)
+    with session.graph.as_default():
+        images = tf.placeholder(tf.float32, shape=(None, None, None, 3), name=INPUT_NAME)
+        outputs = model(images * scale + offset)[:3]
+        # tensorflow uniquifies the names which are taken, so use the names the nodes actually got
+        input_name = images.op.name
+        output_names = [tf.identity(output, name=output_name).op.name
+                        for output, output_name in zip(outputs, OUTPUT_NAMES)]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    # only keep the ancestors of the outputs, which drops the training model around the inference model
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    if fold_constants:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, [input_name], output_names, [
+            'fold_constants(ignore_errors=true)',
+            'fold_batch_norms',
+            'fold_old_batch_norms',
+            'strip_unused_nodes',
+            'sort_by_execution_order',
+        ])
+    return graph_def, input_name, output_names, (-offset / scale).tolist()
+
+
+def parse_args(args):
+    """
+    Parse the arguments.
+    """
+    parser = argparse.ArgumentParser(description='Export a fsaf snapshot as a frozen inference graph.')
+    parser.add_argument('snapshot', help='Snapshot of the model.')
+    parser.add_argument('output', help='Path of the frozen graph (.pb), the metadata is written next to it (.json).')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes',
+                        help='Number of classes, build the model and load the snapshot weights by name if given.',
+                        type=int)
+    parser.add_argument('--convert-model',
+                        help='Convert the model to an inference model (ie. the input is a training model).',
+                        action='store_true')
+    parser.add_argument('--no-fold-constants', help='Do not apply the constant folding graph transforms.',
+                        dest='fold_constants', action='store_false')
+    parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
+                        default=800)
+    parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
+                        type=int, default=1333)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # make sure keras is the minimum required version
+    check_keras_version()
+
+    # the exported graph has no training mode
+    keras.backend.set_learning_phase(0)
+
+    print('Loading model, this may take a second...')
+    model = load_inference_model(args.snapshot, backbone_name=args.backbone, num_classes=args.num_classes,
+                                 convert_model=args.convert_model)
+    num_classes = args.num_classes or int(model.get_layer('filtered_detections').input_shape[1][-1])
+    max_detections = model.get_layer('filtered_detections').max_detections
+
+    graph_def, input_name, output_names, pad_value = freeze_model(model, models.backbone(args.backbone).preprocess_image,
+                                        fold_constants=args.fold_constants)
+    with open(args.output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(metadata_path(args.output), 'w') as f:
+        json.dump({
+            'input': input_name + ':0',
+            'outputs': [output_name + ':0' for output_name in output_names],
+            'pad_value': pad_value,
+            'backbone': args.backbone,
+            'num_classes': num_classes,
+            'max_detections': max_detections,
+            'image_min_side': args.image_min_side,
+            'image_max_side': args.image_max_side,
+        }, f, indent=2)
+    print('Wrote {} nodes to {} ({:.1f} MiB).'.format(len(graph_def.node), args.output,
+                                                     os.path.getsize(args.output) / 2. ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 from keras.layers import Layer
 import tensorflow as tf
-from util_graphs import trim_zeros_graph, prop_box_graph, prop_box_graph_2
+from util_graphs import trim_zeros_graph, prop_box_graph, prop_box_graph_2, feature_locations_graph
 import keras.backend as K
 from losses import focal, iou
 from configure import MAX_NUM_GT_BOXES, STRIDES, POS_SCALE, IGNORE_SCALE
+from utils.fsaf import locations_for_shapes
 
 
 def level_select(cls_pred, regr_pred, gt_boxes, feature_shapes, strides, pos_scale=0.2):
@@ -89,6 +90,109 @@ def level_select(cls_pred, regr_pred, gt_boxes, feature_shapes, strides, pos_sca
     return gt_box_levels
 
 
+def batch_level_select(batch_cls_pred, batch_regr_pred, batch_gt_boxes, feature_shapes, strides, pos_scale=0.2,
+                       alpha=0.25, gamma=2.0):
+    """
+    Select the level of all gt boxes of a batch at once.
+
+    The focal and iou losses of every gt box on every level are computed over the flattened sum(fh * fw) locations,
+    masked by the positive region of the gt box, which gives the same levels as level_select.
+
+    Args:
+        batch_cls_pred: (B, sum(fh * fw), num_classes)
+        batch_regr_pred: (B, sum(fh * fw), 4)
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5)
+        feature_shapes: (5, 2)
+        strides:
+        pos_scale:
+        alpha: alpha of the focal loss.
+        gamma: gamma of the focal loss.
+
+    Returns:
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES), -1 for padding boxes.
+
+    """
+    # the selected levels are only used as targets
+    batch_cls_pred = tf.stop_gradient(batch_cls_pred)
+    batch_regr_pred = tf.stop_gradient(batch_regr_pred)
+    padded_num_gt_boxes = tf.shape(batch_gt_boxes)[1]
+    # (B, MAX_NUM_GT_BOXES)
+    non_zeros = tf.reduce_any(tf.not_equal(batch_gt_boxes[:, :, :4], 0), axis=-1)
+    # gt boxes are packed at the front, so only keep as many of them as the fullest image has
+    max_num_gt_boxes = tf.reduce_max(tf.reduce_sum(tf.cast(non_zeros, tf.int32), axis=1))
+    max_num_gt_boxes = tf.maximum(max_num_gt_boxes, 1)
+    non_zeros = non_zeros[:, :max_num_gt_boxes]
+    gt_labels = tf.cast(batch_gt_boxes[:, :max_num_gt_boxes, 4], tf.int32)
+    gt_boxes = batch_gt_boxes[:, :max_num_gt_boxes, :4]
+    batch_size = tf.shape(gt_boxes)[0]
+    num_gt_boxes = tf.shape(gt_boxes)[1]
+
+    # (sum(fh * fw), )
+    locs_x, locs_y, locs_level, locs_stride = feature_locations_graph(feature_shapes, strides)
+    shift_x = (tf.cast(locs_x, tf.float32) + 0.5) * locs_stride
+    shift_y = (tf.cast(locs_y, tf.float32) + 0.5) * locs_stride
+
+    # positive region of every gt box projected onto every level
+    flat_gt_boxes = tf.reshape(gt_boxes, (-1, 4))
+    level_regions = []
+    for level_id in range(len(strides)):
+        level_regions.append(prop_box_graph(flat_gt_boxes / strides[level_id], pos_scale,
+                                            feature_shapes[level_id][1], feature_shapes[level_id][0]))
+    # (B, num_gt_boxes, sum(fh * fw))
+    x1, y1, x2, y2 = [
+        tf.gather(tf.reshape(tf.stack(coords, axis=-1), (batch_size, num_gt_boxes, len(strides))), locs_level, axis=2)
+        for coords in zip(*level_regions)]
+    pos_region = (locs_x >= x1) & (locs_x < x2) & (locs_y >= y1) & (locs_y < y2)
+    pos_weights = tf.cast(pos_region, tf.float32)
+
+    # focal loss of every location when every gt box is taken as its target:
+    # the loss of all classes as negatives, with the class of the gt box swapped to a positive
+    # (B, sum(fh * fw))
+    neg_cls_loss = (1 - alpha) * batch_cls_pred ** gamma * K.binary_crossentropy(tf.zeros_like(batch_cls_pred),
+                                                                                 batch_cls_pred)
+    neg_cls_loss = tf.reduce_sum(neg_cls_loss, axis=-1)
+    # (B, num_gt_boxes, sum(fh * fw))
+    label_cls_pred = tf.transpose(tf.gather(batch_cls_pred, gt_labels, axis=2, batch_dims=1), (0, 2, 1))
+    label_neg_cls_loss = (1 - alpha) * label_cls_pred ** gamma * K.binary_crossentropy(tf.zeros_like(label_cls_pred),
+                                                                                       label_cls_pred)
+    label_pos_cls_loss = alpha * (1 - label_cls_pred) ** gamma * K.binary_crossentropy(tf.ones_like(label_cls_pred),
+                                                                                       label_cls_pred)
+    cls_loss = neg_cls_loss[:, None, :] - label_neg_cls_loss + label_pos_cls_loss
+
+    # iou loss of every location w.r.t. every gt box
+    target_left = tf.maximum(shift_x - gt_boxes[:, :, 0:1], 0) / 4.0
+    target_top = tf.maximum(shift_y - gt_boxes[:, :, 1:2], 0) / 4.0
+    target_right = tf.maximum(gt_boxes[:, :, 2:3] - shift_x, 0) / 4.0
+    target_bottom = tf.maximum(gt_boxes[:, :, 3:4] - shift_y, 0) / 4.0
+    pred_left = batch_regr_pred[:, None, :, 0]
+    pred_top = batch_regr_pred[:, None, :, 1]
+    pred_right = batch_regr_pred[:, None, :, 2]
+    pred_bottom = batch_regr_pred[:, None, :, 3]
+    target_area = (target_left + target_right) * (target_top + target_bottom)
+    pred_area = (pred_left + pred_right) * (pred_top + pred_bottom)
+    w_intersect = tf.minimum(pred_left, target_left) + tf.minimum(pred_right, target_right)
+    h_intersect = tf.minimum(pred_bottom, target_bottom) + tf.minimum(pred_top, target_top)
+    area_intersect = w_intersect * h_intersect
+    area_union = target_area + pred_area - area_intersect
+    iou_loss = -tf.log((area_intersect + 1e-7) / (area_union + 1e-7))
+
+    # mean loss over the positive region of every gt box on every level
+    locs_losses = (cls_loss + iou_loss) * pos_weights
+    fa = tf.reduce_prod(feature_shapes, axis=-1)
+    level_losses = []
+    for level_id in range(len(strides)):
+        start_idx = tf.reduce_sum(fa[:level_id])
+        end_idx = start_idx + fa[level_id]
+        level_loss = tf.reduce_sum(locs_losses[:, :, start_idx:end_idx], axis=-1)
+        level_num_pos = tf.reduce_sum(pos_weights[:, :, start_idx:end_idx], axis=-1)
+        level_losses.append(level_loss / tf.maximum(level_num_pos, 1.))
+    # (B, num_gt_boxes)
+    gt_box_levels = tf.argmin(tf.stack(level_losses, axis=-1), axis=-1)
+    gt_box_levels = tf.where(non_zeros, gt_box_levels, -tf.ones_like(gt_box_levels))
+    gt_box_levels = tf.pad(gt_box_levels, [[0, 0], [0, padded_num_gt_boxes - num_gt_boxes]], constant_values=-1)
+    return gt_box_levels
+
+
 class LevelSelect(Layer):
     def __init__(self, **kwargs):
         super(LevelSelect, self).__init__(**kwargs)
@@ -99,25 +203,26 @@ class LevelSelect(Layer):
         feature_shapes = inputs[2][0]
         batch_gt_boxes = inputs[3]
 
-        def _level_select(args):
-            cls_pred = args[0]
-            regr_pred = args[1]
-            gt_boxes = args[2]
-
-            return level_select(
-                cls_pred,
-                regr_pred,
-                gt_boxes,
+        def select():
+            return batch_level_select(
+                batch_cls_pred,
+                batch_regr_pred,
+                batch_gt_boxes,
                 feature_shapes=feature_shapes,
                 strides=STRIDES,
                 pos_scale=POS_SCALE
             )
 
-        outputs = tf.map_fn(
-            _level_select,
-            elems=[batch_cls_pred, batch_regr_pred, batch_gt_boxes],
-            dtype=tf.int64,
-        )
+        if len(inputs) == 4:
+            return select()
+
+        # levels cached by the generator, -2 for the gt boxes which need a fresh selection
+        batch_cached_levels = tf.cast(inputs[4], tf.int64)
+        uncached = tf.equal(batch_cached_levels, -2)
+        # the selection only runs when at least one gt box of the batch is not cached
+        outputs = tf.cond(tf.reduce_any(uncached),
+                          lambda: tf.where(uncached, select(), batch_cached_levels),
+                          lambda: batch_cached_levels)
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -125,7 +230,8 @@ class LevelSelect(Layer):
         Computes the output shapes given the input shapes.
 
         Args
-            input_shape : List of shapes of [batch_cls_pred, batch_regr_pred, feature_shapes, batch_gt_boxes].
+            input_shape : List of shapes of [batch_cls_pred, batch_regr_pred, feature_shapes, batch_gt_boxes] and
+                optionally batch_cached_levels.
 
         Returns
             shape of batch_gt_box_levels
@@ -144,6 +250,71 @@ class LevelSelect(Layer):
         return config
 
 
+def heuristic_level_select(batch_gt_boxes, strides, scale=4.0):
+    """
+    Select the level of all gt boxes of a batch from their size only, like the FPN heuristic.
+
+    Level i takes the gt boxes with sqrt(w * h) in [scale * strides[i], 2 * scale * strides[i]), the smaller and larger
+    gt boxes go to the first and last level.
+
+    Args:
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5)
+        strides:
+        scale: The size of the smallest gt boxes of every level relative to its stride.
+
+    Returns:
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES), -1 for padding boxes.
+
+    """
+    # (B, MAX_NUM_GT_BOXES)
+    non_zeros = tf.reduce_any(tf.not_equal(batch_gt_boxes[:, :, :4], 0), axis=-1)
+    box_sizes = tf.sqrt((batch_gt_boxes[:, :, 2] - batch_gt_boxes[:, :, 0]) *
+                        (batch_gt_boxes[:, :, 3] - batch_gt_boxes[:, :, 1]))
+    # upper bound of the box sizes of all levels but the last one
+    upper_bounds = tf.constant([2 * scale * stride for stride in strides[:-1]], dtype=tf.float32)
+    gt_box_levels = tf.reduce_sum(tf.cast(box_sizes[:, :, None] >= upper_bounds, tf.int64), axis=-1)
+    gt_box_levels = tf.where(non_zeros, gt_box_levels, -tf.ones_like(gt_box_levels))
+    return gt_box_levels
+
+
+class HeuristicLevelSelect(Layer):
+    """
+    Drop-in replacement of LevelSelect which assigns the gt boxes to levels by their size, see heuristic_level_select.
+
+    It takes the same inputs as LevelSelect but only uses the gt boxes, so no loss is evaluated to select the levels.
+    """
+
+    def __init__(self, **kwargs):
+        super(HeuristicLevelSelect, self).__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        batch_gt_boxes = inputs[3]
+        outputs = heuristic_level_select(batch_gt_boxes, strides=STRIDES)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        """
+        Computes the output shapes given the input shapes.
+
+        Args
+            input_shape : List of shapes of [batch_cls_pred, batch_regr_pred, feature_shapes, batch_gt_boxes].
+
+        Returns
+            shape of batch_gt_box_levels
+        """
+        return input_shape[3][0], input_shape[3][1]
+
+    def get_config(self):
+        """
+        Gets the configuration of this layer.
+
+        Returns
+            Dictionary containing the parameters of this layer.
+        """
+        config = super(HeuristicLevelSelect, self).get_config()
+        return config
+
+
 def build_fsaf_target(gt_box_levels, gt_boxes, feature_shapes, num_classes, strides, pos_scale, ignore_scale):
     gt_labels = tf.cast(gt_boxes[:, 4], tf.int32)
     gt_boxes = gt_boxes[:, :4]
@@ -262,34 +433,131 @@ def build_fsaf_target(gt_box_levels, gt_boxes, feature_shapes, num_classes, stri
     return [cls_target, cls_mask, cls_num_pos, regr_target, regr_mask]
 
 
+def build_batch_fsaf_target(batch_gt_box_levels, batch_gt_boxes, feature_shapes, num_classes, strides, pos_scale,
+                            ignore_scale, sparse=False):
+    """
+    Build the fsaf targets of a whole batch at once.
+
+    Instead of building a padded target for every gt box, the positive and ignore regions of all gt boxes are compared
+    against the flattened locations of all levels and every positive location is owned by the gt box with the minimal
+    area, which gives the same targets as build_fsaf_target.
+
+    Args:
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES) level of each gt box, -1 for padding boxes.
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5)
+        feature_shapes: (5, 2)
+        num_classes:
+        strides:
+        pos_scale:
+        ignore_scale:
+        sparse: If True, return the sparse targets instead.
+
+    Returns:
+        [cls_target (B, sum(fh * fw), num_classes), cls_mask (B, sum(fh * fw)), cls_num_pos (B, ),
+         regr_target (B, sum(fh * fw), 4), regr_mask (B, sum(fh * fw))]
+        or if sparse
+        [cls_labels (B, sum(fh * fw)), regr_target (num_pos, 4)], where cls_labels is the label of the positive
+        locations, -1 for the negative and -2 for the ignored locations, and regr_target has the regression targets of
+        the positive locations in the order of tf.where(cls_labels >= 0).
+    """
+    gt_box_levels = tf.cast(batch_gt_box_levels, tf.int32)
+    # gt boxes are packed at the front, so only keep as many of them as the fullest image has
+    max_num_gt_boxes = tf.reduce_max(tf.reduce_sum(tf.cast(gt_box_levels >= 0, tf.int32), axis=1))
+    max_num_gt_boxes = tf.maximum(max_num_gt_boxes, 1)
+    gt_box_levels = gt_box_levels[:, :max_num_gt_boxes]
+    gt_labels = tf.cast(batch_gt_boxes[:, :max_num_gt_boxes, 4], tf.int32)
+    gt_boxes = batch_gt_boxes[:, :max_num_gt_boxes, :4]
+    batch_size = tf.shape(gt_boxes)[0]
+    num_gt_boxes = tf.shape(gt_boxes)[1]
+
+    # (sum(fh * fw), )
+    locs_x, locs_y, locs_level, locs_stride = feature_locations_graph(feature_shapes, strides)
+    shift_x = (tf.cast(locs_x, tf.float32) + 0.5) * locs_stride
+    shift_y = (tf.cast(locs_y, tf.float32) + 0.5) * locs_stride
+
+    # project every gt box onto the level it is assigned to
+    # (B * num_gt_boxes, )
+    flat_box_levels = tf.reshape(tf.maximum(gt_box_levels, 0), (-1,))
+    flat_box_strides = tf.gather(tf.constant(strides, dtype=tf.float32), flat_box_levels)
+    flat_box_fh = tf.gather(feature_shapes[:, 0], flat_box_levels)
+    flat_box_fw = tf.gather(feature_shapes[:, 1], flat_box_levels)
+    flat_proj_boxes = tf.reshape(gt_boxes, (-1, 4)) / flat_box_strides[:, None]
+
+    def in_region(scale):
+        # (B, num_gt_boxes, 1)
+        x1, y1, x2, y2 = [tf.reshape(coord, (batch_size, num_gt_boxes, 1))
+                          for coord in prop_box_graph(flat_proj_boxes, scale, flat_box_fw, flat_box_fh)]
+        # (B, num_gt_boxes, sum(fh * fw))
+        return (tf.equal(gt_box_levels[:, :, None], locs_level) &
+                (locs_x >= x1) & (locs_x < x2) &
+                (locs_y >= y1) & (locs_y < y2))
+
+    pos_region = in_region(pos_scale)
+    ign_region = in_region(ignore_scale)
+
+    # (B, num_gt_boxes, sum(fh * fw))
+    l = tf.maximum(shift_x - gt_boxes[:, :, 0:1], 0)
+    t = tf.maximum(shift_y - gt_boxes[:, :, 1:2], 0)
+    r = tf.maximum(gt_boxes[:, :, 2:3] - shift_x, 0)
+    b = tf.maximum(gt_boxes[:, :, 3:4] - shift_y, 0)
+    area = tf.where(pos_region, (l + r) * (t + b), tf.ones_like(l) * 1e7)
+    # (B, sum(fh * fw))
+    owner_indices = tf.argmin(area, axis=1, output_type=tf.int32)
+    pos_mask = tf.reduce_any(pos_region, axis=1)
+    ign_mask = tf.reduce_any(ign_region, axis=1)
+    pos_weights = tf.cast(pos_mask, tf.float32)[:, :, None]
+
+    owner_labels = tf.gather(gt_labels, owner_indices, batch_dims=1)
+    cls_mask = pos_mask | tf.logical_not(ign_mask)
+
+    if sparse:
+        cls_labels = tf.where(pos_mask, owner_labels,
+                              tf.where(cls_mask, -tf.ones_like(owner_labels), -2 * tf.ones_like(owner_labels)))
+        # (num_pos, 2)
+        pos_indices = tf.where(pos_mask)
+        pos_owner_indices = tf.cast(tf.gather_nd(owner_indices, pos_indices), tf.int64)
+        # (num_pos, 4)
+        owner_boxes = tf.gather_nd(gt_boxes, tf.stack((pos_indices[:, 0], pos_owner_indices), axis=-1))
+        shift_x = tf.gather(shift_x, pos_indices[:, 1])
+        shift_y = tf.gather(shift_y, pos_indices[:, 1])
+    else:
+        # (B, sum(fh * fw), 4)
+        owner_boxes = tf.gather(gt_boxes, owner_indices, batch_dims=1)
+    l = tf.maximum(shift_x - owner_boxes[..., 0], 0)
+    t = tf.maximum(shift_y - owner_boxes[..., 1], 0)
+    r = tf.maximum(owner_boxes[..., 2] - shift_x, 0)
+    b = tf.maximum(owner_boxes[..., 3] - shift_y, 0)
+    regr_target = tf.stack((l, t, r, b), axis=-1) / 4.0
+    if sparse:
+        return [cls_labels, regr_target]
+
+    cls_target = tf.one_hot(owner_labels, num_classes) * pos_weights
+    cls_num_pos = tf.reduce_sum(tf.cast(pos_mask, tf.float32), axis=1)
+    regr_target = regr_target * pos_weights
+    regr_mask = pos_mask
+    return [cls_target, cls_mask, cls_num_pos, regr_target, regr_mask]
+
+
 class FSAFTarget(Layer):
-    def __init__(self, num_classes, **kwargs):
+    def __init__(self, num_classes, sparse=False, **kwargs):
         super(FSAFTarget, self).__init__(**kwargs)
         self.num_classes = num_classes
+        self.sparse = sparse
 
     def call(self, inputs, **kwargs):
         batch_gt_box_levels = inputs[0]
         feature_shapes = inputs[1][0]
         batch_gt_boxes = inputs[2]
 
-        def _build_fsaf_target(args):
-            gt_box_levels = args[0]
-            gt_boxes = args[1]
-
-            return build_fsaf_target(
-                gt_box_levels,
-                gt_boxes,
-                feature_shapes=feature_shapes,
-                num_classes=self.num_classes,
-                strides=STRIDES,
-                pos_scale=POS_SCALE,
-                ignore_scale=IGNORE_SCALE,
-            )
-
-        outputs = tf.map_fn(
-            _build_fsaf_target,
-            elems=[batch_gt_box_levels, batch_gt_boxes],
-            dtype=[tf.float32, tf.bool, tf.float32, tf.float32, tf.bool],
+        outputs = build_batch_fsaf_target(
+            batch_gt_box_levels,
+            batch_gt_boxes,
+            feature_shapes=feature_shapes,
+            num_classes=self.num_classes,
+            strides=STRIDES,
+            pos_scale=POS_SCALE,
+            ignore_scale=IGNORE_SCALE,
+            sparse=self.sparse,
         )
         return outputs
 
@@ -302,8 +570,11 @@ class FSAFTarget(Layer):
 
         Returns
             List of tuples representing the shapes of [batch_cls_target, batch_cls_mask, batch_num_pos, batch_regr_target, batch_regr_mask]
+            or [batch_cls_labels, regr_target] if sparse
         """
         batch_size = input_shape[0][0]
+        if self.sparse:
+            return [[batch_size, None], [None, 4]]
         return [[batch_size, None, self.num_classes], [batch_size, None], [batch_size, ], [batch_size, None, 4],
                 [batch_size, None]]
 
@@ -315,7 +586,7 @@ class FSAFTarget(Layer):
             Dictionary containing the parameters of this layer.
         """
         config = super(FSAFTarget, self).get_config()
-        config.update({'num_classes': self.num_classes})
+        config.update({'num_classes': self.num_classes, 'sparse': self.sparse})
         return config
 
 
@@ -324,19 +595,22 @@ class Locations(Layer):
     Keras layer for generating anchors for a given shape.
     """
 
-    def __init__(self, strides, *args, **kwargs):
+    def __init__(self, strides, feature_shapes=None, *args, **kwargs):
         """
         Initializer for an Anchors layer.
 
         Args
             strides: The strides mapping to the feature maps.
+            feature_shapes: Optional list of known feature shapes, each a list of (fh, fw) for every level. The
+                locations of those shapes are precomputed and selected instead of being rebuilt on every forward pass.
+                The locations are always precomputed if the shapes of the features are static.
         """
         self.strides = strides
+        self.feature_shapes = feature_shapes
 
         super(Locations, self).__init__(**kwargs)
 
-    def call(self, inputs, **kwargs):
-        features = inputs
+    def compute_locations(self, features):
         feature_shapes = [tf.shape(feature)[1:3] for feature in features]
         locations_per_feature = []
         strides_per_feature = []
@@ -355,8 +629,28 @@ class Locations(Layer):
             strides = tf.reshape(strides, (-1,))
             strides_per_feature.append(strides)
         locations = K.concatenate(locations_per_feature, axis=0)
-        locations = tf.tile(tf.expand_dims(locations, axis=0), (tf.shape(inputs[0])[0], 1, 1))
         strides = tf.concat(strides_per_feature, axis=0)
+        return locations, strides
+
+    def constant_locations(self, feature_shapes):
+        locations, strides = locations_for_shapes(feature_shapes, self.strides)
+        return K.constant(locations), K.constant(strides)
+
+    def call(self, inputs, **kwargs):
+        features = inputs
+        static_shapes = [K.int_shape(feature)[1:3] for feature in features]
+        if all(None not in static_shape for static_shape in static_shapes):
+            locations, strides = self.constant_locations(static_shapes)
+        elif self.feature_shapes:
+            # (num_levels, 2)
+            feature_shapes = K.stack([tf.shape(feature)[1:3] for feature in features], axis=0)
+            branches = [(K.all(K.equal(feature_shapes, known_shapes)),
+                         lambda known_shapes=known_shapes: self.constant_locations(known_shapes))
+                        for known_shapes in self.feature_shapes]
+            locations, strides = tf.case(branches, default=lambda: self.compute_locations(features), exclusive=False)
+        else:
+            locations, strides = self.compute_locations(features)
+        locations = tf.tile(tf.expand_dims(locations, axis=0), (tf.shape(inputs[0])[0], 1, 1))
         strides = tf.tile(tf.expand_dims(strides, axis=0), (tf.shape(inputs[0])[0], 1))
         return [locations, strides]
 
@@ -372,7 +666,7 @@ class Locations(Layer):
 
     def get_config(self):
         base_config = super(Locations, self).get_config()
-        base_config.update({'strides': self.strides})
+        base_config.update({'strides': self.strides, 'feature_shapes': self.feature_shapes})
         return base_config
 
 
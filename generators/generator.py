@@ -33,6 +33,7 @@ from utils.image import (
     preprocess_image,
     resize_image,
 )
+from utils.fsaf import compute_batch_fsaf_targets
 from utils.transform import transform_aabb
 import configure
 
@@ -54,7 +55,10 @@ class Generator(keras.utils.Sequence):
             transform_parameters=None,
             compute_shapes=guess_shapes,
             preprocess_image=preprocess_image,
-            config=None
+            config=None,
+            level_assigner=None,
+            sparse_targets=False,
+            level_cache=None
     ):
         """
         Initialize Generator object.
@@ -69,6 +73,13 @@ class Generator(keras.utils.Sequence):
             transform_parameters: The transform parameters used for data augmentation.
             compute_shapes: Function handler for computing the shapes of the pyramid for a given input.
             preprocess_image: Function handler for preprocessing an image (scaling / normalizing) for passing through a network.
+            config: Config parameters, None indicates the default configuration.
+            level_assigner: Function handler which takes the group and the (B, MAX_NUM_GT_BOXES, 5) gt boxes and returns
+                the (B, MAX_NUM_GT_BOXES) levels of the gt boxes. If given, the fsaf targets are computed here and
+                the inputs are [images, cls_target, cls_mask, cls_num_pos, regr_target, regr_mask].
+            sparse_targets: If True, the fsaf targets computed here are [images, cls_labels, regr_target] instead.
+            level_cache: utils.level_cache.LevelCache, if given the cached levels of the gt boxes are appended to the
+                inputs so that LevelSelect only runs for the boxes which are not cached.
         """
         self.transform_generator = transform_generator
         self.visual_effect_generator = visual_effect_generator
@@ -83,6 +94,9 @@ class Generator(keras.utils.Sequence):
         self.compute_shapes = compute_shapes
         self.preprocess_image = preprocess_image
         self.config = config
+        self.level_assigner = level_assigner
+        self.sparse_targets = sparse_targets
+        self.level_cache = level_cache
         self.groups = None
         self.current_index = 0
 
@@ -412,6 +426,30 @@ class Generator(keras.utils.Sequence):
             batch_gt_boxes[image_index, :gt_boxes.shape[0]] = gt_boxes
         return [batch_images, batch_gt_boxes, batch_feature_shapes]
 
+    def compute_fsaf_inputs(self, inputs, group):
+        """
+        Replace the gt boxes and feature shapes in the inputs by the fsaf targets of the assigned levels.
+        """
+        batch_images, batch_gt_boxes, batch_feature_shapes = inputs
+        batch_gt_box_levels = self.level_assigner(group, batch_gt_boxes)
+        batch_targets = compute_batch_fsaf_targets(
+            batch_gt_boxes,
+            batch_gt_box_levels,
+            batch_feature_shapes[0],
+            self.num_classes(),
+            strides=configure.STRIDES,
+            pos_scale=configure.POS_SCALE,
+            ignore_scale=configure.IGNORE_SCALE,
+            sparse=self.sparse_targets
+        )
+        if self.sparse_targets:
+            batch_cls_labels, batch_regr_target = batch_targets
+            return [batch_images, batch_cls_labels, batch_regr_target]
+        batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask = batch_targets
+        # (b, ) --> (b, 1)
+        batch_cls_num_pos = batch_cls_num_pos[:, None]
+        return [batch_images, batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask]
+
     def generate_anchors(self, image_shape):
         anchor_params = None
         if self.config and 'anchor_parameters' in self.config:
@@ -424,15 +462,21 @@ class Generator(keras.utils.Sequence):
         """
         print('nothing')
 
-    def compute_input_output(self, group):
+    def prepare_group(self, group):
         """
-        Compute inputs and target outputs for the network.
+        Load, augment and preprocess the images and annotations of a group.
+
+        Returns
+            The image indices of the images which are kept, with their images and annotations.
+            The annotations have an extra 'box_indices' entry, the index of every gt box in the loaded annotations.
         """
 
         # load images and annotations
         # list
         image_group = self.load_image_group(group)
         annotations_group = self.load_annotations_group(group)
+        for annotations in annotations_group:
+            annotations['box_indices'] = np.arange(annotations['bboxes'].shape[0])
 
         # check validity of annotations
         image_group, annotations_group = self.filter_annotations(image_group, annotations_group, group)
@@ -443,18 +487,37 @@ class Generator(keras.utils.Sequence):
         # randomly transform data
         image_group, annotations_group = self.random_transform_group(image_group, annotations_group)
 
-        # check validity of annotations
+        # check validity of annotations, images without any valid box are dropped
+        loaded_annotations_group = annotations_group
         image_group, annotations_group = self.clip_transformed_annotations(image_group, annotations_group, group)
+        group = [image_index for image_index, annotations in zip(group, loaded_annotations_group)
+                 if any(annotations is kept_annotations for kept_annotations in annotations_group)]
 
         if len(image_group) == 0:
-            return None, None
+            return group, image_group, annotations_group
 
         # perform preprocessing steps
         image_group, annotations_group = self.preprocess_group(image_group, annotations_group)
+        return group, image_group, annotations_group
+
+    def compute_input_output(self, group):
+        """
+        Compute inputs and target outputs for the network.
+        """
+        group, image_group, annotations_group = self.prepare_group(group)
+
+        if len(image_group) == 0:
+            return None, None
 
         # compute network inputs
         inputs = self.compute_inputs(image_group, annotations_group)
 
+        # optionally compute the fsaf targets here instead of in the graph
+        if self.level_assigner is not None:
+            inputs = self.compute_fsaf_inputs(inputs, group)
+        elif self.level_cache is not None:
+            inputs.append(self.level_cache.lookup(group, [annotations['box_indices'] for annotations in annotations_group]))
+
         # compute network targets
         targets = [np.zeros((len(image_group), ), dtype=np.float32), np.zeros((len(image_group), ), dtype=np.float32)]
 
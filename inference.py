@@ -3,6 +3,7 @@ import models
 from utils.image import read_image_bgr, preprocess_image, resize_image
 from utils.visualization import draw_box, draw_caption
 from utils.colors import label_color
+from utils.profiling import LatencyRecorder
 
 # import miscellaneous modules
 import matplotlib.pyplot as plt
@@ -70,22 +71,29 @@ for key, value in voc_classes.items():
     labels_to_names[value] = key
 # load image
 image_paths = glob.glob('datasets/voc_test/VOC2007/JPEGImages/*.jpg')
-for image_path in image_paths:
+recorder = LatencyRecorder()
+# number of images between two latency summaries
+log_interval = 10
+for image_index, image_path in enumerate(image_paths):
     print('Handling {}'.format(image_path))
-    image = read_image_bgr(image_path)
+    with recorder.stage('decode'):
+        image = read_image_bgr(image_path)
 
     # copy to draw on
     draw = image.copy()
 
     # preprocess image for network
-    image = preprocess_image(image)
-    image, scale = resize_image(image)
+    with recorder.stage('preprocess'):
+        image = preprocess_image(image)
+    with recorder.stage('resize'):
+        image, scale = resize_image(image)
 
     # process image
-    start = time.time()
-    # locations, feature_shapes = model.predict_on_batch(np.expand_dims(image, axis=0))
-    boxes, scores, labels = model.predict_on_batch(np.expand_dims(image, axis=0))
-    print("processing time: ", time.time() - start)
+    with recorder.stage('forward'):
+        # locations, feature_shapes = model.predict_on_batch(np.expand_dims(image, axis=0))
+        boxes, scores, labels = model.predict_on_batch(np.expand_dims(image, axis=0))
+    if (image_index + 1) % log_interval == 0:
+        print(recorder.format())
 
     # correct for image scale
     boxes /= scale
@@ -113,4 +121,5 @@ for image_path in image_paths:
     if int(key) == 121:
         image_fname = osp.split(image_path)[-1]
         cv2.imwrite('test/{}'.format(image_fname), draw)
+print(recorder.format())
 
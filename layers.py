@@ -3,6 +3,7 @@ import keras.backend as K
 import tensorflow as tf
 from utils import anchors as utils_anchors
 import util_graphs
+from utils.fsaf import locations_for_shapes
 
 import numpy as np
 
@@ -127,6 +128,182 @@ class ClipBoxes(keras.layers.Layer):
         return input_shape[1]
 
 
+def level_top_k(classification, level_sizes, k):
+    """
+    Select the k best scoring locations of every pyramid level.
+
+    Args
+        classification: Tensor of shape (B, num_boxes, num_classes), the locations of all levels concatenated.
+        level_sizes: The number of locations of every level, in the order they are concatenated.
+        k: The maximum number of locations to keep per level.
+
+    Returns
+        List of tensors of shape (B, min(k, level_size)) with the indices of the selected locations of every level.
+    """
+    # (B, num_boxes)
+    scores = K.max(classification, axis=-1)
+    start = 0
+    indices = []
+    for level_size in level_sizes:
+        level_scores = scores[:, start:start + level_size]
+        _, level_indices = tf.nn.top_k(level_scores, k=K.minimum(k, level_size))
+        indices.append(level_indices + start)
+        start = start + level_size
+    return indices
+
+
+class LevelTopK(keras.layers.Layer):
+    """
+    Keras layer to keep only the top-k scoring locations of every pyramid level, so the number of NMS candidates is
+    bounded whatever the scores are.
+    """
+
+    def __init__(self, k=1000, **kwargs):
+        """
+        Initializer for the LevelTopK layer.
+
+        Args
+            k: The maximum number of locations to keep per level.
+        """
+        self.k = k
+        super(LevelTopK, self).__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        """
+        Args
+            inputs : List of [boxes, classification, features[0], features[1], ...] tensors, the features are only used
+                for the number of locations of every level.
+        """
+        boxes, classification = inputs[0], inputs[1]
+        features = inputs[2:]
+        level_sizes = [K.shape(feature)[1] * K.shape(feature)[2] for feature in features]
+        indices = K.concatenate(level_top_k(classification, level_sizes, self.k), axis=1)
+        boxes = tf.gather(boxes, indices, batch_dims=1)
+        classification = tf.gather(classification, indices, batch_dims=1)
+        return [boxes, classification]
+
+    def compute_output_shape(self, input_shape):
+        return [
+            (input_shape[0][0], None, input_shape[0][2]),
+            (input_shape[1][0], None, input_shape[1][2]),
+        ]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None, None]
+
+    def get_config(self):
+        config = super(LevelTopK, self).get_config()
+        config.update({'k': self.k})
+        return config
+
+
+class TopKRegressBoxes(keras.layers.Layer):
+    """
+    Keras layer which selects the top-k scoring locations of every pyramid level, then computes and clips the boxes of
+    those locations only.
+
+    Same output as Locations, RegressBoxes, ClipBoxes and LevelTopK applied one after the other, without decoding a
+    box for every location.
+    """
+
+    def __init__(self, strides, k=1000, feature_shapes=None, **kwargs):
+        """
+        Initializer for the TopKRegressBoxes layer.
+
+        Args
+            strides: The strides mapping to the feature maps.
+            k: The maximum number of locations to keep per level.
+            feature_shapes: Optional list of known feature shapes, each a list of (fh, fw) for every level. The
+                locations of those shapes are precomputed and gathered by the selected indices instead of being
+                computed from the indices on every forward pass, like in fsaf_layers.Locations.
+        """
+        self.strides = strides
+        self.k = k
+        self.feature_shapes = feature_shapes
+        super(TopKRegressBoxes, self).__init__(**kwargs)
+
+    def compute_locations(self, level_indices, feature_shapes):
+        """
+        Compute the (B, num_selected, 2) (x, y) locations of the selected indices of every level from the indices.
+        """
+        locations = []
+        start = 0
+        for indices_, fh_fw, stride in zip(level_indices, feature_shapes, self.strides):
+            fw = fh_fw[1]
+            local_indices = indices_ - start
+            locations.append(K.stack([K.cast(local_indices % fw, K.floatx()) * stride + stride // 2,
+                                      K.cast(local_indices // fw, K.floatx()) * stride + stride // 2], axis=2))
+            start = start + fh_fw[0] * fw
+        return K.concatenate(locations, axis=1)
+
+    def constant_locations(self, feature_shapes, indices):
+        """
+        Gather the (B, num_selected, 2) (x, y) locations of the selected indices from the precomputed locations.
+        """
+        locations, _ = locations_for_shapes(feature_shapes, self.strides)
+        return tf.gather(K.constant(locations), indices)
+
+    def call(self, inputs, **kwargs):
+        """
+        Args
+            inputs : List of [image, regression, classification, features[0], features[1], ...] tensors.
+        """
+        image, regression, classification = inputs[0], inputs[1], inputs[2]
+        features = inputs[3:]
+        feature_shapes = [K.shape(feature)[1:3] for feature in features]
+        level_indices = level_top_k(classification, [fh_fw[0] * fh_fw[1] for fh_fw in feature_shapes], self.k)
+        # (B, sum(min(k, fh * fw)))
+        indices = K.concatenate(level_indices, axis=1)
+
+        # the locations of the selected indices, same as the ones of the Locations layer
+        static_shapes = [K.int_shape(feature)[1:3] for feature in features]
+        if all(None not in static_shape for static_shape in static_shapes):
+            locations = self.constant_locations(static_shapes, indices)
+        elif self.feature_shapes:
+            # (num_levels, 2)
+            stacked_shapes = K.stack(feature_shapes, axis=0)
+            branches = [(K.all(K.equal(stacked_shapes, known_shapes)),
+                         lambda known_shapes=known_shapes: self.constant_locations(known_shapes, indices))
+                        for known_shapes in self.feature_shapes]
+            locations = tf.case(branches, default=lambda: self.compute_locations(level_indices, feature_shapes),
+                                exclusive=False)
+        else:
+            locations = self.compute_locations(level_indices, feature_shapes)
+        locations_x = locations[:, :, 0]
+        locations_y = locations[:, :, 1]
+
+        regression = tf.gather(regression, indices, batch_dims=1)
+        classification = tf.gather(classification, indices, batch_dims=1)
+
+        shape = K.cast(K.shape(image), K.floatx())
+        height = shape[1]
+        width = shape[2]
+        x1 = tf.clip_by_value(locations_x - regression[:, :, 0] * 4.0, 0, width)
+        y1 = tf.clip_by_value(locations_y - regression[:, :, 1] * 4.0, 0, height)
+        x2 = tf.clip_by_value(locations_x + regression[:, :, 2] * 4.0, 0, width)
+        y2 = tf.clip_by_value(locations_y + regression[:, :, 3] * 4.0, 0, height)
+        boxes = K.stack([x1, y1, x2, y2], axis=2)
+        return [boxes, classification]
+
+    def compute_output_shape(self, input_shape):
+        return [
+            (input_shape[1][0], None, 4),
+            (input_shape[2][0], None, input_shape[2][2]),
+        ]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None, None]
+
+    def get_config(self):
+        config = super(TopKRegressBoxes, self).get_config()
+        config.update({
+            'strides': self.strides,
+            'k': self.k,
+            'feature_shapes': self.feature_shapes,
+        })
+        return config
+
+
 def filter_detections(
         boxes,
         classification,
@@ -200,16 +377,20 @@ def filter_detections(
         return indices_
 
     if class_specific_filter:
-        all_indices = []
-        # perform per class filtering
-        for c in range(int(classification.shape[1])):
-            scores = classification[:, c]
-            labels = c * tf.ones((K.shape(scores)[0],), dtype='int64')
-            all_indices.append(_filter_detections(scores, labels))
-
-        # concatenate indices to single tensor
-        # (concatenated_num_score_nms_keeps, 2)
-        indices = K.concatenate(all_indices, axis=0)
+        # threshold all classes at once
+        # (num_score_keeps, 2) of (box index, label)
+        indices = tf.where(K.greater(classification, score_threshold))
+
+        if nms:
+            filtered_boxes = K.gather(boxes, indices[:, 0])
+            filtered_scores = tf.gather_nd(classification, indices)
+            # shift the boxes of every class apart so that boxes of different classes never overlap,
+            # then a single NMS gives the same result as one NMS per class
+            offsets = K.cast(indices[:, 1], K.floatx()) * (K.max(boxes) + 1)
+            nms_indices = tf.image.non_max_suppression(filtered_boxes + offsets[:, None], filtered_scores,
+                                                       max_output_size=max_detections, iou_threshold=nms_threshold)
+            # (num_score_nms_keeps, 2)
+            indices = K.gather(indices, nms_indices)
     else:
         scores = K.max(classification, axis=1)
         labels = K.argmax(classification, axis=1)
@@ -245,6 +426,50 @@ def filter_detections(
     return [boxes, scores, labels] + other_
 
 
+def batched_filter_detections(
+        boxes,
+        classification,
+        score_threshold=0.05,
+        max_detections=300,
+        nms_threshold=0.5
+):
+    """
+    Filter the detections of a batch per class with a single combined NMS op.
+
+    Same as filter_detections with class_specific_filter=True and nms=True, for all batch items at once.
+
+    Args
+        boxes: Tensor of shape (B, num_boxes, 4) containing the boxes in (x1, y1, x2, y2) format.
+        classification: Tensor of shape (B, num_boxes, num_classes) containing the classification scores.
+        score_threshold: Threshold used to prefilter the boxes with.
+        max_detections: Maximum number of detections to keep.
+        nms_threshold: Threshold for the IoU value to determine when a box should be suppressed.
+
+    Returns
+        A list of [boxes, scores, labels] shaped (B, max_detections, 4), (B, max_detections) and (B, max_detections),
+        padded with -1's.
+    """
+    # the boxes are shared by all classes, IoU does not depend on the coordinate order and the boxes are not normalized
+    nmsed_boxes, nmsed_scores, nmsed_labels, valid_detections = tf.image.combined_non_max_suppression(
+        boxes=K.expand_dims(boxes, axis=2),
+        scores=classification,
+        max_output_size_per_class=max_detections,
+        max_total_size=max_detections,
+        iou_threshold=nms_threshold,
+        score_threshold=score_threshold,
+        clip_boxes=False
+    )
+
+    # (B, max_detections)
+    valid_mask = tf.sequence_mask(valid_detections, max_detections)
+    boxes = tf.where(tf.tile(K.expand_dims(valid_mask, axis=-1), (1, 1, 4)), nmsed_boxes, -K.ones_like(nmsed_boxes))
+    scores = tf.where(valid_mask, nmsed_scores, -K.ones_like(nmsed_scores))
+    labels = K.cast(nmsed_labels, 'int32')
+    labels = tf.where(valid_mask, labels, -K.ones_like(labels))
+
+    return [boxes, scores, labels]
+
+
 class FilterDetections(keras.layers.Layer):
     """
     Keras layer for filtering detections using score threshold and NMS.
@@ -258,6 +483,7 @@ class FilterDetections(keras.layers.Layer):
             score_threshold=0.05,
             max_detections=300,
             parallel_iterations=32,
+            batched_nms=True,
             **kwargs
     ):
         """
@@ -270,6 +496,8 @@ class FilterDetections(keras.layers.Layer):
             score_threshold: Threshold used to prefilter the boxes with.
             max_detections: Maximum number of detections to keep.
             parallel_iterations: Number of batch items to process in parallel.
+            batched_nms: Whether to filter the whole batch with one combined NMS op when nms and class_specific_filter
+                are enabled and there are no other inputs. Otherwise every batch item is filtered in a tf.map_fn.
         """
         self.nms = nms
         self.class_specific_filter = class_specific_filter
@@ -277,6 +505,7 @@ class FilterDetections(keras.layers.Layer):
         self.score_threshold = score_threshold
         self.max_detections = max_detections
         self.parallel_iterations = parallel_iterations
+        self.batched_nms = batched_nms
         super(FilterDetections, self).__init__(**kwargs)
 
     def call(self, inputs, **kwargs):
@@ -290,6 +519,15 @@ class FilterDetections(keras.layers.Layer):
         classification = inputs[1]
         other = inputs[2:]
 
+        if self.batched_nms and self.nms and self.class_specific_filter and not other:
+            return batched_filter_detections(
+                boxes,
+                classification,
+                score_threshold=self.score_threshold,
+                max_detections=self.max_detections,
+                nms_threshold=self.nms_threshold,
+            )
+
         # wrap nms with our parameters
         def _filter_detections(args):
             boxes_ = args[0]
@@ -358,6 +596,7 @@ class FilterDetections(keras.layers.Layer):
             'score_threshold': self.score_threshold,
             'max_detections': self.max_detections,
             'parallel_iterations': self.parallel_iterations,
+            'batched_nms': self.batched_nms,
         })
 
         return config
@@ -143,13 +143,57 @@ def iou():
     return _iou
 
 
-def focal_with_mask(alpha=0.25, gamma=2.0):
+def fused_focal_graph(y_true, y_pred, alpha=0.25, gamma=2.0):
+    """
+    Compute the sum of the focal loss with a hand-written gradient.
+
+    Only y_true and y_pred are kept for the backward pass, the alpha factor, the focal weight and the cross entropy are
+    recomputed there instead of being kept alive as (N, num_classes) intermediates.
+
+    Args
+        y_true: One-hot targets with shape (N, num_classes).
+        y_pred: Predicted probabilities with shape (N, num_classes).
+        alpha: Scale the focal weight with alpha.
+        gamma: Take the power of the focal weight with gamma.
+
+    Returns
+        The sum of the focal loss of y_pred w.r.t. y_true, same as K.sum(focal_weight * K.binary_crossentropy(...)).
+    """
+    epsilon = K.epsilon()
+
+    @tf.custom_gradient
+    def _fused_focal(y_pred):
+        pos_mask = K.equal(y_true, 1)
+        # same clipping as K.binary_crossentropy
+        clipped_pred = tf.clip_by_value(y_pred, epsilon, 1 - epsilon)
+        pos_cls_loss = -alpha * (1 - y_pred) ** gamma * tf.log(clipped_pred)
+        neg_cls_loss = -(1 - alpha) * y_pred ** gamma * tf.log(1 - clipped_pred)
+        cls_loss = K.sum(tf.where(pos_mask, pos_cls_loss, neg_cls_loss))
+
+        def grad(dy):
+            pos_mask = K.equal(y_true, 1)
+            clipped_pred = tf.clip_by_value(y_pred, epsilon, 1 - epsilon)
+            # the gradient does not flow through the clipped values
+            in_range = tf.cast((y_pred >= epsilon) & (y_pred <= 1 - epsilon), y_pred.dtype)
+            pos_grad = alpha * (gamma * (1 - y_pred) ** (gamma - 1) * tf.log(clipped_pred) -
+                                (1 - y_pred) ** gamma / clipped_pred * in_range)
+            neg_grad = (1 - alpha) * (y_pred ** gamma / (1 - clipped_pred) * in_range -
+                                      gamma * y_pred ** (gamma - 1) * tf.log(1 - clipped_pred))
+            return dy * tf.where(pos_mask, pos_grad, neg_grad)
+
+        return cls_loss, grad
+
+    return _fused_focal(y_pred)
+
+
+def focal_with_mask(alpha=0.25, gamma=2.0, fused=True):
     """
     Create a functor for computing the focal loss.
 
     Args
         alpha: Scale the focal weight with alpha.
         gamma: Take the power of the focal weight with gamma.
+        fused: Whether to use fused_focal_graph, which keeps less intermediates alive for the backward pass.
 
     Returns
         A functor that computes the focal loss using the alpha and gamma.
@@ -161,6 +205,8 @@ def focal_with_mask(alpha=0.25, gamma=2.0):
 
         As defined in https://arxiv.org/abs/1708.02002
 
+        The valid locations are gathered once, so the ignored locations never enter the loss computation.
+
         Args
             y_true: Tensor of target data from the generator with shape (B, N, num_classes).
             y_pred: Tensor of predicted data from the network with shape (B, N, num_classes).
@@ -172,18 +218,22 @@ def focal_with_mask(alpha=0.25, gamma=2.0):
         """
         # compute the focal loss
         y_true, y_pred, cls_mask, cls_num_pos = inputs[0], inputs[1], inputs[2], inputs[3]
-        alpha_factor = K.ones_like(y_true) * alpha
-        alpha_factor = tf.where(K.equal(y_true, 1), alpha_factor, 1 - alpha_factor)
-        focal_weight = tf.where(K.equal(y_true, 1), 1 - y_pred, y_pred)
-        focal_weight = alpha_factor * focal_weight ** gamma
-        # (B, N) --> (B, N, 1)
-        cls_mask = tf.cast(cls_mask, tf.float32)
-        cls_mask = tf.expand_dims(cls_mask, axis=-1)
-        # (B, N, num_classes) * (B, N, 1)
-        masked_cls_loss = focal_weight * K.binary_crossentropy(y_true, y_pred) * cls_mask
+        # (num_valid, 2)
+        indices = tf.where(cls_mask)
+        # (num_valid, num_classes)
+        y_true = tf.gather_nd(y_true, indices)
+        y_pred = tf.gather_nd(y_pred, indices)
+        if fused:
+            cls_loss = fused_focal_graph(y_true, y_pred, alpha=alpha, gamma=gamma)
+        else:
+            alpha_factor = K.ones_like(y_true) * alpha
+            alpha_factor = tf.where(K.equal(y_true, 1), alpha_factor, 1 - alpha_factor)
+            focal_weight = tf.where(K.equal(y_true, 1), 1 - y_pred, y_pred)
+            focal_weight = alpha_factor * focal_weight ** gamma
+            cls_loss = K.sum(focal_weight * K.binary_crossentropy(y_true, y_pred))
         # compute the normalizer: the number of positive locations
         normalizer = K.maximum(K.cast_to_floatx(1.0), tf.reduce_sum(cls_num_pos))
-        return K.sum(masked_cls_loss) / normalizer
+        return cls_loss / normalizer
 
     return _focal
 
@@ -199,36 +249,136 @@ def iou_with_mask():
 
         """
         y_true, y_pred, regr_mask = inputs[0], inputs[1], inputs[2]
-        y_true = tf.maximum(y_true, 0)
-        pred_left = y_pred[:, :, 0]
-        pred_top = y_pred[:, :, 1]
-        pred_right = y_pred[:, :, 2]
-        pred_bottom = y_pred[:, :, 3]
+        # gather the positive locations once
+        # (num_pos, 2)
+        indices = tf.where(regr_mask)
+        # (num_pos, 4)
+        y_true = tf.maximum(tf.gather_nd(y_true, indices), 0)
+        y_pred = tf.gather_nd(y_pred, indices)
+        pred_left = y_pred[:, 0]
+        pred_top = y_pred[:, 1]
+        pred_right = y_pred[:, 2]
+        pred_bottom = y_pred[:, 3]
 
-        # (B, N)
-        target_left = y_true[:, :, 0]
-        target_top = y_true[:, :, 1]
-        target_right = y_true[:, :, 2]
-        target_bottom = y_true[:, :, 3]
+        # (num_pos, )
+        target_left = y_true[:, 0]
+        target_top = y_true[:, 1]
+        target_right = y_true[:, 2]
+        target_bottom = y_true[:, 3]
 
-        # (B, N)
         target_area = (target_left + target_right) * (target_top + target_bottom)
-        masked_target_area = tf.boolean_mask(target_area, regr_mask)
         pred_area = (pred_left + pred_right) * (pred_top + pred_bottom)
-        masked_pred_area = tf.boolean_mask(pred_area, regr_mask)
         w_intersect = tf.minimum(pred_left, target_left) + tf.minimum(pred_right, target_right)
         h_intersect = tf.minimum(pred_bottom, target_bottom) + tf.minimum(pred_top, target_top)
 
         area_intersect = w_intersect * h_intersect
-        masked_area_intersect = tf.boolean_mask(area_intersect, regr_mask)
-        masked_area_union = masked_target_area + masked_pred_area - masked_area_intersect
+        area_union = target_area + pred_area - area_intersect
 
-        # (B, N)
-        masked_iou_loss = -tf.log((masked_area_intersect + 1e-7) / (masked_area_union + 1e-7))
-        regr_mask = tf.cast(regr_mask, tf.float32)
+        # (num_pos, )
+        iou_loss = -tf.log((area_intersect + 1e-7) / (area_union + 1e-7))
         # compute the normalizer: the number of positive locations
-        regr_num_pos = tf.reduce_sum(regr_mask)
+        regr_num_pos = tf.cast(tf.shape(indices)[0], K.floatx())
         normalizer = K.maximum(K.cast_to_floatx(1.), regr_num_pos)
-        return K.sum(masked_iou_loss) / normalizer
+        return K.sum(iou_loss) / normalizer
+
+    return _iou
+
+
+def focal_with_labels(alpha=0.25, gamma=2.0):
+    """
+    Create a functor for computing the focal loss from sparse class labels.
+
+    Args
+        alpha: Scale the focal weight with alpha.
+        gamma: Take the power of the focal weight with gamma.
+
+    Returns
+        A functor that computes the focal loss using the alpha and gamma.
+    """
+
+    def _focal(inputs):
+        """
+        Compute the focal loss given the class labels and the predicted tensor.
+
+        The loss of every location is computed as if all classes were negatives, then the class of the positive
+        locations is swapped to a positive, so the one-hot target is never built.
+
+        Args
+            cls_labels: (B, N) label of the positive locations, -1 for the negative and -2 for the ignored locations.
+            y_pred: Tensor of predicted data from the network with shape (B, N, num_classes).
+
+        Returns
+            The focal loss of y_pred w.r.t. cls_labels.
+        """
+        cls_labels, y_pred = inputs[0], inputs[1]
+        cls_labels = tf.cast(cls_labels, tf.int32)
+        # gather the valid (positive and negative) locations once
+        # (num_valid, 2)
+        indices = tf.where(K.greater_equal(cls_labels, -1))
+        # (num_valid, )
+        cls_labels = tf.gather_nd(cls_labels, indices)
+        # (num_valid, num_classes)
+        y_pred = tf.gather_nd(y_pred, indices)
+        pos_mask = tf.cast(K.greater_equal(cls_labels, 0), K.floatx())
+        neg_cls_loss = (1 - alpha) * y_pred ** gamma * K.binary_crossentropy(K.zeros_like(y_pred), y_pred)
+        neg_cls_loss = K.sum(neg_cls_loss, axis=-1)
+        # (num_valid, ), prediction of the labeled class
+        label_pred = tf.gather(y_pred, K.maximum(cls_labels, 0), batch_dims=1)
+        label_neg_cls_loss = (1 - alpha) * label_pred ** gamma * K.binary_crossentropy(K.zeros_like(label_pred),
+                                                                                     label_pred)
+        label_pos_cls_loss = alpha * (1 - label_pred) ** gamma * K.binary_crossentropy(K.ones_like(label_pred),
+                                                                                     label_pred)
+        cls_loss = neg_cls_loss + pos_mask * (label_pos_cls_loss - label_neg_cls_loss)
+        # compute the normalizer: the number of positive locations
+        normalizer = K.maximum(K.cast_to_floatx(1.0), K.sum(pos_mask))
+        return K.sum(cls_loss) / normalizer
+
+    return _focal
+
+
+def iou_with_labels():
+    def _iou(inputs):
+        """
+
+        Args:
+            inputs: y_true: (num_pos, 4) regression targets of the positive locations, or (B, N, 4)
+                    y_pred: (B, N, 4)
+                    cls_labels: (B, N) label of the positive locations, -1 for the negative and -2 for the ignored locations.
+
+        Returns:
+
+        """
+        y_true, y_pred, cls_labels = inputs[0], inputs[1], inputs[2]
+        # (num_pos, 2), in the same order as the positive regression targets
+        indices = tf.where(K.greater_equal(cls_labels, 0))
+        if K.ndim(y_true) == 3:
+            y_true = tf.gather_nd(y_true, indices)
+        y_pred = tf.gather_nd(y_pred, indices)
+        y_true = tf.maximum(y_true, 0)
+        pred_left = y_pred[:, 0]
+        pred_top = y_pred[:, 1]
+        pred_right = y_pred[:, 2]
+        pred_bottom = y_pred[:, 3]
+
+        # (num_pos, )
+        target_left = y_true[:, 0]
+        target_top = y_true[:, 1]
+        target_right = y_true[:, 2]
+        target_bottom = y_true[:, 3]
+
+        target_area = (target_left + target_right) * (target_top + target_bottom)
+        pred_area = (pred_left + pred_right) * (pred_top + pred_bottom)
+        w_intersect = tf.minimum(pred_left, target_left) + tf.minimum(pred_right, target_right)
+        h_intersect = tf.minimum(pred_bottom, target_bottom) + tf.minimum(pred_top, target_top)
+
+        area_intersect = w_intersect * h_intersect
+        area_union = target_area + pred_area - area_intersect
+
+        # (num_pos, )
+        iou_loss = -tf.log((area_intersect + 1e-7) / (area_union + 1e-7))
+        # compute the normalizer: the number of positive locations
+        normalizer = K.maximum(1, K.shape(indices)[0])
+        normalizer = K.cast(normalizer, dtype=K.floatx())
+        return K.sum(iou_loss) / normalizer
 
     return _iou
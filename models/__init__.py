@@ -3,7 +3,7 @@ import sys
 import layers
 import losses
 import initializers
-from fsaf_layers import RegressBoxes, Locations, LevelSelect, FSAFTarget
+from fsaf_layers import RegressBoxes, Locations, LevelSelect, HeuristicLevelSelect, FSAFTarget
 import keras
 import tensorflow as tf
 
@@ -19,12 +19,15 @@ class Backbone(object):
             'PriorProbability': initializers.PriorProbability,
             'RegressBoxes': RegressBoxes,
             'FilterDetections': layers.FilterDetections,
+            'LevelTopK': layers.LevelTopK,
+            'TopKRegressBoxes': layers.TopKRegressBoxes,
             'Anchors': layers.Anchors,
             'ClipBoxes': layers.ClipBoxes,
             'cls_loss': losses.focal_with_mask(),
             'regr_loss': losses.iou_with_mask(),
             'Locations': Locations,
             'LevelSelect': LevelSelect,
+            'HeuristicLevelSelect': HeuristicLevelSelect,
             'FSAFTarget': FSAFTarget,
             'keras': keras,
             'tf': tf,
@@ -41,11 +41,17 @@ class ResNetBackbone(Backbone):
         """
         return resnet_retinanet(*args, backbone=self.backbone, **kwargs)
 
-    def fsaf(self, num_classes, modifier):
+    def fsaf(self, num_classes, modifier, **kwargs):
         """
         Returns a retinanet model using the correct backbone.
         """
-        return resnet_fsaf(num_classes=num_classes, backbone=self.backbone, modifier=modifier)
+        return resnet_fsaf(num_classes=num_classes, backbone=self.backbone, modifier=modifier, **kwargs)
+
+    def fsaf_multi_head_bbox(self, heads, modifier=None, **kwargs):
+        """
+        Returns a multi head fsaf inference model using the correct backbone.
+        """
+        return resnet_fsaf_multi_head_bbox(heads=heads, backbone=self.backbone, modifier=modifier, **kwargs)
 
     def download_imagenet(self):
         """
@@ -124,7 +130,8 @@ def resnet_retinanet(num_classes, backbone='resnet50', modifier=None, **kwargs):
     return retinanet.retinanet(inputs=inputs, num_classes=num_classes, backbone_layers=resnet.outputs[1:], **kwargs)
 
 
-def resnet_fsaf(num_classes, backbone='resnet50', modifier=None):
+def resnet_fsaf(num_classes, backbone='resnet50', modifier=None, host_targets=False, sparse_targets=False,
+                cached_levels=False, level_select='online'):
     """
     Constructs a retinanet model using a resnet backbone.
 
@@ -133,13 +140,32 @@ def resnet_fsaf(num_classes, backbone='resnet50', modifier=None):
         backbone: Which backbone to use (one of ('resnet50', 'resnet101', 'resnet152')).
         inputs: The inputs to the network (defaults to a Tensor of shape (None, None, 3)).
         modifier: A function handler which can modify the backbone before using it in retinanet (this can be used to freeze backbone layers for example).
+        host_targets: If True, the model takes the fsaf targets computed by the generator as inputs instead of the gt boxes.
+        sparse_targets: If True, the fsaf targets are the class label of every location instead of one-hot targets and masks.
+        cached_levels: If True, the model takes the cached levels of the gt boxes as an extra input.
+        level_select: How the gt boxes are assigned to levels, one of ('online', 'heuristic').
 
     Returns
         RetinaNet model with a ResNet backbone.
     """
     image_input = keras.layers.Input(shape=(None, None, 3))
-    gt_boxes_input = keras.layers.Input(shape=(configure.MAX_NUM_GT_BOXES, 5))
-    feature_shapes_input = keras.layers.Input((5, 2), dtype='int32')
+    if host_targets and sparse_targets:
+        cls_labels_input = keras.layers.Input(shape=(None,), dtype='int32')
+        regr_target_input = keras.layers.Input(shape=(None, 4))
+        inputs = [image_input, cls_labels_input, regr_target_input]
+    elif host_targets:
+        cls_target_input = keras.layers.Input(shape=(None, num_classes))
+        cls_mask_input = keras.layers.Input(shape=(None,), dtype='bool')
+        cls_num_pos_input = keras.layers.Input(shape=(1,))
+        regr_target_input = keras.layers.Input(shape=(None, 4))
+        regr_mask_input = keras.layers.Input(shape=(None,), dtype='bool')
+        inputs = [image_input, cls_target_input, cls_mask_input, cls_num_pos_input, regr_target_input, regr_mask_input]
+    else:
+        gt_boxes_input = keras.layers.Input(shape=(configure.MAX_NUM_GT_BOXES, 5))
+        feature_shapes_input = keras.layers.Input((5, 2), dtype='int32')
+        inputs = [image_input, gt_boxes_input, feature_shapes_input]
+        if cached_levels:
+            inputs.append(keras.layers.Input((configure.MAX_NUM_GT_BOXES,), dtype='int32'))
 
     # create the resnet backbone
     if backbone == 'resnet50':
@@ -156,9 +182,49 @@ def resnet_fsaf(num_classes, backbone='resnet50', modifier=None):
         resnet = modifier(resnet)
 
     # create the full model
-    return retinanet.fsaf(inputs=[image_input, gt_boxes_input, feature_shapes_input],
+    if host_targets:
+        return retinanet.fsaf_with_targets(inputs=inputs,
+                                           num_classes=num_classes,
+                                           backbone_layers=resnet.outputs[1:],
+                                           sparse_targets=sparse_targets)
+    return retinanet.fsaf(inputs=inputs,
                           num_classes=num_classes,
-                          backbone_layers=resnet.outputs[1:])
+                          backbone_layers=resnet.outputs[1:],
+                          sparse_targets=sparse_targets,
+                          level_select=level_select)
+
+
+def resnet_fsaf_multi_head_bbox(heads, backbone='resnet50', modifier=None, **kwargs):
+    """
+    Constructs a multi head fsaf inference model using a resnet backbone, the backbone runs once for all the heads.
+
+    Args
+        heads: List of (head name, number of classes).
+        backbone: Which backbone to use (one of ('resnet50', 'resnet101', 'resnet152')).
+        modifier: A function handler which can modify the backbone before using it.
+        **kwargs: Passed to models.retinanet.fsaf_multi_head_bbox.
+
+    Returns
+        A keras.models.Model which outputs the [boxes, scores, labels] of every head.
+    """
+    image_input = keras.layers.Input(shape=(None, None, 3))
+
+    # create the resnet backbone
+    if backbone == 'resnet50':
+        resnet = keras_resnet.models.ResNet50(image_input, include_top=False, freeze_bn=True)
+    elif backbone == 'resnet101':
+        resnet = keras_resnet.models.ResNet101(image_input, include_top=False, freeze_bn=True)
+    elif backbone == 'resnet152':
+        resnet = keras_resnet.models.ResNet152(image_input, include_top=False, freeze_bn=True)
+    else:
+        raise ValueError('Backbone (\'{}\') is invalid.'.format(backbone))
+
+    # invoke modifier if given
+    if modifier:
+        resnet = modifier(resnet)
+
+    return retinanet.fsaf_multi_head_bbox(inputs=image_input, backbone_layers=resnet.outputs[1:], heads=heads,
+                                          **kwargs)
 
 
 def resnet50_retinanet(num_classes, inputs=None, **kwargs):
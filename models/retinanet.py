@@ -18,10 +18,10 @@ import keras
 import tensorflow as tf
 import initializers
 import layers
-from utils.anchors import AnchorParameters
+from utils.anchors import AnchorParameters, guess_shapes
 from models import assert_training_model
-from fsaf_layers import LevelSelect, FSAFTarget, Locations, RegressBoxes
-from losses import focal_with_mask, iou_with_mask
+from fsaf_layers import LevelSelect, HeuristicLevelSelect, FSAFTarget, Locations, RegressBoxes
+from losses import focal_with_mask, iou_with_mask, focal_with_labels, iou_with_labels
 import keras.backend as K
 import configure
 
@@ -226,6 +226,10 @@ def default_fsaf_regression_model(
     return keras.models.Model(inputs=inputs, outputs=outputs, name=name)
 
 
+# the layers of the pyramid with weights, see __create_pyramid_features
+PYRAMID_LAYERS = ('C5_reduced', 'P5', 'C4_reduced', 'P4', 'C3_reduced', 'P3', 'P6', 'P7')
+
+
 def __create_pyramid_features(C3, C4, C5, feature_size=256):
     """
     Creates the FPN layers on top of the backbone features.
@@ -501,11 +505,35 @@ def retinanet_bbox(
     return keras.models.Model(inputs=model.inputs, outputs=detections, name=name)
 
 
+def __build_sparse_losses(batch_cls_labels, batch_regr_target, batch_cls_pred, batch_regr_pred):
+    """
+    Build the cls_loss and regr_loss layers on top of the sparse fsaf targets.
+
+    Args
+        batch_cls_labels: (b, sum(fh*fw)) label of the positive locations, -1 for the negative and -2 for the ignored ones.
+        batch_regr_target: Regression targets of the positive locations, either (num_pos, 4) or (b, sum(fh*fw), 4).
+        batch_cls_pred: (b, sum(fh*fw), num_classes)
+        batch_regr_pred: (b, sum(fh*fw), 4)
+
+    Returns
+        cls_loss, regr_loss
+    """
+    cls_loss = keras.layers.Lambda(focal_with_labels(),
+                                   output_shape=(1,),
+                                   name="cls_loss")([batch_cls_labels, batch_cls_pred])
+    regr_loss = keras.layers.Lambda(iou_with_labels(),
+                                    output_shape=(1,),
+                                    name="regr_loss")([batch_regr_target, batch_regr_pred, batch_cls_labels])
+    return cls_loss, regr_loss
+
+
 def fsaf(
         inputs,
         backbone_layers,
         num_classes,
         create_pyramid_features=__create_pyramid_features,
+        sparse_targets=False,
+        level_select='online',
         name='fsaf'
 ):
     """
@@ -514,11 +542,16 @@ def fsaf(
     This model is the minimum model necessary for training (with the unfortunate exception of anchors as output).
 
     Args
-        inputs: keras.layers.Input (or list of) for the input to the model.
+        inputs: List of keras.layers.Input for [image, gt_boxes, feature_shapes] and optionally the cached levels of the
+            gt boxes (see utils.level_cache.LevelCache).
         num_classes: Number of classes to classify.
         num_anchors: Number of base anchors.
         create_pyramid_features : Functor for creating pyramid features given the features C3, C4, C5 from the backbone.
         submodels: Submodels to run on each feature map (default is regression and classification submodels).
+        sparse_targets: If True, FSAFTarget outputs the class label of every location and the regression targets of the
+            positive locations only, instead of the dense targets and masks.
+        level_select: How the gt boxes are assigned to levels, one of ('online', 'heuristic'). 'online' picks the level
+            with the minimal loss, 'heuristic' picks it from the box size only. Both modes share the same weights.
         name: Name of the model.
 
     Returns
@@ -544,8 +577,26 @@ def fsaf(
     # for all pyramid levels, run available submodels
     # [(b, sum(fh*fw), 4), (b, sum(fh*fw), num_classes)]
     batch_regr_pred, batch_cls_pred = __build_fsaf_pyramid(submodels, features)
-    batch_gt_box_levels = LevelSelect(name='level_select')(
-        [batch_cls_pred, batch_regr_pred, feature_shapes_input, gt_boxes_input])
+    if level_select == 'online':
+        level_select_layer = LevelSelect(name='level_select')
+    elif level_select == 'heuristic':
+        level_select_layer = HeuristicLevelSelect(name='level_select')
+    else:
+        raise ValueError('Level select (\'{}\') is invalid.'.format(level_select))
+    # the optional 4th input holds the levels cached by the generator
+    batch_gt_box_levels = level_select_layer(
+        [batch_cls_pred, batch_regr_pred, feature_shapes_input, gt_boxes_input] + inputs[3:4])
+    if sparse_targets:
+        batch_cls_labels, batch_regr_target = FSAFTarget(
+            num_classes=num_classes,
+            sparse=True,
+            name='fsaf_target')(
+            [batch_gt_box_levels, feature_shapes_input, gt_boxes_input])
+        cls_loss, regr_loss = __build_sparse_losses(batch_cls_labels, batch_regr_target, batch_cls_pred,
+                                                    batch_regr_pred)
+        return keras.models.Model(inputs=inputs,
+                                  outputs=[cls_loss, regr_loss, batch_cls_pred, batch_regr_pred],
+                                  name=name)
     batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask = FSAFTarget(
         num_classes=num_classes,
         name='fsaf_target')(
@@ -564,10 +615,76 @@ def fsaf(
                               name=name)
 
 
+def fsaf_with_targets(
+        inputs,
+        backbone_layers,
+        num_classes,
+        create_pyramid_features=__create_pyramid_features,
+        sparse_targets=False,
+        name='fsaf'
+):
+    """
+    Construct a FSAF model on top of a backbone which takes the fsaf targets as inputs.
+
+    The targets are computed outside of the graph (see utils.fsaf.compute_batch_fsaf_targets), so this model has no
+    LevelSelect and FSAFTarget layers. The layer names are the same as in fsaf, so both models share snapshots.
+
+    Args
+        inputs: List of keras.layers.Input for [image, cls_target, cls_mask, cls_num_pos, regr_target, regr_mask],
+            or [image, cls_labels, regr_target] if sparse_targets.
+        backbone_layers: The features C3, C4, C5 from the backbone.
+        num_classes: Number of classes to classify.
+        create_pyramid_features : Functor for creating pyramid features given the features C3, C4, C5 from the backbone.
+        sparse_targets: If True, the targets are the class label of every location and the dense regression targets.
+        name: Name of the model.
+
+    Returns
+        A keras.models.Model with the same outputs as fsaf:
+        ```
+        [
+            cls_loss, regr_loss, classification, regression
+        ]
+        ```
+    """
+    submodels = default_fsaf_submodels(num_classes)
+
+    C3, C4, C5 = backbone_layers
+
+    # compute pyramid features as per https://arxiv.org/abs/1708.02002
+    # [P3, P4, P5, P6, P7]
+    features = create_pyramid_features(C3, C4, C5)
+    # for all pyramid levels, run available submodels
+    # [(b, sum(fh*fw), 4), (b, sum(fh*fw), num_classes)]
+    batch_regr_pred, batch_cls_pred = __build_fsaf_pyramid(submodels, features)
+    if sparse_targets:
+        batch_cls_labels, batch_regr_target = inputs[1:]
+        cls_loss, regr_loss = __build_sparse_losses(batch_cls_labels, batch_regr_target, batch_cls_pred,
+                                                    batch_regr_pred)
+        return keras.models.Model(inputs=inputs,
+                                  outputs=[cls_loss, regr_loss, batch_cls_pred, batch_regr_pred],
+                                  name=name)
+    batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask = inputs[1:]
+    focal_loss_graph = focal_with_mask()
+    iou_loss_graph = iou_with_mask()
+    cls_loss = keras.layers.Lambda(focal_loss_graph,
+                                   output_shape=(1,),
+                                   name="cls_loss")(
+        [batch_cls_target, batch_cls_pred, batch_cls_mask, batch_cls_num_pos])
+    regr_loss = keras.layers.Lambda(iou_loss_graph,
+                                    output_shape=(1,),
+                                    name="regr_loss")([batch_regr_target, batch_regr_pred, batch_regr_mask])
+    return keras.models.Model(inputs=inputs,
+                              outputs=[cls_loss, regr_loss, batch_cls_pred, batch_regr_pred],
+                              name=name)
+
+
 def fsaf_bbox(
         model=None,
         nms=True,
         class_specific_filter=True,
+        pre_nms_top_k=1000,
+        fused_postprocess=True,
+        image_shapes=None,
         name='fsaf-bbox',
 ):
     """
@@ -580,6 +697,11 @@ def fsaf_bbox(
         model: RetinaNet model to append bbox layers to. If None, it will create a RetinaNet model using **kwargs.
         nms: Whether to use non-maximum suppression for the filtering step.
         class_specific_filter: Whether to use class specific filtering or filter for the best scoring class only.
+        pre_nms_top_k: Number of best scoring locations of every pyramid level to keep before NMS, None keeps all.
+        fused_postprocess: If True and pre_nms_top_k is given, select the top-k locations first and only compute the
+            boxes of those (see layers.TopKRegressBoxes).
+        image_shapes: Optional list of known (height, width) of the input images, the locations of those shapes are
+            precomputed instead of being rebuilt on every forward pass, e.g. the shapes of utils.buckets.ShapeBuckets.
         name: Name of the model.
 
     Returns
@@ -602,11 +724,28 @@ def fsaf_bbox(
     classification = model.outputs[2]
     # (b, sum(fh*fw), 4)
     regression = model.outputs[3]
-    locations, strides = Locations(strides=configure.STRIDES)(features)
 
-    # apply predicted regression to anchors
-    boxes = RegressBoxes(name='boxes')([locations, strides, regression])
-    boxes = layers.ClipBoxes(name='clipped_boxes')([model.inputs[0], boxes])
+    feature_shapes = None
+    if image_shapes is not None:
+        feature_shapes = [[[int(size) for size in shape] for shape in guess_shapes(image_shape, range(3, 8))]
+                          for image_shape in image_shapes]
+
+    if pre_nms_top_k is not None and fused_postprocess:
+        # bound the number of candidates of every level and only compute their boxes
+        boxes, classification = layers.TopKRegressBoxes(strides=configure.STRIDES, k=pre_nms_top_k,
+                                                        feature_shapes=feature_shapes, name='top_k_boxes')(
+            [model.inputs[0], regression, classification] + features)
+    else:
+        locations, strides = Locations(strides=configure.STRIDES, feature_shapes=feature_shapes)(features)
+
+        # apply predicted regression to anchors
+        boxes = RegressBoxes(name='boxes')([locations, strides, regression])
+        boxes = layers.ClipBoxes(name='clipped_boxes')([model.inputs[0], boxes])
+
+        # bound the number of candidates of every level
+        if pre_nms_top_k is not None:
+            boxes, classification = layers.LevelTopK(k=pre_nms_top_k, name='level_top_k')(
+                [boxes, classification] + features)
 
     # filter detections (apply NMS / score threshold / select top-k)
     detections = layers.FilterDetections(
@@ -617,3 +756,94 @@ def fsaf_bbox(
 
     # construct the model
     return keras.models.Model(inputs=model.inputs[0], outputs=detections, name=name)
+
+
+def fsaf_raw(model, name='fsaf-raw'):
+    """
+    Construct a model which outputs the raw regression and classification of a fsaf training model, the boxes are
+    decoded and filtered on the host (see utils.postprocess.HostPostprocessor).
+
+    Args
+        model: fsaf training model.
+        name: Name of the model.
+
+    Returns
+        A keras.models.Model which takes an image as input and outputs
+        [regression (b, sum(fh*fw), 4), classification (b, sum(fh*fw), num_classes)].
+    """
+    assert_training_model(model)
+    return keras.models.Model(inputs=model.inputs[0], outputs=[model.outputs[3], model.outputs[2]], name=name)
+
+
+def fsaf_multi_head_bbox(
+        inputs,
+        backbone_layers,
+        heads,
+        create_pyramid_features=__create_pyramid_features,
+        nms=True,
+        class_specific_filter=True,
+        pre_nms_top_k=1000,
+        name='fsaf-multi-head-bbox',
+):
+    """
+    Construct an inference model running several fsaf heads on the features of one backbone and one pyramid.
+
+    The backbone and the pyramid run once per image whatever the number of heads, every head has its own submodels,
+    named '<head>_fsaf_regression_model' and '<head>_fsaf_classification_model', and its own FilterDetections layer,
+    named '<head>_filtered_detections'. The backbone and pyramid layers have the same names as in fsaf, so their
+    weights load by name from any snapshot (see utils.inference.load_multi_head_model).
+
+    Args
+        inputs: The image input of the backbone.
+        backbone_layers: The features C3, C4, C5 from the backbone.
+        heads: List of (head name, number of classes).
+        create_pyramid_features : Functor for creating pyramid features given the features C3, C4, C5 from the backbone.
+        nms: Whether to use non-maximum suppression for the filtering step.
+        class_specific_filter: Whether to use class specific filtering or filter for the best scoring class only.
+        pre_nms_top_k: Number of best scoring locations of every pyramid level to keep before NMS, None keeps all.
+        name: Name of the model.
+
+    Returns
+        A keras.models.Model which takes an image as input and outputs the detections of every head:
+        ```
+        [
+            head[0] boxes, head[0] scores, head[0] labels, head[1] boxes, ...
+        ]
+        ```
+    """
+    C3, C4, C5 = backbone_layers
+
+    # [P3, P4, P5, P6, P7]
+    features = create_pyramid_features(C3, C4, C5)
+
+    locations = strides = None
+    if pre_nms_top_k is None:
+        # the locations only depend on the features, so all heads share them
+        locations, strides = Locations(strides=configure.STRIDES)(features)
+
+    outputs = []
+    for head_name, num_classes in heads:
+        submodels = [
+            ('{}_fsaf_regression'.format(head_name),
+             default_fsaf_regression_model(4, name='{}_fsaf_regression_model'.format(head_name))),
+            ('{}_fsaf_classification'.format(head_name),
+             default_fsaf_classification_model(num_classes, name='{}_fsaf_classification_model'.format(head_name)))
+        ]
+        # [(b, sum(fh*fw), 4), (b, sum(fh*fw), num_classes)]
+        regression, classification = __build_fsaf_pyramid(submodels, features)
+
+        if pre_nms_top_k is not None:
+            boxes, classification = layers.TopKRegressBoxes(strides=configure.STRIDES, k=pre_nms_top_k,
+                                                            name='{}_top_k_boxes'.format(head_name))(
+                [inputs, regression, classification] + features)
+        else:
+            boxes = RegressBoxes(name='{}_boxes'.format(head_name))([locations, strides, regression])
+            boxes = layers.ClipBoxes(name='{}_clipped_boxes'.format(head_name))([inputs, boxes])
+
+        outputs += layers.FilterDetections(
+            nms=nms,
+            class_specific_filter=class_specific_filter,
+            name='{}_filtered_detections'.format(head_name)
+        )([boxes, classification])
+
+    return keras.models.Model(inputs=inputs, outputs=outputs, name=name)
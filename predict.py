@@ -0,0 +1,320 @@
+"""
+Run a fsaf model over a list of images and write the detections to a file.
+
+Example:
+    python3 predict.py snapshots/resnet50_pascal.h5 datasets/images --num-classes 20 --output detections.jsonl
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+import models
+from utils.image import read_image_bgr
+from utils.buckets import ShapeBuckets
+from utils.inference import list_images, image_aspect_ratio, group_by_aspect_ratio, load_inference_model, \
+    load_image, pad_images, predict_images, unpack_detections
+from utils.keras_version import check_keras_version
+from utils.postprocess import HostPostprocessor
+from utils.predictor import SessionPredictor
+from utils.profiling import LatencyRecorder
+from utils.tiling import detect_tiled
+
+
+def get_session():
+    """
+    Construct a modified tf session.
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    return tf.Session(config=config)
+
+
+class JSONLWriter(object):
+    """
+    Write the detections of every image as one json line.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write(self, image_path, boxes, scores, labels):
+        self.file.write(json.dumps({
+            'image_path': image_path,
+            'boxes': np.round(boxes, 2).tolist(),
+            'scores': np.round(scores, 4).tolist(),
+            'labels': labels.tolist(),
+        }) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class NPZWriter(object):
+    """
+    Write the detections of all images as flat columns of a .npz file, image_indices maps every detection to its
+    image in image_paths.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.image_paths = []
+        self.columns = collections.defaultdict(list)
+
+    def write(self, image_path, boxes, scores, labels):
+        self.columns['image_indices'].append(np.full((boxes.shape[0],), len(self.image_paths), dtype=np.int32))
+        self.columns['boxes'].append(boxes.astype(np.float32).reshape(-1, 4))
+        self.columns['scores'].append(scores.astype(np.float32))
+        self.columns['labels'].append(labels.astype(np.int32))
+        self.image_paths.append(image_path)
+
+    def close(self):
+        columns = {
+            'image_indices': np.zeros((0,), dtype=np.int32),
+            'boxes': np.zeros((0, 4), dtype=np.float32),
+            'scores': np.zeros((0,), dtype=np.float32),
+            'labels': np.zeros((0,), dtype=np.int32),
+        }
+        columns.update({name: np.concatenate(column, axis=0) for name, column in self.columns.items()})
+        np.savez(self.path, image_paths=np.array(self.image_paths), **columns)
+
+
+def create_writer(path):
+    if path.endswith('.npz'):
+        return NPZWriter(path)
+    return JSONLWriter(path)
+
+
+def run(model, image_paths, writer, preprocess_image, args, recorder, buckets=None):
+    """
+    Run the model over the images, the images of the next batches are loaded in a thread pool while the current
+    batch runs. If the model is a utils.postprocess.HostPostprocessor, the detections of a batch are written after
+    the next batch is submitted, so its postprocessing overlaps with the next forward pass.
+
+    Returns
+        The number of images per second.
+    """
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        aspect_ratios = list(executor.map(image_aspect_ratio, image_paths))
+        groups = group_by_aspect_ratio(aspect_ratios, args.batch_size)
+
+        def submit(group):
+            return [executor.submit(load_image, image_paths[i], preprocess_image, args.image_min_side,
+                                    args.image_max_side, recorder) for i in group]
+
+        num_images = [0]
+        start = time.time()
+
+        def finish(group_index, group, scales, outputs):
+            with recorder.stage('postprocess'):
+                if isinstance(model, HostPostprocessor):
+                    outputs = outputs.result()
+                boxes, scores, labels = outputs[:3]
+                detections = unpack_detections(boxes, scores, labels, scales, score_threshold=args.score_threshold)
+            with recorder.stage('serialize'):
+                for image_index, (image_boxes, image_scores, image_labels) in zip(group, detections):
+                    writer.write(image_paths[image_index], image_boxes, image_scores, image_labels)
+
+            num_images[0] += len(group)
+            if (group_index + 1) % args.log_interval == 0 or group_index + 1 == len(groups):
+                print('{}/{} images, {:.2f} images/s'.format(num_images[0], len(image_paths),
+                                                             num_images[0] / (time.time() - start)))
+
+        pending = collections.deque()
+        # the batch whose detections are written after the next batch is submitted
+        previous = None
+        for group_index, group in enumerate(groups):
+            # keep args.prefetch batches loading ahead of the model
+            while len(pending) <= args.prefetch and group_index + len(pending) < len(groups):
+                pending.append(submit(groups[group_index + len(pending)]))
+            image_group, scales = zip(*[future.result() for future in pending.popleft()])
+
+            with recorder.stage('forward'):
+                if isinstance(model, HostPostprocessor):
+                    outputs = model.submit(pad_images(image_group, buckets=buckets))
+                else:
+                    outputs = predict_images(model, image_group, buckets=buckets)
+
+            if previous is not None:
+                finish(*previous)
+            previous = (group_index, group, scales, outputs)
+        if previous is not None:
+            finish(*previous)
+    return num_images[0] / max(time.time() - start, 1e-6)
+
+
+def run_tiled(model, image_paths, writer, preprocess_image, args, recorder):
+    """
+    Run the model over overlapping tiles of the images at full resolution, the next images are read in a thread pool
+    while the current image runs.
+
+    Returns
+        The number of images per second.
+    """
+    def read_image(path):
+        with recorder.stage('decode'):
+            return read_image_bgr(path)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        pending = collections.deque()
+        start = time.time()
+        for image_index, image_path in enumerate(image_paths):
+            while len(pending) <= args.prefetch and image_index + len(pending) < len(image_paths):
+                pending.append(executor.submit(read_image, image_paths[image_index + len(pending)]))
+            image = pending.popleft().result()
+
+            boxes, scores, labels = detect_tiled(
+                model,
+                image,
+                preprocess_image,
+                tile_size=args.tile_size,
+                overlap=args.tile_overlap,
+                batch_size=args.batch_size,
+                score_threshold=args.score_threshold,
+                nms_threshold=args.nms_threshold,
+                recorder=recorder,
+            )
+            with recorder.stage('serialize'):
+                writer.write(image_path, boxes, scores, labels)
+
+            if (image_index + 1) % args.log_interval == 0 or image_index + 1 == len(image_paths):
+                print('{}/{} images, {:.2f} images/s'.format(image_index + 1, len(image_paths),
+                                                             (image_index + 1) / (time.time() - start)))
+    return len(image_paths) / max(time.time() - start, 1e-6)
+
+
+def check_args(parsed_args):
+    """
+    Check for contradictions within the parsed arguments before the model is loaded.
+
+    Args
+        parsed_args: parser.parse_args()
+
+    Returns
+        parsed_args
+    """
+    if parsed_args.tile_size and not 0 <= parsed_args.tile_overlap < parsed_args.tile_size:
+        raise ValueError('The tile overlap ({}) must be non negative and smaller than the tile size ({}).'.format(
+            parsed_args.tile_overlap, parsed_args.tile_size))
+
+    return parsed_args
+
+
+def parse_args(args):
+    """
+    Parse the arguments.
+    """
+    parser = argparse.ArgumentParser(description='Bulk inference script for a fsaf network.')
+    parser.add_argument('snapshot', help='Snapshot of the model.')
+    parser.add_argument('inputs', nargs='+',
+                        help='Images, directories of images or text files with one image path per line.')
+    parser.add_argument('--output', help='Output file, .jsonl or .npz (columnar).', default='detections.jsonl')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes',
+                        help='Number of classes, build the model and load the snapshot weights by name if given.',
+                        type=int)
+    parser.add_argument('--convert-model',
+                        help='Convert the model to an inference model (ie. the input is a training model).',
+                        action='store_true')
+    parser.add_argument('--gpu', help='Id of the GPU to use (as reported by nvidia-smi), -1 runs on CPU.')
+    parser.add_argument('--batch-size', help='Size of the batches.', default=8, type=int)
+    parser.add_argument('--workers', help='Number of threads decoding and resizing the images.', default=4, type=int)
+    parser.add_argument('--prefetch', help='Number of batches loaded ahead of the model.', default=2, type=int)
+    parser.add_argument('--score-threshold', help='Threshold on score to filter detections with (defaults to 0.05).',
+                        default=0.05, type=float)
+    parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
+                        default=800)
+    parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
+                        type=int, default=1333)
+    parser.add_argument('--session-callable',
+                        help='Run the model through a session callable instead of predict_on_batch.',
+                        action='store_true')
+    parser.add_argument('--host-postprocess',
+                        help='Stop the graph at the regression and classification and postprocess them with NumPy '
+                             'while the next batch runs (requires --num-classes or a training snapshot).',
+                        action='store_true')
+    parser.add_argument('--shape-buckets',
+                        help='Pad the batches to a few fixed shapes, which are run once when the model is loaded.',
+                        action='store_true')
+    parser.add_argument('--bucket-multiple', help='The sides of the shape buckets are multiples of this.',
+                        default=128, type=int)
+    parser.add_argument('--tile-size',
+                        help='Run on overlapping square tiles of this size at full resolution instead of resizing the '
+                             'images, the batches are made of the tiles of one image.', type=int)
+    parser.add_argument('--tile-overlap', help='Number of pixels shared by two neighbouring tiles.', default=128,
+                        type=int)
+    parser.add_argument('--nms-threshold', help='Threshold of the NMS merging the detections of the tiles.',
+                        default=0.5, type=float)
+    parser.add_argument('--latency-report', help='Write the latency percentiles of every stage to this json file.')
+    parser.add_argument('--log-interval', help='Number of batches between two throughput reports.', default=10,
+                        type=int)
+
+    return check_args(parser.parse_args(args))
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # make sure keras is the minimum required version
+    check_keras_version()
+
+    # optionally choose specific GPU
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    keras.backend.tensorflow_backend.set_session(get_session())
+
+    image_paths = list_images(args.inputs)
+    print('Found {} images.'.format(len(image_paths)))
+
+    buckets = None
+    if args.shape_buckets and not args.tile_size:
+        buckets = ShapeBuckets(multiple=args.bucket_multiple, min_side=args.image_min_side,
+                               max_side=args.image_max_side)
+
+    print('Loading model, this may take a second...')
+    # the locations of the bucket shapes are precomputed in the model
+    model = load_inference_model(args.snapshot, backbone_name=args.backbone, num_classes=args.num_classes,
+                                 convert_model=args.convert_model, raw=args.host_postprocess,
+                                 image_shapes=buckets.buckets if buckets is not None else None)
+    if args.session_callable:
+        model = SessionPredictor(model)
+    if args.host_postprocess:
+        model = HostPostprocessor(model, score_threshold=args.score_threshold, nms_threshold=args.nms_threshold)
+
+    if buckets is not None:
+        for bucket, seconds in buckets.warmup(model, batch_size=args.batch_size).items():
+            print('Warmed up bucket {}x{} in {:.2f}s.'.format(bucket[0], bucket[1], seconds))
+
+    recorder = LatencyRecorder()
+    writer = create_writer(args.output)
+    try:
+        if args.tile_size:
+            images_per_second = run_tiled(model, image_paths, writer,
+                                          models.backbone(args.backbone).preprocess_image, args, recorder)
+        else:
+            images_per_second = run(model, image_paths, writer, models.backbone(args.backbone).preprocess_image, args,
+                                    recorder, buckets=buckets)
+    finally:
+        writer.close()
+    print(recorder.format())
+    if args.latency_report:
+        recorder.dump(args.latency_report)
+    if buckets is not None:
+        print('Shape buckets: {}'.format(json.dumps(buckets.report())))
+    print('Wrote the detections of {} images to {} ({:.2f} images/s).'.format(len(image_paths), args.output,
+                                                                             images_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Run a fsaf model over the frames of a video and write the detections of every frame as json lines.
+
+Example:
+    python3 predict_video.py snapshots/resnet50_pascal.h5 camera.mp4 --num-classes 20 --adaptive-stride
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+import models
+from utils.inference import load_inference_model
+from utils.keras_version import check_keras_version
+from utils.video import VideoDetector
+
+
+def get_session():
+    """
+    Construct a modified tf session.
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    return tf.Session(config=config)
+
+
+def parse_args(args):
+    """
+    Parse the arguments.
+    """
+    parser = argparse.ArgumentParser(description='Video inference script for a fsaf network.')
+    parser.add_argument('snapshot', help='Snapshot of the model.')
+    parser.add_argument('video_path', help='Video file readable by OpenCV.')
+    parser.add_argument('--output', help='Output .jsonl file.', default='detections.jsonl')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes',
+                        help='Number of classes, build the model and load the snapshot weights by name if given.',
+                        type=int)
+    parser.add_argument('--convert-model',
+                        help='Convert the model to an inference model (ie. the input is a training model).',
+                        action='store_true')
+    parser.add_argument('--gpu', help='Id of the GPU to use (as reported by nvidia-smi), -1 runs on CPU.')
+    parser.add_argument('--batch-size', help='Number of frames of a batch.', default=4, type=int)
+    parser.add_argument('--queue-size', help='Maximum number of decoded frames waiting for the model.', default=16,
+                        type=int)
+    parser.add_argument('--adaptive-stride', help='Skip frames when the model falls behind the decoding.',
+                        action='store_true')
+    parser.add_argument('--max-stride', help='Maximum frame stride of --adaptive-stride.', default=8, type=int)
+    parser.add_argument('--static-threshold',
+                        help='Reuse the detections of the previous frame if the mean pixel change, in [0, 1], is '
+                             'below this threshold.', type=float)
+    parser.add_argument('--score-threshold', help='Threshold on score to filter detections with (defaults to 0.05).',
+                        default=0.05, type=float)
+    parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
+                        default=800)
+    parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
+                        type=int, default=1333)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # make sure keras is the minimum required version
+    check_keras_version()
+
+    # optionally choose specific GPU
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    keras.backend.tensorflow_backend.set_session(get_session())
+
+    print('Loading model, this may take a second...')
+    model = load_inference_model(args.snapshot, backbone_name=args.backbone, num_classes=args.num_classes,
+                                 convert_model=args.convert_model)
+    detector = VideoDetector(
+        model,
+        models.backbone(args.backbone).preprocess_image,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+        min_side=args.image_min_side,
+        max_side=args.image_max_side,
+        score_threshold=args.score_threshold,
+        adaptive_stride=args.adaptive_stride,
+        max_stride=args.max_stride,
+        static_threshold=args.static_threshold,
+    )
+
+    with open(args.output, 'w') as f:
+        for frame_index, (boxes, scores, labels), static in detector.detect(args.video_path):
+            f.write(json.dumps({
+                'frame_index': frame_index,
+                'static': static,
+                'boxes': np.round(boxes, 2).tolist(),
+                'scores': np.round(scores, 4).tolist(),
+                'labels': labels.tolist(),
+            }) + '\n')
+    print('{num_frames} frames, {num_skipped} skipped, {num_static} static, {fps:.2f} frames/s'.format(
+        **detector.stats))
+
+
+if __name__ == '__main__':
+    main()
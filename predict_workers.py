@@ -0,0 +1,160 @@
+"""
+Run a fsaf model over a list of images with several inference workers which share one copy of the weights.
+
+The snapshot is loaded once into one graph and one session, every worker is a thread running its own session callable
+(see utils.predictor.SessionPredictor) on that graph, so the weights exist once whatever the number of workers. The
+session runs release the GIL, so the forward passes of the workers run concurrently. The images are split between the
+workers, each writes its own output file, and the throughput of every worker and the resident memory of the process
+are reported.
+
+Example:
+    python3 predict_workers.py snapshots/resnet101_pascal.h5 datasets/images --backbone resnet101 --num-classes 20 \
+        --threads 4 --output detections.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import keras
+import tensorflow as tf
+
+import models
+from predict import create_writer, run
+from utils.inference import list_images, load_inference_model
+from utils.predictor import SessionPredictor
+from utils.profiling import LatencyRecorder, memory_usage
+
+
+def get_session():
+    """
+    Construct a modified tf session.
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    return tf.Session(config=config)
+
+
+def worker_output(output, worker_index):
+    root, ext = os.path.splitext(output)
+    return '{}.{}{}'.format(root, worker_index, ext)
+
+
+def run_worker(worker_index, predictor, graph, image_paths, args, reports):
+    """
+    Run a worker over its images and append its throughput to the reports.
+    """
+    output = worker_output(args.output, worker_index)
+    writer = create_writer(output)
+    recorder = LatencyRecorder()
+    try:
+        with graph.as_default():
+            images_per_second = run(predictor, image_paths, writer, models.backbone(args.backbone).preprocess_image,
+                                    args, recorder)
+    finally:
+        writer.close()
+    reports.append({
+        'worker': worker_index,
+        'output': output,
+        'num_images': len(image_paths),
+        'images_per_second': images_per_second,
+        'forward': recorder.summary().get('forward'),
+    })
+
+
+def format_report(reports, memory):
+    """
+    Returns
+        The throughput of every worker and the memory usage of the process as text, in MiB.
+    """
+    lines = ['{:>6} {:>8} {:>10}'.format('worker', 'images', 'images/s')]
+    for report in reports:
+        lines.append('{:>6d} {:>8d} {:>10.2f}'.format(report['worker'], report['num_images'],
+                                                       report['images_per_second']))
+    lines.append('rss: {:.1f} MiB before loading, {:.1f} MiB after loading, {:.1f} MiB at the end'.format(
+        memory['baseline']['rss'] / 2. ** 20, memory['loaded']['rss'] / 2. ** 20, memory['final']['rss'] / 2. ** 20))
+    return '\n'.join(lines)
+
+
+def parse_args(args):
+    """
+    Parse the arguments.
+    """
+    parser = argparse.ArgumentParser(description='Multi-threaded inference script for a fsaf network.')
+    parser.add_argument('snapshot', help='Snapshot of the model.')
+    parser.add_argument('inputs', nargs='+',
+                        help='Images, directories of images or text files with one image path per line.')
+    parser.add_argument('--num-classes', help='Number of classes of the model.', type=int, required=True)
+    parser.add_argument('--output',
+                        help='Output file, .jsonl or .npz (columnar), the index of the worker is added to its name.',
+                        default='detections.jsonl')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--threads', help='Number of inference workers sharing the model.', default=2, type=int)
+    parser.add_argument('--gpu', help='Id of the GPU to use (as reported by nvidia-smi), -1 runs on CPU.')
+    parser.add_argument('--batch-size', help='Size of the batches.', default=8, type=int)
+    parser.add_argument('--workers', help='Number of threads decoding and resizing the images of every worker.',
+                        default=2, type=int)
+    parser.add_argument('--prefetch', help='Number of batches loaded ahead of the model.', default=2, type=int)
+    parser.add_argument('--score-threshold', help='Threshold on score to filter detections with (defaults to 0.05).',
+                        default=0.05, type=float)
+    parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
+                        default=800)
+    parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
+                        type=int, default=1333)
+    parser.add_argument('--memory-report', help='Write the throughput of every worker and the memory usage to this '
+                                                'json file.')
+    parser.add_argument('--log-interval', help='Number of batches between two throughput reports.', default=10,
+                        type=int)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    keras.backend.tensorflow_backend.set_session(get_session())
+
+    image_paths = list_images(args.inputs)
+    print('Found {} images.'.format(len(image_paths)))
+
+    baseline = memory_usage()
+    model = load_inference_model(args.snapshot, backbone_name=args.backbone, num_classes=args.num_classes)
+    loaded = memory_usage()
+    graph = tf.get_default_graph()
+
+    # one callable per worker on the shared session, so every worker has its own input buffers
+    start = time.time()
+    reports = []
+    threads = [
+        threading.Thread(target=run_worker, args=(worker_index, SessionPredictor(model), graph,
+                                                  image_paths[worker_index::args.threads], args, reports))
+        for worker_index in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(reports) < len(threads):
+        raise RuntimeError('Workers {} failed.'.format(sorted(set(range(args.threads)) -
+                                                              {report['worker'] for report in reports})))
+
+    reports.sort(key=lambda report: report['worker'])
+    memory = {'baseline': baseline, 'loaded': loaded, 'final': memory_usage()}
+    print(format_report(reports, memory))
+    if args.memory_report:
+        with open(args.memory_report, 'w') as f:
+            json.dump({'workers': reports, 'memory': memory}, f, indent=2)
+    print('Wrote the detections of {} images to {} files ({:.2f} images/s).'.format(
+        len(image_paths), len(reports), len(image_paths) / max(time.time() - start, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
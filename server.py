@@ -0,0 +1,241 @@
+"""
+Serve a fsaf model over HTTP, concurrent requests are run in batches.
+
+    POST /detect with the encoded image as body returns the detections as json.
+    GET /metrics returns the queue depth and the latencies as json.
+
+Example:
+    python3 server.py snapshots/resnet50_pascal.h5 --num-classes 20 --port 8080
+    curl --data-binary @test/004456.jpg http://localhost:8080/detect
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+import models
+from utils.batching import DynamicBatcher, ImageDecodeError
+from utils.buckets import ShapeBuckets, ladder_buckets
+from utils.inference import load_inference_model
+from utils.keras_version import check_keras_version
+from utils.predictor import SessionPredictor
+from utils.resolution import ResolutionLadder, make_rungs
+from utils.result_cache import DetectionCache, file_identity
+
+
+def get_session():
+    """
+    Construct a modified tf session.
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    return tf.Session(config=config)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, timeout=30.):
+    """
+    Create the request handler class of the server.
+
+    Args
+        batcher: The utils.batching.DynamicBatcher running the model.
+        timeout: The maximum number of seconds to wait for the detections of a request.
+    """
+
+    class DetectionHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, content):
+            self._send_body(status, json.dumps(content).encode('utf-8'))
+
+        def _send_body(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self._send_json(404, {'error': 'not found'})
+                return
+            self._send_json(200, batcher.metrics())
+
+        def do_POST(self):
+            if self.path != '/detect':
+                self._send_json(404, {'error': 'not found'})
+                return
+            image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                future = batcher.submit(image_bytes)
+                boxes, scores, labels = future.result(timeout=timeout)
+            except ImageDecodeError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            except concurrent.futures.TimeoutError:
+                # the request is not run if it is not batched yet
+                future.cancel()
+                self._send_json(504, {'error': 'no detections after {}s'.format(timeout)})
+                return
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                return
+            with batcher.recorder.stage('serialize'):
+                content = {
+                    'boxes': np.round(boxes, 2).tolist(),
+                    'scores': np.round(scores, 4).tolist(),
+                    'labels': labels.tolist(),
+                }
+                # the (min_side, max_side) the image was run at, unless the detections were cached
+                if hasattr(future, 'resolution'):
+                    content['resolution'] = list(future.resolution)
+                body = json.dumps(content).encode('utf-8')
+            self._send_body(200, body)
+
+        def log_message(self, format, *args):
+            # the metrics endpoint replaces the per request logs
+            pass
+
+    return DetectionHandler
+
+
+def parse_args(args):
+    """
+    Parse the arguments.
+    """
+    parser = argparse.ArgumentParser(description='Serve a fsaf network over HTTP.')
+    parser.add_argument('snapshot', help='Snapshot of the model.')
+    parser.add_argument('--backbone', help='The backbone of the model.', default='resnet50')
+    parser.add_argument('--num-classes',
+                        help='Number of classes, build the model and load the snapshot weights by name if given.',
+                        type=int)
+    parser.add_argument('--convert-model',
+                        help='Convert the model to an inference model (ie. the input is a training model).',
+                        action='store_true')
+    parser.add_argument('--gpu', help='Id of the GPU to use (as reported by nvidia-smi), -1 runs on CPU.')
+    parser.add_argument('--host', help='Address to listen on.', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on.', default=8080, type=int)
+    parser.add_argument('--max-batch-size', help='The maximum number of images of a batch.', default=8, type=int)
+    parser.add_argument('--max-wait-ms', help='The maximum time the first image of a batch waits for more images.',
+                        default=10., type=float)
+    parser.add_argument('--workers', help='Number of threads decoding and resizing the images.', default=4, type=int)
+    parser.add_argument('--session-callable',
+                        help='Run the model through a session callable instead of predict_on_batch.',
+                        action='store_true')
+    parser.add_argument('--shape-buckets',
+                        help='Pad the batches to a few fixed shapes, which are run once when the model is loaded.',
+                        action='store_true')
+    parser.add_argument('--bucket-multiple', help='The sides of the shape buckets are multiples of this.',
+                        default=128, type=int)
+    parser.add_argument('--cache-size', help='Number of detections cached in memory, 0 disables the cache.',
+                        default=0, type=int)
+    parser.add_argument('--cache-dir', help='Directory of the on-disk tier of the detection cache.')
+    parser.add_argument('--cache-max-bytes', help='Maximum size of the on-disk tier of the detection cache.',
+                        default=1 << 30, type=int)
+    parser.add_argument('--deadline-ms',
+                        help='Latency target of a request, lower the resolution of the images along the ladder of '
+                             '--ladder-min-sides when the batches fall behind it.', type=float)
+    parser.add_argument('--ladder-min-sides', help='Min sides of the resolution ladder, the max sides keep the ratio '
+                                                   'of --image-max-side to --image-min-side.',
+                        type=int, nargs='+', default=[800, 640, 512])
+    parser.add_argument('--score-threshold', help='Threshold on score to filter detections with (defaults to 0.05).',
+                        default=0.05, type=float)
+    parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
+                        default=800)
+    parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
+                        type=int, default=1333)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # make sure keras is the minimum required version
+    check_keras_version()
+
+    # optionally choose specific GPU
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    keras.backend.tensorflow_backend.set_session(get_session())
+
+    # the identity of the weights the model is loaded from, the detection cache keys on it
+    identity = file_identity(args.snapshot) if args.cache_size > 0 else None
+    ladder = None
+    if args.deadline_ms:
+        ladder = ResolutionLadder(args.deadline_ms / 1000.,
+                                  rungs=make_rungs(args.ladder_min_sides, min_side=args.image_min_side,
+                                                   max_side=args.image_max_side))
+    buckets = None
+    if args.shape_buckets:
+        if ladder is not None:
+            # cover every rung, the images of the lower rungs are not padded back up to the full resolution
+            buckets = ShapeBuckets(buckets=ladder_buckets(ladder.rungs, multiple=args.bucket_multiple),
+                                   multiple=args.bucket_multiple)
+        else:
+            buckets = ShapeBuckets(multiple=args.bucket_multiple, min_side=args.image_min_side,
+                                   max_side=args.image_max_side)
+
+    print('Loading model, this may take a second...')
+    # the locations of the bucket shapes are precomputed in the model
+    model = load_inference_model(args.snapshot, backbone_name=args.backbone, num_classes=args.num_classes,
+                                 convert_model=args.convert_model,
+                                 image_shapes=buckets.buckets if buckets is not None else None)
+    max_detections = model.get_layer('filtered_detections').max_detections
+    if args.session_callable:
+        model = SessionPredictor(model)
+    if buckets is not None:
+        # the batches have any size up to max_batch_size, warm up the largest one
+        for bucket, seconds in buckets.warmup(model, batch_size=args.max_batch_size).items():
+            print('Warmed up bucket {}x{} in {:.2f}s.'.format(bucket[0], bucket[1], seconds))
+    cache = None
+    if args.cache_size > 0:
+        cache = DetectionCache(
+            identity,
+            snapshot=args.snapshot,
+            score_threshold=args.score_threshold,
+            max_detections=max_detections,
+            capacity=args.cache_size,
+            cache_dir=args.cache_dir,
+            max_disk_bytes=args.cache_max_bytes,
+        )
+    batcher = DynamicBatcher(
+        model,
+        models.backbone(args.backbone).preprocess_image,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000.,
+        workers=args.workers,
+        min_side=args.image_min_side,
+        max_side=args.image_max_side,
+        score_threshold=args.score_threshold,
+        buckets=buckets,
+        cache=cache,
+        ladder=ladder,
+    ).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Parity of build_batch_fsaf_target, which builds the fsaf targets of a whole batch at once, with the per image
+build_fsaf_target it replaced, for the retinanet (fsaf_layers) and the yolo (yolo.fsaf_layers) copies.
+"""
+
+import keras.backend as K
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import fsaf_layers
+import yolo.fsaf_layers
+
+NUM_CLASSES = 7
+IMAGE_SHAPE = (320, 416)
+
+
+@pytest.fixture(params=[fsaf_layers, yolo.fsaf_layers], ids=['retinanet', 'yolo'])
+def module(request):
+    return request.param
+
+
+def make_feature_shapes(strides, image_shape=IMAGE_SHAPE):
+    return np.array([((image_shape[0] + stride - 1) // stride, (image_shape[1] + stride - 1) // stride)
+                     for stride in strides], dtype=np.int32)
+
+
+def make_batch(boxes_group, labels_group, levels_group, max_num_gt_boxes=20):
+    """
+    Pack the boxes of every image at the front of a zero padded (B, max_num_gt_boxes, 5) batch, like the generator.
+    """
+    batch_gt_boxes = np.zeros((len(boxes_group), max_num_gt_boxes, 5), dtype=np.float32)
+    batch_gt_box_levels = -np.ones((len(boxes_group), max_num_gt_boxes), dtype=np.int64)
+    for image_index, (boxes, labels, levels) in enumerate(zip(boxes_group, labels_group, levels_group)):
+        num_boxes = len(boxes)
+        if num_boxes == 0:
+            continue
+        batch_gt_boxes[image_index, :num_boxes, :4] = boxes
+        batch_gt_boxes[image_index, :num_boxes, 4] = labels
+        batch_gt_box_levels[image_index, :num_boxes] = levels
+    return batch_gt_box_levels, batch_gt_boxes
+
+
+def random_batch(rng, module, batch_size=3, max_num_boxes=12):
+    height, width = IMAGE_SHAPE
+    boxes_group, labels_group, levels_group = [], [], []
+    for _ in range(batch_size):
+        num_boxes = rng.randint(0, max_num_boxes + 1)
+        x1 = rng.uniform(0, width - 20, num_boxes)
+        y1 = rng.uniform(0, height - 20, num_boxes)
+        x2 = np.minimum(x1 + rng.uniform(8, width / 2, num_boxes), width - 1)
+        y2 = np.minimum(y1 + rng.uniform(8, height / 2, num_boxes), height - 1)
+        boxes_group.append(np.stack([x1, y1, x2, y2], axis=1))
+        labels_group.append(rng.randint(0, NUM_CLASSES, num_boxes))
+        levels_group.append(rng.randint(0, len(module.STRIDES), num_boxes))
+    return make_batch(boxes_group, labels_group, levels_group)
+
+
+def build_targets(module, batch_gt_box_levels, batch_gt_boxes):
+    """
+    Returns
+        The batch targets and the per image targets, both as lists of numpy arrays with a batch dimension.
+    """
+    feature_shapes = tf.constant(make_feature_shapes(module.STRIDES))
+    batch_targets = module.build_batch_fsaf_target(
+        tf.constant(batch_gt_box_levels), tf.constant(batch_gt_boxes), feature_shapes, NUM_CLASSES,
+        module.STRIDES, module.POS_SCALE, module.IGNORE_SCALE)
+    image_targets = [
+        module.build_fsaf_target(
+            tf.constant(gt_box_levels), tf.constant(gt_boxes), feature_shapes, NUM_CLASSES,
+            module.STRIDES, module.POS_SCALE, module.IGNORE_SCALE)
+        for gt_box_levels, gt_boxes in zip(batch_gt_box_levels, batch_gt_boxes)
+    ]
+    num_targets = len(batch_targets)
+    values = K.batch_get_value(list(batch_targets) + [target for targets in image_targets for target in targets])
+    image_values = [values[start:start + num_targets] for start in range(num_targets, len(values), num_targets)]
+    return values[:num_targets], [np.stack(targets, axis=0) for targets in zip(*image_values)]
+
+
+def assert_parity(module, batch_gt_box_levels, batch_gt_boxes):
+    batch_targets, image_targets = build_targets(module, batch_gt_box_levels, batch_gt_boxes)
+    names = ['cls_target', 'cls_mask', 'cls_num_pos', 'regr_target', 'regr_mask']
+    for name, batch_target, image_target in zip(names, batch_targets, image_targets):
+        assert batch_target.shape == image_target.shape, name
+        np.testing.assert_allclose(batch_target.astype(np.float32), image_target.astype(np.float32), atol=1e-5,
+                                   err_msg=name)
+    return batch_targets
+
+
+def test_random_batches(module):
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        assert_parity(module, *random_batch(rng, module))
+
+
+def test_padded_and_empty_rows(module):
+    # the second image has no gt boxes, the others are padded to the same length
+    boxes_group = [
+        np.array([[10, 20, 90, 120], [200, 40, 330, 200]], dtype=np.float32),
+        np.zeros((0, 4), dtype=np.float32),
+        np.array([[50, 60, 150, 100]], dtype=np.float32),
+    ]
+    batch_targets = assert_parity(module, *make_batch(boxes_group, [[1, 2], [], [3]], [[0, 1], [], [0]]))
+    cls_target, cls_mask, cls_num_pos, regr_target, regr_mask = batch_targets
+    assert cls_num_pos[1] == 0
+    assert cls_mask[1].all()
+    assert not regr_mask[1].any()
+    assert not cls_target[1].any()
+
+
+def test_all_empty_batch(module):
+    batch_targets = assert_parity(module, *make_batch([np.zeros((0, 4))] * 2, [[], []], [[], []]))
+    assert not batch_targets[2].any()
+
+
+def test_tied_areas(module):
+    # the same box twice with different labels, the first one owns all the positive locations
+    box = [100, 100, 180, 170]
+    batch_targets = assert_parity(module, *make_batch([np.array([box, box], dtype=np.float32)], [[4, 5]], [[0, 0]]))
+    cls_target, _, cls_num_pos, _, regr_mask = batch_targets
+    assert cls_num_pos[0] > 0
+    assert cls_target[0, regr_mask[0], 4].all()
+    assert not cls_target[0, :, 5].any()
+
+
+def test_overlapping_ignore_regions(module):
+    # boxes of the same level whose ignore regions overlap the positive region of the others
+    boxes = np.array([
+        [40, 40, 200, 200],
+        [90, 90, 150, 150],
+        [150, 60, 260, 180],
+        [60, 150, 180, 260],
+    ], dtype=np.float32)
+    batch_targets = assert_parity(module, *make_batch([boxes], [[0, 1, 2, 3]], [[1, 1, 1, 1]]))
+    cls_target, cls_mask, _, _, regr_mask = batch_targets
+    # the positive locations are never ignored and some locations are ignored
+    assert cls_mask[0, regr_mask[0]].all()
+    assert not cls_mask[0].all()
@@ -26,15 +26,19 @@ import losses
 import models
 from callbacks import RedirectModel
 from callbacks import Evaluate
-from models.retinanet import retinanet_bbox, fsaf_bbox
+from callbacks import LevelCacheRefresh
+from models.retinanet import retinanet_bbox, fsaf_bbox, PYRAMID_LAYERS
 from generators.csv_generator import CSVGenerator
 from generators.voc_generator import PascalVocGenerator
 from utils.anchors import make_shapes_callback
+from utils.buckets import ShapeBuckets
 from utils.config import read_config_file, parse_anchor_parameters
 from utils.keras_version import check_keras_version
 from utils.model import freeze as freeze_model
 from utils.transform import random_transform_generator
 from utils.image import random_visual_effect_generator
+from utils.level_cache import LevelCache
+from utils.fsaf import heuristic_level_assigner
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
@@ -73,7 +77,9 @@ def model_with_weights(model, weights, skip_mismatch):
     return model
 
 
-def create_models(backbone_retinanet, num_classes, weights, num_gpus=0, freeze_backbone=False, lr=1e-5, config=None):
+def create_models(backbone_retinanet, num_classes, weights, num_gpus=0, freeze_backbone=False, lr=1e-5, config=None,
+                  host_targets=False, sparse_targets=False, cached_levels=False, level_select='online',
+                  freeze_pyramid=False):
     """
     Creates three models (model, training_model, prediction_model).
 
@@ -84,6 +90,12 @@ def create_models(backbone_retinanet, num_classes, weights, num_gpus=0, freeze_b
         num_gpus : The number of GPUs to use for training.
         freeze_backbone : If True, disables learning for the backbone.
         config : Config parameters, None indicates the default configuration.
+        host_targets : If True, the model takes the fsaf targets computed by the generator as inputs.
+        sparse_targets : If True, the fsaf targets are built as per location class labels instead of dense masks.
+        cached_levels : If True, the model takes the levels cached by the generator as an extra input.
+        level_select : How the gt boxes are assigned to levels, one of ('online', 'heuristic').
+        freeze_pyramid : If True, disables learning for the pyramid (required to load the heads into one multi head
+            model, see utils.inference.load_multi_head_model).
 
     Returns
         model : The base model. This is also the model that is saved in snapshots.
@@ -107,16 +119,28 @@ def create_models(backbone_retinanet, num_classes, weights, num_gpus=0, freeze_b
         with tf.device('/cpu:0'):
             model = model_with_weights(backbone_retinanet(num_classes,
                                                           # num_anchors=num_anchors,
-                                                          modifier=modifier),
+                                                          modifier=modifier,
+                                                          host_targets=host_targets,
+                                                          sparse_targets=sparse_targets,
+                                                          cached_levels=cached_levels,
+                                                          level_select=level_select),
                                        weights=weights, skip_mismatch=True)
         training_model = multi_gpu_model(model, gpus=num_gpus)
     else:
         model = model_with_weights(backbone_retinanet(num_classes,
                                                       # num_anchors=num_anchors,
-                                                      modifier=modifier),
+                                                      modifier=modifier,
+                                                      host_targets=host_targets,
+                                                      sparse_targets=sparse_targets,
+                                                      cached_levels=cached_levels,
+                                                      level_select=level_select),
                                    weights=weights, skip_mismatch=True)
         training_model = model
 
+    if freeze_pyramid:
+        for layer_name in PYRAMID_LAYERS:
+            model.get_layer(layer_name).trainable = False
+
     # make prediction model
     # prediction_model = None
     prediction_model = fsaf_bbox(model=model)
@@ -134,7 +158,7 @@ def create_models(backbone_retinanet, num_classes, weights, num_gpus=0, freeze_b
     return model, training_model, prediction_model
 
 
-def create_callbacks(model, training_model, prediction_model, validation_generator, args):
+def create_callbacks(model, training_model, prediction_model, validation_generator, args, train_generator=None):
     """ Creates the callbacks to use during training.
 
     Args
@@ -143,6 +167,7 @@ def create_callbacks(model, training_model, prediction_model, validation_generat
         prediction_model: The model that should be used for validation.
         validation_generator: The generator for creating validation data.
         args: parseargs args object.
+        train_generator: The generator for creating training data, used to refresh its level cache.
 
     Returns:
         A list of callbacks used for training.
@@ -165,6 +190,12 @@ def create_callbacks(model, training_model, prediction_model, validation_generat
         )
         callbacks.append(tensorboard_callback)
 
+    if train_generator is not None and train_generator.level_cache is not None:
+        level_cache_refresh = LevelCacheRefresh(train_generator, train_generator.level_cache,
+                                                tensorboard=tensorboard_callback)
+        level_cache_refresh = RedirectModel(level_cache_refresh, model)
+        callbacks.append(level_cache_refresh)
+
     if args.evaluation and validation_generator:
         if args.dataset_type == 'coco':
             from callbacks import CocoEval
@@ -172,8 +203,12 @@ def create_callbacks(model, training_model, prediction_model, validation_generat
             # use prediction model for evaluation
             evaluation = CocoEval(validation_generator, tensorboard=tensorboard_callback)
         else:
+            buckets = None
+            if args.shape_buckets:
+                buckets = ShapeBuckets(multiple=args.bucket_multiple, min_side=args.image_min_side,
+                                       max_side=args.image_max_side)
             evaluation = Evaluate(validation_generator, tensorboard=tensorboard_callback,
-                                  weighted_average=args.weighted_average)
+                                  weighted_average=args.weighted_average, buckets=buckets)
         evaluation = RedirectModel(evaluation, prediction_model)
         callbacks.append(evaluation)
 
@@ -224,6 +259,10 @@ def create_generators(args, preprocess_image):
         'image_max_side': args.image_max_side,
         'preprocess_image': preprocess_image,
     }
+    # compute the fsaf targets in the generator, with the gt boxes assigned to levels by their size
+    if args.host_targets:
+        common_args['level_assigner'] = heuristic_level_assigner
+        common_args['sparse_targets'] = args.sparse_targets
 
     # create random transform generator for augmenting training data
     if args.random_transform:
@@ -305,6 +344,13 @@ def create_generators(args, preprocess_image):
     else:
         raise ValueError('Invalid data type received: {}'.format(args.dataset_type))
 
+    # optionally feed the cached levels of the gt boxes to the model, the validation cache is never filled
+    if args.level_cache_interval > 0:
+        train_generator.level_cache = LevelCache(refresh_interval=args.level_cache_interval,
+                                                 warmup_epochs=args.level_cache_warmup)
+        if validation_generator is not None:
+            validation_generator.level_cache = LevelCache()
+
     return train_generator, validation_generator
 
 
@@ -334,6 +380,16 @@ def check_args(parsed_args):
         raise ValueError(
             "Multi-GPU support is experimental, use at own risk! Run with --multi-gpu-force if you wish to continue.")
 
+    if parsed_args.level_select == 'heuristic' and parsed_args.level_cache_interval > 0:
+        raise ValueError("The level cache is only used with --level-select online.")
+
+    if parsed_args.multiprocessing and parsed_args.level_cache_interval > 0:
+        raise ValueError("The level cache is not shared with the multiprocessing workers, which would never see it "
+                         "filled, use it without --multiprocessing.")
+
+    if parsed_args.host_targets and parsed_args.level_select != 'heuristic':
+        raise ValueError("The host targets assign the gt boxes to levels by their size, use --level-select heuristic.")
+
     if 'resnet' not in parsed_args.backbone:
         warnings.warn(
             'Using experimental backbone {}. Only resnet50 has been properly tested.'.format(parsed_args.backbone))
@@ -389,15 +445,38 @@ def parse_args(args):
     parser.add_argument('--no-evaluation', help='Disable per epoch evaluation.', dest='evaluation',
                         action='store_false')
     parser.add_argument('--freeze-backbone', help='Freeze training of backbone layers.', action='store_true')
+    parser.add_argument('--freeze-pyramid',
+                        help='Freeze training of the pyramid layers, heads trained with --freeze-backbone '
+                             '--freeze-pyramid from the same weights can be run on one shared backbone.',
+                        action='store_true')
     parser.add_argument('--random-transform', help='Randomly transform image and annotations.', action='store_true')
     parser.add_argument('--image-min-side', help='Rescale the image so the smallest side is min_side.', type=int,
                         default=800)
     parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
                         type=int, default=1333)
     parser.add_argument('--config', help='Path to a configuration parameters .ini file.')
+    parser.add_argument('--sparse-targets', help='Build the fsaf targets as per location class labels.',
+                        action='store_true')
+    parser.add_argument('--host-targets',
+                        help='Compute the fsaf targets in the generator instead of the model (needs --level-select '
+                             'heuristic).',
+                        action='store_true')
+    parser.add_argument('--level-select',
+                        help='Select the level of the gt boxes by their losses (online) or by their size (heuristic).',
+                        choices=['online', 'heuristic'], default='online')
+    parser.add_argument('--level-cache-interval',
+                        help='Cache the selected levels of the gt boxes and refresh them every this many epochs '
+                             '(0 disables the cache, not supported with --multiprocessing).',
+                        type=int, default=0)
+    parser.add_argument('--level-cache-warmup', help='Number of epochs to select the levels online before caching.',
+                        type=int, default=1)
     parser.add_argument('--weighted-average',
                         help='Compute the mAP using the weighted average of precisions among classes.',
                         action='store_true')
+    parser.add_argument('--shape-buckets', help='Pad the evaluation images to a few fixed shapes.',
+                        action='store_true')
+    parser.add_argument('--bucket-multiple', help='The sides of the shape buckets are multiples of this.',
+                        default=128, type=int)
     parser.add_argument('--compute-val-loss', help='Compute validation loss during training', dest='compute_val_loss',
                         action='store_true')
 
@@ -439,8 +518,15 @@ def main(args=None):
         print('Loading model, this may take a second...')
         # model = models.load_model(args.snapshot, backbone_name=args.backbone)
         model = model_with_weights(backbone.fsaf(train_generator.num_classes(),
-                                                 modifier=None),
+                                                 modifier=None,
+                                                 host_targets=args.host_targets,
+                                                 sparse_targets=args.sparse_targets,
+                                                 cached_levels=args.level_cache_interval > 0,
+                                                 level_select=args.level_select),
                                    weights=args.snapshot, skip_mismatch=True)
+        if args.freeze_pyramid:
+            for layer_name in PYRAMID_LAYERS:
+                model.get_layer(layer_name).trainable = False
         training_model = model
         prediction_model = fsaf_bbox(model=model)
         # compile model
@@ -467,7 +553,12 @@ def main(args=None):
             num_gpus=args.num_gpus,
             freeze_backbone=args.freeze_backbone,
             lr=args.lr,
-            config=args.config
+            config=args.config,
+            host_targets=args.host_targets,
+            sparse_targets=args.sparse_targets,
+            cached_levels=args.level_cache_interval > 0,
+            level_select=args.level_select,
+            freeze_pyramid=args.freeze_pyramid,
         )
 
     # print model summary
@@ -486,6 +577,7 @@ def main(args=None):
         prediction_model,
         validation_generator,
         args,
+        train_generator=train_generator,
     )
 
     if not args.compute_val_loss:
@@ -63,6 +63,37 @@ def prop_box_graph_2(boxes, scale, width, height):
     return x1, y1, x2, y2
 
 
+def feature_locations_graph(feature_shapes, strides):
+    """
+    Flatten the locations of all pyramid levels into one grid, in the same order as the concatenated predictions.
+
+    Args:
+        feature_shapes: (num_levels, 2) tensor of (fh, fw) for every level.
+        strides: The strides mapping to the feature maps.
+
+    Returns:
+        locs_x: (sum(fh * fw), ) column of each location on its own level.
+        locs_y: (sum(fh * fw), ) row of each location on its own level.
+        locs_level: (sum(fh * fw), ) level id of each location.
+        locs_stride: (sum(fh * fw), ) stride of each location.
+    """
+    locs_x = []
+    locs_y = []
+    locs_level = []
+    for level_id in range(len(strides)):
+        fh = feature_shapes[level_id][0]
+        fw = feature_shapes[level_id][1]
+        locs_xx, locs_yy = tf.meshgrid(tf.range(fw), tf.range(fh))
+        locs_x.append(tf.reshape(locs_xx, (-1,)))
+        locs_y.append(tf.reshape(locs_yy, (-1,)))
+        locs_level.append(tf.fill((fh * fw,), level_id))
+    locs_x = tf.concat(locs_x, axis=0)
+    locs_y = tf.concat(locs_y, axis=0)
+    locs_level = tf.concat(locs_level, axis=0)
+    locs_stride = tf.gather(tf.constant(strides, dtype=tf.float32), locs_level)
+    return locs_x, locs_y, locs_level, locs_stride
+
+
 def trim_zeros_graph(boxes, name='trim_zeros'):
     """
     Often boxes are represented with matrices of shape [N, 4] and are padded with zeros.
@@ -0,0 +1,254 @@
+import collections
+import io
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from .image import read_image_bgr, resize_image
+from .inference import predict_images, unpack_detections
+from .profiling import LatencyRecorder
+
+
+class ImageDecodeError(ValueError):
+    """
+    Raised by the futures of DynamicBatcher.submit when the image bytes can not be decoded.
+    """
+
+
+class DynamicBatcher(object):
+    """
+    Coalesce concurrent detection requests into batches.
+
+    The images are decoded and resized in a thread pool, then a single thread runs the model on batches of at most
+    max_batch_size images, waiting at most max_wait seconds after the first image of a batch for more images. The
+    requests whose future was cancelled before it was batched, e.g. after a timeout of the caller, are skipped.
+    """
+
+    def __init__(
+            self,
+            model,
+            preprocess_image,
+            max_batch_size=8,
+            max_wait=0.01,
+            workers=4,
+            min_side=800,
+            max_side=1333,
+            score_threshold=0.05,
+            buckets=None,
+            cache=None,
+            recorder=None,
+            ladder=None,
+    ):
+        """
+        Initialize the batcher, call start before submitting images.
+
+        Args
+            model: A model which takes an image batch as input and outputs [boxes, scores, labels], or its
+                utils.predictor.SessionPredictor.
+            preprocess_image: The preprocessing function of the backbone.
+            max_batch_size: The maximum number of images of a batch.
+            max_wait: The maximum number of seconds the first image of a batch waits for more images.
+            workers: Number of threads decoding and resizing the images.
+            min_side: The image's min side will be equal to min_side after resizing.
+            max_side: If after resizing the image's max side is above max_side, resize until the max side is equal to max_side.
+            score_threshold: The score confidence threshold to use.
+            buckets: Optional utils.buckets.ShapeBuckets the batches are padded to.
+            cache: Optional utils.result_cache.DetectionCache looked up before running the model.
+            recorder: The utils.profiling.LatencyRecorder of the decode, preprocess, resize, forward, postprocess and
+                total (from the submission to the detections) stages, a new one by default.
+            ladder: Optional utils.resolution.ResolutionLadder selecting the min_side and max_side of every image
+                from the latency of the batches, instead of min_side and max_side.
+        """
+        self.model = model
+        self.preprocess_image = preprocess_image
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.min_side = min_side
+        self.max_side = max_side
+        self.score_threshold = score_threshold
+        self.buckets = buckets
+        self.cache = cache
+        self.recorder = recorder or LatencyRecorder()
+        self.ladder = ladder
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # (image, scale, submit time, future) of the preprocessed images
+        self.queue = queue.Queue()
+        self.thread = None
+        self.running = False
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        # the submitted requests which are not batched yet, decoding or waiting for the model
+        self.num_pending = 0
+        self.num_cancelled = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.batch_sizes = collections.deque(maxlen=1000)
+
+    def start(self):
+        # predict in the graph of the thread which built the model
+        if hasattr(self.model, '_make_predict_function'):
+            self.model._make_predict_function()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(tf.get_default_graph(),), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown()
+
+    def submit(self, image_bytes):
+        """
+        Submit an encoded image.
+
+        Returns
+            A concurrent.futures.Future of the (boxes, scores, labels) detections of the image. With a ladder, its
+            resolution attribute is the (min_side, max_side) the image was resized with.
+        """
+        future = Future()
+        submit_time = time.time()
+        with self.lock:
+            self.num_requests += 1
+        if self.cache is not None:
+            # only the detections at full resolution are cached, the lower rungs of the ladder are a fallback of
+            # bursts which should not outlive them
+            resolution = self.ladder.rungs[0] if self.ladder is not None else (self.min_side, self.max_side)
+            # the detections are stored under the key of the weights the request was looked up with
+            key = self.cache.key(image_bytes, resolution=resolution)
+            detections = self.cache.get(key)
+            if detections is not None:
+                if self.ladder is not None:
+                    future.resolution = resolution
+                future.set_result(detections)
+                return future
+
+            def put(done):
+                # the callback runs on the model thread, the store and its file I/O run in the thread pool
+                if (not done.cancelled() and done.exception() is None and
+                        getattr(done, 'resolution', resolution) == resolution):
+                    self.executor.submit(self.cache.put, key, done.result())
+
+            future.add_done_callback(put)
+        with self.lock:
+            self.num_pending += 1
+        self.executor.submit(self._preprocess, image_bytes, submit_time, future)
+        return future
+
+    def _preprocess(self, image_bytes, submit_time, future):
+        if future.cancelled():
+            with self.lock:
+                self.num_pending -= 1
+                self.num_cancelled += 1
+            return
+        try:
+            with self.recorder.stage('decode'):
+                try:
+                    image = read_image_bgr(io.BytesIO(image_bytes))
+                except Exception as e:
+                    raise ImageDecodeError('Can not decode the image: {}'.format(e))
+            with self.recorder.stage('preprocess'):
+                image = self.preprocess_image(image)
+            min_side, max_side = self.min_side, self.max_side
+            if self.ladder is not None:
+                min_side, max_side = future.resolution = self.ladder.select()
+            with self.recorder.stage('resize'):
+                image, scale = resize_image(image, min_side=min_side, max_side=max_side)
+        except Exception as e:
+            with self.lock:
+                self.num_pending -= 1
+                self.num_errors += 1
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+            return
+        self.queue.put((image, scale, submit_time, future))
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, graph):
+        with graph.as_default():
+            while self.running:
+                batch = self._next_batch()
+                if not batch:
+                    continue
+                # skip the requests whose caller gave up, the others can no longer be cancelled
+                num_batched = len(batch)
+                batch = [request for request in batch if request[3].set_running_or_notify_cancel()]
+                with self.lock:
+                    self.num_pending -= num_batched
+                    self.num_cancelled += num_batched - len(batch)
+                if not batch:
+                    continue
+                image_group, scales, submit_times, futures = zip(*batch)
+                start = time.time()
+                try:
+                    with self.recorder.stage('forward'):
+                        boxes, scores, labels = predict_images(self.model, image_group, buckets=self.buckets)[:3]
+                    with self.recorder.stage('postprocess'):
+                        detections = unpack_detections(boxes, scores, labels, scales,
+                                                       score_threshold=self.score_threshold)
+                except Exception as e:
+                    with self.lock:
+                        self.num_errors += len(futures)
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                end = time.time()
+                if self.ladder is not None:
+                    self.ladder.update(start - min(submit_times), end - start)
+
+                with self.lock:
+                    self.num_batches += 1
+                    self.batch_sizes.append(len(batch))
+                for submit_time, future, image_detections in zip(submit_times, futures, detections):
+                    self.recorder.record('total', end - submit_time)
+                    if self.ladder is not None:
+                        self.recorder.record('total@{}'.format(future.resolution[0]), end - submit_time)
+                    future.set_result(image_detections)
+
+    def metrics(self):
+        """
+        Returns
+            A dict with the queue depth (the requests submitted but not batched yet), the request, cancellation and
+            batch counts, the mean batch size, the latency summary of
+            every stage (see utils.profiling.LatencyRecorder.summary), the hit counts of the shape buckets, the
+            statistics of the detection cache and the state of the resolution ladder.
+        """
+        with self.lock:
+            metrics = {
+                'queue_depth': self.num_pending,
+                'num_requests': self.num_requests,
+                'num_cancelled': self.num_cancelled,
+                'num_batches': self.num_batches,
+                'num_errors': self.num_errors,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.,
+            }
+            if self.buckets is not None:
+                metrics['shape_buckets'] = self.buckets.report()
+        metrics['latency'] = self.recorder.summary()
+        if self.cache is not None:
+            metrics['cache'] = self.cache.statistics()
+        if self.ladder is not None:
+            metrics['resolution'] = self.ladder.report()
+        return metrics
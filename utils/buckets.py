@@ -0,0 +1,127 @@
+import collections
+import time
+
+import keras
+import numpy as np
+
+
+def round_up(size, multiple):
+    return int(np.ceil(size / float(multiple)) * multiple)
+
+
+def default_buckets(min_side=800, max_side=1333, multiple=128):
+    """
+    Compute the buckets covering the images resized by utils.image.resize_image.
+
+    The short side of a resized image is at most min_side and the long side at most max_side, so the buckets have a
+    short side of min_side and a long side of every multiple between min_side and max_side, in both orientations.
+
+    Returns
+        List of (height, width) buckets.
+    """
+    short_side = round_up(min_side, multiple)
+    long_sides = range(short_side, round_up(max_side, multiple) + 1, multiple)
+    buckets = [(short_side, long_side) for long_side in long_sides]
+    buckets += [(long_side, short_side) for long_side in long_sides if long_side != short_side]
+    return buckets
+
+
+def ladder_buckets(rungs, multiple=128):
+    """
+    Compute the buckets covering the images resized with every (min_side, max_side) rung of a resolution ladder (see
+    utils.resolution), so the images of the lower rungs are not padded back up to the buckets of the highest one.
+
+    Returns
+        List of (height, width) buckets.
+    """
+    buckets = []
+    for min_side, max_side in rungs:
+        buckets += [bucket for bucket in default_buckets(min_side=min_side, max_side=max_side, multiple=multiple)
+                    if bucket not in buckets]
+    return buckets
+
+
+class ShapeBuckets(object):
+    """
+    Pad the image batches to a few fixed shapes, so the model only ever runs on those shapes.
+
+    The images which do not fit in any bucket are padded to the next multiple of the bucket multiple and counted as
+    misses.
+    """
+
+    def __init__(self, buckets=None, multiple=128, min_side=800, max_side=1333):
+        """
+        Initialize the buckets.
+
+        Args
+            buckets: List of (height, width) buckets, defaults to default_buckets(min_side, max_side, multiple).
+            multiple: The multiple the shapes which fit no bucket are padded to.
+            min_side: The min side of the resized images, used for the default buckets.
+            max_side: The max side of the resized images, used for the default buckets.
+        """
+        if buckets is None:
+            buckets = default_buckets(min_side=min_side, max_side=max_side, multiple=multiple)
+        # try the smallest buckets first
+        self.buckets = sorted([tuple(bucket) for bucket in buckets], key=lambda bucket: bucket[0] * bucket[1])
+        self.multiple = multiple
+        self.hits = collections.Counter()
+        self.num_misses = 0
+
+    def bucket(self, shape):
+        """
+        Get the smallest bucket which fits an image shape.
+
+        Args
+            shape: The (height, width, ...) shape of the image.
+
+        Returns
+            The (height, width) bucket.
+        """
+        height, width = shape[:2]
+        for bucket in self.buckets:
+            if height <= bucket[0] and width <= bucket[1]:
+                self.hits[bucket] += 1
+                return bucket
+        self.num_misses += 1
+        return round_up(height, self.multiple), round_up(width, self.multiple)
+
+    def pad(self, image_group):
+        """
+        Copy the images to the upper left part of a zero padded image batch of the shape of a bucket.
+        """
+        max_shape = tuple(max(image.shape[x] for image in image_group) for x in range(3))
+        batch_images = np.zeros((len(image_group),) + self.bucket(max_shape) + max_shape[2:],
+                                dtype=keras.backend.floatx())
+        for image_index, image in enumerate(image_group):
+            batch_images[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+        if keras.backend.image_data_format() == 'channels_first':
+            batch_images = batch_images.transpose((0, 3, 1, 2))
+        return batch_images
+
+    def warmup(self, model, batch_size=1, channels=3):
+        """
+        Run the model once on every bucket, so the first requests of every shape do not pay for the kernel selection
+        and the memory allocation.
+
+        Returns
+            A dict mapping every bucket to the time of its first run in seconds.
+        """
+        timings = {}
+        for bucket in self.buckets:
+            batch_images = np.zeros((batch_size,) + bucket + (channels,), dtype=keras.backend.floatx())
+            if keras.backend.image_data_format() == 'channels_first':
+                batch_images = batch_images.transpose((0, 3, 1, 2))
+            start = time.time()
+            model.predict_on_batch(batch_images)
+            timings[bucket] = time.time() - start
+        return timings
+
+    def report(self):
+        """
+        Returns
+            A dict with the hit count of every bucket and the number of misses.
+        """
+        return {
+            'hits': {'{}x{}'.format(*bucket): self.hits[bucket] for bucket in self.buckets},
+            'misses': self.num_misses,
+        }
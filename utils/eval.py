@@ -16,13 +16,16 @@ limitations under the License.
 
 from utils.compute_overlap import compute_overlap
 from utils.visualization import draw_detections, draw_annotations
+from utils.inference import pad_images, predict_images
+from utils.postprocess import HostPostprocessor
+from utils.profiling import NULL_RECORDER
 
-import keras
 import numpy as np
 import os
 import cv2
 import progressbar
 import pickle
+import time
 
 assert (callable(progressbar.progressbar)), "Using wrong progressbar module, install 'progressbar2' instead."
 
@@ -59,7 +62,8 @@ def _compute_ap(recall, precision):
     return ap
 
 
-def _get_detections(generator, model, score_threshold=0.05, max_detections=100, visualize=False):
+def _get_detections(generator, model, score_threshold=0.05, max_detections=100, visualize=False, buckets=None,
+                    recorder=NULL_RECORDER):
     """
     Get the detections from the model using the generator.
 
@@ -68,10 +72,13 @@ def _get_detections(generator, model, score_threshold=0.05, max_detections=100,
 
     Args:
         generator: The generator used to run images through the model.
-        model: The model to run on the images.
+        model: The model to run on the images, or a utils.postprocess.HostPostprocessor whose postprocessing of an
+            image overlaps with the forward pass of the next one.
         score_threshold: The score confidence threshold to use.
         max_detections: The maximum number of detections to use per image.
         save_path: The path to save the images with visualized detections to.
+        buckets: Optional utils.buckets.ShapeBuckets the images are padded to.
+        recorder: utils.profiling.LatencyRecorder of the decode, preprocess, resize, forward and postprocess stages.
 
     Returns:
         A list of lists containing the detections for each image in the generator.
@@ -80,17 +87,12 @@ def _get_detections(generator, model, score_threshold=0.05, max_detections=100,
     all_detections = [[None for i in range(generator.num_classes()) if generator.has_label(i)] for j in
                       range(generator.size())]
 
-    for i in progressbar.progressbar(range(generator.size()), prefix='Running network: '):
-        raw_image = generator.load_image(i)
-        image = generator.preprocess_image(raw_image.copy())
-        image, scale = generator.resize_image(image)
-
-        if keras.backend.image_data_format() == 'channels_first':
-            image = image.transpose((2, 0, 1))
-
-        # run network
-        boxes, scores, labels = model.predict_on_batch(np.expand_dims(image, axis=0))[:3]
+    def collect(i, raw_image, scale, outputs):
+        if isinstance(model, HostPostprocessor):
+            outputs = outputs.result()
+        boxes, scores, labels = outputs
 
+        postprocess_start = time.time()
         # correct boxes for image scale
         boxes /= scale
 
@@ -113,6 +115,7 @@ def _get_detections(generator, model, score_threshold=0.05, max_detections=100,
         # (n, 6)
         image_detections = np.concatenate(
             [image_boxes, np.expand_dims(image_scores, axis=1), np.expand_dims(image_labels, axis=1)], axis=1)
+        recorder.record('postprocess', time.time() - postprocess_start)
 
         if visualize:
             draw_annotations(raw_image, generator.load_annotations(i), label_to_name=generator.label_to_name)
@@ -131,6 +134,29 @@ def _get_detections(generator, model, score_threshold=0.05, max_detections=100,
 
             all_detections[i][label] = image_detections[image_detections[:, -1] == label, :-1]
 
+    # the detections of an image are collected after the next image is run through the network
+    pending = None
+    for i in progressbar.progressbar(range(generator.size()), prefix='Running network: '):
+        with recorder.stage('decode'):
+            raw_image = generator.load_image(i)
+        with recorder.stage('preprocess'):
+            image = generator.preprocess_image(raw_image.copy())
+        with recorder.stage('resize'):
+            image, scale = generator.resize_image(image)
+
+        # run network
+        with recorder.stage('forward'):
+            if isinstance(model, HostPostprocessor):
+                outputs = model.submit(pad_images([image], buckets=buckets))
+            else:
+                outputs = predict_images(model, [image], buckets=buckets)[:3]
+
+        if pending is not None:
+            collect(*pending)
+        pending = (i, raw_image, scale, outputs)
+    if pending is not None:
+        collect(*pending)
+
     return all_detections
 
 
@@ -171,7 +197,9 @@ def evaluate(
         score_threshold=0.05,
         max_detections=100,
         visualize=False,
-        epoch=0
+        epoch=0,
+        buckets=None,
+        recorder=NULL_RECORDER
 ):
     """
     Evaluate a given dataset using a given model.
@@ -183,6 +211,8 @@ def evaluate(
         score_threshold: The score confidence threshold to use for detections.
         max_detections: The maximum number of detections to use per image.
         visualize: Show the visualized detections or not.
+        buckets: Optional utils.buckets.ShapeBuckets the images are padded to.
+        recorder: utils.profiling.LatencyRecorder of the stages of the inference.
 
     Returns:
         A dict mapping class names to mAP scores.
@@ -190,7 +220,7 @@ def evaluate(
     """
     # gather all detections and annotations
     all_detections = _get_detections(generator, model, score_threshold=score_threshold, max_detections=max_detections,
-                                     visualize=visualize)
+                                     visualize=visualize, buckets=buckets, recorder=recorder)
     all_annotations = _get_annotations(generator)
     average_precisions = {}
 
@@ -261,10 +291,20 @@ def evaluate(
 
 if __name__ == '__main__':
     from generators.voc_generator import PascalVocGenerator
+    from utils.buckets import ShapeBuckets
     from utils.image import preprocess_image
+    import argparse
     import models
     import os
 
+    parser = argparse.ArgumentParser(description='Evaluation script for a fsaf network.')
+    parser.add_argument('--shape-buckets',
+                        help='Pad the images to a few fixed shapes, which are run once when the model is loaded.',
+                        action='store_true')
+    parser.add_argument('--bucket-multiple', help='The sides of the shape buckets are multiples of this.',
+                        default=128, type=int)
+    args = parser.parse_args()
+
     os.environ['CUDA_VISIBLE_DEVICES'] = '1'
     common_args = {
         'batch_size': 1,
@@ -297,7 +337,13 @@ if __name__ == '__main__':
     fsaf = resnet_fsaf(num_classes=20, backbone='resnet101')
     model = fsaf_bbox(fsaf)
     model.load_weights(model_path, by_name=True)
-    average_precisions = evaluate(generator, model, visualize=False)
+    buckets = None
+    if args.shape_buckets:
+        buckets = ShapeBuckets(multiple=args.bucket_multiple, min_side=common_args['image_min_side'],
+                               max_side=common_args['image_max_side'])
+        for bucket, seconds in buckets.warmup(model).items():
+            print('Warmed up bucket {}x{} in {:.2f}s.'.format(bucket[0], bucket[1], seconds))
+    average_precisions = evaluate(generator, model, visualize=False, buckets=buckets)
     # compute per class average precision
     total_instances = []
     precisions = []
@@ -308,3 +354,5 @@ if __name__ == '__main__':
         precisions.append(average_precision)
     mean_ap = sum(precisions) / sum(x > 0 for x in total_instances)
     print('mAP: {:.4f}'.format(mean_ap))
+    if buckets is not None:
+        print('Shape buckets: {}'.format(buckets.report()))
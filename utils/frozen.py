@@ -0,0 +1,87 @@
+"""
+Run a frozen inference graph exported by export.py, without keras and the custom layers.
+"""
+
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from .image import resize_image
+
+
+def metadata_path(path):
+    return path[:-len('.pb')] + '.json' if path.endswith('.pb') else path + '.json'
+
+
+class FrozenDetector(object):
+    """
+    Load a frozen graph and run it with a session callable.
+
+    The graph takes a batch of BGR images which are not preprocessed (the preprocessing of the backbone is part of the
+    graph) and outputs [boxes, scores, labels] like models.retinanet.fsaf_bbox.
+    """
+
+    def __init__(self, path, config=None):
+        """
+        Load the graph and its metadata (written next to it by export.py).
+
+        Args
+            path: Path to the frozen graph (.pb).
+            config: Optional tf.ConfigProto of the session.
+        """
+        with open(metadata_path(path)) as f:
+            self.metadata = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph, config=config)
+        images = self.graph.get_tensor_by_name(self.metadata['input'])
+        outputs = [self.graph.get_tensor_by_name(name) for name in self.metadata['outputs']]
+        self.callable = self.session.make_callable(outputs, feed_list=[images])
+        # the raw pixel value which is zero after preprocessing, the images are padded with it
+        self.pad_value = np.array(self.metadata['pad_value'], dtype=np.float32)
+
+    def predict_on_batch(self, batch_images):
+        """
+        Run the graph on a batch of BGR images padded with pad_value.
+
+        Returns
+            The numpy [boxes, scores, labels] of the batch.
+        """
+        return self.callable(batch_images)
+
+    def pad_images(self, image_group):
+        """
+        Copy the images to the upper left part of an image batch padded with pad_value.
+        """
+        max_shape = tuple(max(image.shape[x] for image in image_group) for x in range(3))
+        batch_images = np.empty((len(image_group),) + max_shape, dtype=np.float32)
+        batch_images[...] = self.pad_value
+        for image_index, image in enumerate(image_group):
+            batch_images[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+        return batch_images
+
+    def detect(self, image_group, score_threshold=0.05):
+        """
+        Resize the BGR images like at export time and detect the objects on them.
+
+        Args
+            image_group: List of (h, w, 3) BGR images.
+            score_threshold: The score confidence threshold to use.
+
+        Returns
+            List of (boxes, scores, labels) of every image, in the original image coordinates.
+        """
+        resized = [resize_image(image.astype(np.float32), min_side=self.metadata['image_min_side'],
+                                max_side=self.metadata['image_max_side']) for image in image_group]
+        boxes, scores, labels = self.predict_on_batch(self.pad_images([image for image, _ in resized]))
+        detections = []
+        for image_boxes, image_scores, image_labels, (_, scale) in zip(boxes, scores, labels, resized):
+            indices = np.where(image_scores > score_threshold)[0]
+            detections.append((image_boxes[indices] / scale, image_scores[indices], image_labels[indices]))
+        return detections
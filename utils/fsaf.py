@@ -0,0 +1,271 @@
+import functools
+import numpy as np
+
+from configure import STRIDES, POS_SCALE, IGNORE_SCALE
+
+
+def feature_locations(feature_shapes, strides=STRIDES):
+    """
+    Flatten the locations of all pyramid levels into one grid, in the same order as the concatenated predictions.
+
+    Args:
+        feature_shapes: (num_levels, 2) array of (fh, fw) for every level.
+        strides: The strides mapping to the feature maps.
+
+    Returns:
+        locs_x: (sum(fh * fw), ) column of each location on its own level.
+        locs_y: (sum(fh * fw), ) row of each location on its own level.
+        locs_level: (sum(fh * fw), ) level id of each location.
+        locs_stride: (sum(fh * fw), ) stride of each location.
+    """
+    locs_x = []
+    locs_y = []
+    locs_level = []
+    for level_id in range(len(strides)):
+        fh, fw = feature_shapes[level_id]
+        locs_xx, locs_yy = np.meshgrid(np.arange(fw, dtype=np.int32), np.arange(fh, dtype=np.int32))
+        locs_x.append(locs_xx.reshape(-1))
+        locs_y.append(locs_yy.reshape(-1))
+        locs_level.append(np.full((fh * fw,), level_id, dtype=np.int32))
+    locs_x = np.concatenate(locs_x, axis=0)
+    locs_y = np.concatenate(locs_y, axis=0)
+    locs_level = np.concatenate(locs_level, axis=0)
+    locs_stride = np.array(strides, dtype=np.float32)[locs_level]
+    return locs_x, locs_y, locs_level, locs_stride
+
+
+def prop_boxes(boxes, scale, width, height):
+    """
+    Compute proportional box coordinates, see util_graphs.prop_box_graph.
+
+    Box centers are fixed. Box w and h scaled by scale.
+
+    Args:
+        boxes: (n, 4) boxes projected onto the feature map.
+        scale: The scale of box w and h.
+        width: Width of the feature map, a scalar or (n, ) array.
+        height: Height of the feature map, a scalar or (n, ) array.
+
+    Returns:
+        x1, y1, x2, y2 of shape (n, ), the region covers [x1, x2) * [y1, y2).
+    """
+    boxes = boxes.astype(np.float32)
+    scale = np.float32(scale)
+    centers = np.float32(0.5) * (boxes[:, 0:2] + boxes[:, 2:4])
+    sizes = (boxes[:, 2:4] - boxes[:, 0:2]) * scale
+    x1 = np.floor(centers[:, 0] - np.float32(0.5) * sizes[:, 0])
+    y1 = np.floor(centers[:, 1] - np.float32(0.5) * sizes[:, 1])
+    x2 = np.ceil(centers[:, 0] + np.float32(0.5) * sizes[:, 0])
+    y2 = np.ceil(centers[:, 1] + np.float32(0.5) * sizes[:, 1])
+    x2 = np.clip(x2, 1, width).astype(np.int32)
+    y2 = np.clip(y2, 1, height).astype(np.int32)
+    x1 = np.clip(x1, 0, x2 - 1).astype(np.int32)
+    y1 = np.clip(y1, 0, y2 - 1).astype(np.int32)
+    return x1, y1, x2, y2
+
+
+def compute_fsaf_targets(
+        gt_boxes,
+        gt_labels,
+        gt_box_levels,
+        feature_shapes,
+        num_classes,
+        strides=STRIDES,
+        pos_scale=POS_SCALE,
+        ignore_scale=IGNORE_SCALE,
+        sparse=False
+):
+    """
+    Compute the fsaf targets of one image, the NumPy counterpart of fsaf_layers.build_batch_fsaf_target.
+
+    Args:
+        gt_boxes: (n, 4) gt boxes in (x1, y1, x2, y2) format.
+        gt_labels: (n, ) labels of the gt boxes.
+        gt_box_levels: (n, ) level assigned to each gt box, gt boxes with a negative level are skipped.
+        feature_shapes: (5, 2) array of (fh, fw) for every level.
+        num_classes: Number of classes.
+        strides: The strides mapping to the feature maps.
+        pos_scale: The scale of the positive region of a gt box.
+        ignore_scale: The scale of the ignore region of a gt box.
+        sparse: If True, return the class labels instead of the one-hot class targets and masks.
+
+    Returns:
+        cls_target: (sum(fh * fw), num_classes)
+        cls_mask: (sum(fh * fw), ) False for the ignored locations.
+        cls_num_pos: The number of positive locations.
+        regr_target: (sum(fh * fw), 4)
+        regr_mask: (sum(fh * fw), ) True for the positive locations.
+        or if sparse
+        cls_labels: (sum(fh * fw), ) label of the positive locations, -1 for the negative and -2 for the ignored locations.
+        regr_target: (sum(fh * fw), 4)
+    """
+    feature_shapes = np.asarray(feature_shapes)
+    keep = gt_box_levels >= 0
+    gt_boxes = gt_boxes[keep].astype(np.float32)
+    gt_labels = gt_labels[keep].astype(np.int32)
+    gt_box_levels = gt_box_levels[keep].astype(np.int32)
+
+    locs_x, locs_y, locs_level, locs_stride = feature_locations(feature_shapes, strides)
+    num_locations = locs_x.shape[0]
+    regr_target = np.zeros((num_locations, 4), dtype=np.float32)
+    if gt_boxes.shape[0] == 0:
+        if sparse:
+            return np.full((num_locations,), -1, dtype=np.int32), regr_target
+        return (np.zeros((num_locations, num_classes), dtype=np.float32), np.ones((num_locations,), dtype=bool),
+                np.float32(0.), regr_target, np.zeros((num_locations,), dtype=bool))
+
+    # project every gt box onto the level it is assigned to
+    box_strides = np.array(strides, dtype=np.float32)[gt_box_levels]
+    box_fh = feature_shapes[gt_box_levels, 0]
+    box_fw = feature_shapes[gt_box_levels, 1]
+    proj_boxes = gt_boxes / box_strides[:, None]
+
+    def in_region(scale):
+        # (n, 1)
+        x1, y1, x2, y2 = [coord[:, None] for coord in prop_boxes(proj_boxes, scale, box_fw, box_fh)]
+        # (n, sum(fh * fw))
+        return ((gt_box_levels[:, None] == locs_level) &
+                (locs_x >= x1) & (locs_x < x2) &
+                (locs_y >= y1) & (locs_y < y2))
+
+    pos_region = in_region(pos_scale)
+    ign_region = in_region(ignore_scale)
+
+    # (sum(fh * fw), )
+    shift_x = (locs_x.astype(np.float32) + np.float32(0.5)) * locs_stride
+    shift_y = (locs_y.astype(np.float32) + np.float32(0.5)) * locs_stride
+    pos_mask = pos_region.any(axis=0)
+    ign_mask = ign_region.any(axis=0)
+
+    # the positive locations are owned by the gt box with the minimal area, the first one on ties
+    pos_indices = np.where(pos_mask)[0]
+    l = np.maximum(shift_x[pos_indices] - gt_boxes[:, 0:1], 0)
+    t = np.maximum(shift_y[pos_indices] - gt_boxes[:, 1:2], 0)
+    r = np.maximum(gt_boxes[:, 2:3] - shift_x[pos_indices], 0)
+    b = np.maximum(gt_boxes[:, 3:4] - shift_y[pos_indices], 0)
+    area = np.where(pos_region[:, pos_indices], (l + r) * (t + b), np.float32(1e7))
+    owner_indices = np.argmin(area, axis=0)
+    owner_boxes = gt_boxes[owner_indices]
+
+    regr_target[pos_indices, 0] = np.maximum(shift_x[pos_indices] - owner_boxes[:, 0], 0)
+    regr_target[pos_indices, 1] = np.maximum(shift_y[pos_indices] - owner_boxes[:, 1], 0)
+    regr_target[pos_indices, 2] = np.maximum(owner_boxes[:, 2] - shift_x[pos_indices], 0)
+    regr_target[pos_indices, 3] = np.maximum(owner_boxes[:, 3] - shift_y[pos_indices], 0)
+    regr_target /= 4.0
+    cls_mask = pos_mask | ~ign_mask
+    if sparse:
+        cls_labels = np.where(cls_mask, -1, -2).astype(np.int32)
+        cls_labels[pos_indices] = gt_labels[owner_indices]
+        return cls_labels, regr_target
+
+    cls_target = np.zeros((num_locations, num_classes), dtype=np.float32)
+    cls_target[pos_indices, gt_labels[owner_indices]] = 1
+    cls_num_pos = np.float32(pos_indices.shape[0])
+    return cls_target, cls_mask, cls_num_pos, regr_target, pos_mask
+
+
+def compute_batch_fsaf_targets(
+        batch_gt_boxes,
+        batch_gt_box_levels,
+        feature_shapes,
+        num_classes,
+        strides=STRIDES,
+        pos_scale=POS_SCALE,
+        ignore_scale=IGNORE_SCALE,
+        sparse=False
+):
+    """
+    Compute the fsaf targets of a batch, with the same layout as the outputs of fsaf_layers.FSAFTarget.
+
+    Args:
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5) gt boxes and labels, padded with zeros.
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES) level assigned to each gt box, -1 for padding boxes.
+        feature_shapes: (5, 2) array of (fh, fw) for every level.
+        num_classes: Number of classes.
+        strides: The strides mapping to the feature maps.
+        pos_scale: The scale of the positive region of a gt box.
+        ignore_scale: The scale of the ignore region of a gt box.
+        sparse: If True, return the class labels instead of the one-hot class targets and masks.
+
+    Returns:
+        [batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask]
+        or [batch_cls_labels, batch_regr_target] if sparse. Unlike FSAFTarget, the regression targets stay dense so that
+        every input keeps the batch dimension.
+    """
+    targets = [
+        compute_fsaf_targets(
+            gt_boxes[:, :4],
+            gt_boxes[:, 4],
+            gt_box_levels,
+            feature_shapes,
+            num_classes,
+            strides=strides,
+            pos_scale=pos_scale,
+            ignore_scale=ignore_scale,
+            sparse=sparse
+        ) for gt_boxes, gt_box_levels in zip(batch_gt_boxes, batch_gt_box_levels)
+    ]
+    return [np.stack(batch_target, axis=0) for batch_target in zip(*targets)]
+
+
+@functools.lru_cache(maxsize=None)
+def _locations_for_shapes(feature_shapes, strides):
+    locs_x, locs_y, _, locs_stride = feature_locations(np.array(feature_shapes).reshape(-1, 2), strides)
+    offsets = np.floor_divide(locs_stride, 2)
+    locations = np.stack([locs_x * locs_stride + offsets, locs_y * locs_stride + offsets], axis=1)
+    return locations.astype(np.float32), locs_stride
+
+
+def locations_for_shapes(feature_shapes, strides=STRIDES):
+    """
+    Compute the outputs of fsaf_layers.Locations for one image, memoized per feature shapes.
+
+    Args:
+        feature_shapes: (num_levels, 2) (fh, fw) for every level.
+        strides: The strides mapping to the feature maps.
+
+    Returns:
+        locations: (sum(fh * fw), 2) (x, y) of the center of every location.
+        strides: (sum(fh * fw), ) stride of every location.
+    """
+    feature_shapes = tuple(tuple(int(size) for size in feature_shape) for feature_shape in feature_shapes)
+    return _locations_for_shapes(feature_shapes, tuple(strides))
+
+
+def heuristic_levels(batch_gt_boxes, strides=STRIDES, scale=4.0):
+    """
+    Select the level of all gt boxes of a batch from their size only, see fsaf_layers.heuristic_level_select.
+
+    Level i takes the gt boxes with sqrt(w * h) in [scale * strides[i], 2 * scale * strides[i]), the smaller and larger
+    gt boxes go to the first and last level.
+
+    Args:
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5) gt boxes and labels, padded with zeros.
+        strides: The strides mapping to the feature maps.
+        scale: The size of the smallest gt boxes of every level relative to its stride.
+
+    Returns:
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES), -1 for padding boxes.
+    """
+    batch_gt_boxes = np.asarray(batch_gt_boxes, dtype=np.float32)
+    non_zeros = np.any(batch_gt_boxes[:, :, :4] != 0, axis=-1)
+    box_sizes = np.sqrt((batch_gt_boxes[:, :, 2] - batch_gt_boxes[:, :, 0]) *
+                        (batch_gt_boxes[:, :, 3] - batch_gt_boxes[:, :, 1]))
+    # upper bound of the box sizes of all levels but the last one
+    upper_bounds = np.array([2 * scale * stride for stride in strides[:-1]], dtype=np.float32)
+    gt_box_levels = np.sum(box_sizes[:, :, None] >= upper_bounds, axis=-1).astype(np.int64)
+    return np.where(non_zeros, gt_box_levels, -1)
+
+
+def heuristic_level_assigner(group, batch_gt_boxes):
+    """
+    Level assigner of generators.Generator which assigns the gt boxes to levels by their size, see heuristic_levels.
+
+    Args:
+        group: The indices of the images of the batch, unused.
+        batch_gt_boxes: (B, MAX_NUM_GT_BOXES, 5) gt boxes and labels, padded with zeros.
+
+    Returns:
+        batch_gt_box_levels: (B, MAX_NUM_GT_BOXES), -1 for padding boxes.
+    """
+    return heuristic_levels(batch_gt_boxes)
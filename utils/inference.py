@@ -0,0 +1,282 @@
+import os
+
+import keras
+import numpy as np
+from PIL import Image
+
+from .image import read_image_bgr, resize_image
+from .predictor import SessionPredictor
+from .profiling import NULL_RECORDER
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_images(inputs):
+    """
+    List the images to run inference on.
+
+    Args
+        inputs: List of image paths, directories (searched recursively) and text files with one image path per line.
+
+    Returns
+        The list of image paths.
+    """
+    image_paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, file_names in sorted(os.walk(path)):
+                image_paths.extend(os.path.join(root, file_name) for file_name in sorted(file_names)
+                                   if file_name.lower().endswith(IMAGE_EXTENSIONS))
+        elif path.lower().endswith('.txt'):
+            with open(path) as f:
+                image_paths.extend(line.strip() for line in f if line.strip())
+        else:
+            image_paths.append(path)
+    return image_paths
+
+
+def image_aspect_ratio(path):
+    """
+    Compute the aspect ratio of an image from its header, without decoding it.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+    return float(width) / float(height)
+
+
+def group_by_aspect_ratio(aspect_ratios, batch_size):
+    """
+    Sort the images by aspect ratio and divide them into batches, so the images of a batch need little padding.
+
+    Args
+        aspect_ratios: List of the aspect ratios of the images.
+        batch_size: The maximum number of images of a batch.
+
+    Returns
+        List of lists of image indices.
+    """
+    order = sorted(range(len(aspect_ratios)), key=lambda i: aspect_ratios[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def load_inference_model(snapshot, backbone_name='resnet50', num_classes=None, convert_model=False, raw=False,
+                         **kwargs):
+    """
+    Load a model which outputs the detections.
+
+    Args
+        snapshot: Path to the snapshot.
+        backbone_name: Backbone with which the model was trained.
+        num_classes: If given, build the fsaf model of this number of classes and load the snapshot weights by name,
+            which works for both training and inference snapshots.
+        convert_model: Whether the snapshot loaded with models.load_model is a training model to convert.
+        raw: Whether to return the raw model of models.retinanet.fsaf_raw instead, whose outputs are postprocessed on
+            the host. Requires num_classes or a training snapshot.
+        **kwargs: Passed to models.retinanet.fsaf_bbox when the model is built or converted here, e.g. image_shapes.
+
+    Returns
+        A keras.models.Model which takes an image batch as input and outputs [boxes, scores, labels], or
+        [regression, classification] if raw.
+    """
+    import models
+    from models.retinanet import fsaf_bbox, fsaf_raw
+
+    convert = fsaf_raw if raw else lambda model: fsaf_bbox(model, **kwargs)
+    if num_classes is not None:
+        model = models.backbone(backbone_name).fsaf(num_classes, modifier=None)
+        model.load_weights(snapshot, by_name=True)
+        return convert(model)
+
+    model = models.load_model(snapshot, backbone_name=backbone_name)
+    if convert_model or raw:
+        model = convert(model)
+    return model
+
+
+def load_head_weights(model, head_name, snapshot):
+    """
+    Load the weights of the fsaf submodels of a snapshot into a head of a multi head model (see
+    models.retinanet.fsaf_multi_head_bbox).
+
+    Args
+        model: The multi head model.
+        head_name: The name of the head.
+        snapshot: Path to a training or inference snapshot, saved with model.save or model.save_weights.
+    """
+    import h5py
+
+    with h5py.File(snapshot, 'r') as f:
+        # snapshots of model.save keep the weights in a sub group
+        group = f['model_weights'] if 'model_weights' in f else f
+        for submodel_name in ('fsaf_regression_model', 'fsaf_classification_model'):
+            model.get_layer('{}_{}'.format(head_name, submodel_name)).set_weights(
+                _snapshot_layer_weights(group, submodel_name))
+
+
+def _decode_names(names):
+    return [name.decode('utf8') if isinstance(name, bytes) else name for name in names]
+
+
+def _snapshot_layer_weights(group, layer_name):
+    """ Read the weights of a layer from the weights group of a snapshot. """
+    layer_group = group[layer_name]
+    return [np.asarray(layer_group[weight_name]) for weight_name in _decode_names(layer_group.attrs['weight_names'])]
+
+
+def check_shared_weights(model, snapshot):
+    """
+    Check that the backbone and pyramid weights of a snapshot are the ones loaded into a multi head model, a head
+    trained on other features than the shared ones gives wrong detections without any error.
+
+    Args
+        model: The multi head model.
+        snapshot: Path to the snapshot of a head.
+
+    Raises
+        ValueError: If the weights of a layer shared by the snapshot and the model differ.
+    """
+    import h5py
+
+    mismatched = []
+    with h5py.File(snapshot, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        layer_names = set(_decode_names(group.attrs['layer_names']))
+        # the head submodels of the model are prefixed by the head name, so only the backbone and pyramid match
+        for layer in model.layers:
+            if layer.name not in layer_names or not layer.weights:
+                continue
+            snapshot_weights = _snapshot_layer_weights(group, layer.name)
+            if len(snapshot_weights) != len(layer.weights) or not all(
+                    np.array_equal(weights, loaded) for weights, loaded in zip(snapshot_weights, layer.get_weights())):
+                mismatched.append(layer.name)
+    if mismatched:
+        raise ValueError('The weights of {} layers of {} differ from the shared ones ({}), the heads must be trained '
+                         'on the same backbone and pyramid, with train.py --freeze-backbone --freeze-pyramid.'.format(
+                             len(mismatched), snapshot, ', '.join(mismatched[:10])))
+
+
+def load_multi_head_model(heads, backbone_name='resnet50', backbone_snapshot=None, **kwargs):
+    """
+    Build one inference model running several fsaf heads on a shared backbone and load every head from its own
+    snapshot.
+
+    The heads must have been trained on the same frozen backbone and pyramid (train.py --freeze-backbone
+    --freeze-pyramid, starting from the same weights), whose weights are loaded from backbone_snapshot, or from the
+    snapshot of the first head. A ValueError is raised if the backbone or pyramid weights of a head snapshot differ.
+
+    Args
+        heads: List of (head name, snapshot, number of classes).
+        backbone_name: Backbone with which the heads were trained.
+        backbone_snapshot: Optional snapshot of the backbone and pyramid weights.
+        **kwargs: Passed to models.retinanet.fsaf_multi_head_bbox.
+
+    Returns
+        A keras.models.Model which takes an image batch as input and outputs the [boxes, scores, labels] of every
+        head, in the order of heads.
+    """
+    import models
+
+    model = models.backbone(backbone_name).fsaf_multi_head_bbox(
+        [(head_name, num_classes) for head_name, _, num_classes in heads], **kwargs)
+    # the head submodels have their own names, so only the backbone and the pyramid load by name
+    model.load_weights(backbone_snapshot or heads[0][1], by_name=True)
+    for head_name, snapshot, _ in heads:
+        load_head_weights(model, head_name, snapshot)
+        check_shared_weights(model, snapshot)
+    return model
+
+
+def split_head_outputs(outputs, head_names):
+    """
+    Split the outputs of a multi head model by head.
+
+    Returns
+        A dict mapping every head name to its [boxes, scores, labels].
+    """
+    return {head_name: outputs[3 * i:3 * i + 3] for i, head_name in enumerate(head_names)}
+
+
+def load_image(path, preprocess_image, min_side=800, max_side=1333, recorder=NULL_RECORDER):
+    """
+    Read, preprocess and resize an image for the network.
+
+    Args
+        path: Path to the image.
+        preprocess_image: The preprocessing function of the backbone.
+        min_side: The image's min side will be equal to min_side after resizing.
+        max_side: If after resizing the image's max side is above max_side, resize until the max side is equal to max_side.
+        recorder: utils.profiling.LatencyRecorder of the decode, preprocess and resize stages.
+
+    Returns
+        image: The network input.
+        scale: The resizing scale.
+    """
+    with recorder.stage('decode'):
+        image = read_image_bgr(path)
+    with recorder.stage('preprocess'):
+        image = preprocess_image(image)
+    with recorder.stage('resize'):
+        return resize_image(image, min_side=min_side, max_side=max_side)
+
+
+def pad_images(image_group, buckets=None):
+    """
+    Copy the images to the upper left part of a zero padded image batch, the same way as the generators do.
+
+    Args
+        image_group: List of the images.
+        buckets: Optional utils.buckets.ShapeBuckets the batch is padded to.
+    """
+    if buckets is not None:
+        return buckets.pad(image_group)
+    max_shape = tuple(max(image.shape[x] for image in image_group) for x in range(3))
+    batch_images = np.zeros((len(image_group),) + max_shape, dtype=keras.backend.floatx())
+    for image_index, image in enumerate(image_group):
+        batch_images[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+    if keras.backend.image_data_format() == 'channels_first':
+        batch_images = batch_images.transpose((0, 3, 1, 2))
+    return batch_images
+
+
+def predict_images(model, image_group, buckets=None):
+    """
+    Run the model on a batch of images padded like pad_images.
+
+    A utils.predictor.SessionPredictor copies the images into the input buffer it keeps for the batch shape instead of
+    allocating a new batch.
+
+    Args
+        model: The inference model or a utils.predictor.SessionPredictor of it.
+        image_group: List of the images.
+        buckets: Optional utils.buckets.ShapeBuckets the batch is padded to.
+
+    Returns
+        List of the numpy outputs of the model.
+    """
+    if not isinstance(model, SessionPredictor):
+        return model.predict_on_batch(pad_images(image_group, buckets=buckets))
+    shape = None
+    if buckets is not None:
+        shape = buckets.bucket(tuple(max(image.shape[x] for image in image_group) for x in range(2)))
+    return model.predict_images(image_group, shape=shape)
+
+
+def unpack_detections(boxes, scores, labels, scales, score_threshold=0.05):
+    """
+    Split the outputs of a batch into the detections of every image, in the original image coordinates.
+
+    Args
+        boxes: (B, max_detections, 4) boxes output by the model.
+        scores: (B, max_detections) scores output by the model, sorted in decreasing order.
+        labels: (B, max_detections) labels output by the model.
+        scales: List of the resizing scales of the images.
+        score_threshold: The score confidence threshold to use.
+
+    Returns
+        List of (image_boxes, image_scores, image_labels) of every image.
+    """
+    detections = []
+    for image_boxes, image_scores, image_labels, scale in zip(boxes, scores, labels, scales):
+        indices = np.where(image_scores > score_threshold)[0]
+        detections.append((image_boxes[indices] / scale, image_scores[indices], image_labels[indices]))
+    return detections
@@ -0,0 +1,79 @@
+import numpy as np
+
+from configure import MAX_NUM_GT_BOXES
+
+# level fed to LevelSelect for the gt boxes which need a fresh selection
+UNCACHED_LEVEL = -2
+
+
+class LevelCache(object):
+    """
+    Cache of the levels selected by LevelSelect, keyed by image index and box index.
+
+    The cache is empty during the warmup epochs, so every gt box is selected online. After that it is refreshed every
+    refresh_interval epochs (see callbacks.LevelCacheRefresh) and the generator feeds the cached levels to the model.
+    """
+
+    def __init__(self, refresh_interval=5, warmup_epochs=1):
+        """
+        Initialize the cache.
+
+        Args
+            refresh_interval: Number of epochs between two refreshes of the cache.
+            warmup_epochs: Number of epochs during which the levels are always selected online.
+        """
+        self.refresh_interval = refresh_interval
+        self.warmup_epochs = warmup_epochs
+        # image_index --> {box_index: level}
+        self.levels = {}
+
+    def should_refresh(self, epoch):
+        """
+        Whether the cache should be refreshed at the end of the given (zero based) epoch.
+        """
+        num_epochs = epoch + 1 - self.warmup_epochs
+        return num_epochs >= 0 and num_epochs % self.refresh_interval == 0
+
+    def lookup(self, group, batch_box_indices, max_num_gt_boxes=MAX_NUM_GT_BOXES):
+        """
+        Look up the cached levels of a batch.
+
+        Args
+            group: The image indices of the batch.
+            batch_box_indices: List of (n, ) arrays of the box indices of every image, in the order of the gt boxes.
+            max_num_gt_boxes: The padded number of gt boxes.
+
+        Returns
+            (B, max_num_gt_boxes) cached levels, UNCACHED_LEVEL for the boxes not in the cache and -1 for padding.
+        """
+        batch_levels = np.full((len(group), max_num_gt_boxes), -1, dtype=np.int32)
+        for index, (image_index, box_indices) in enumerate(zip(group, batch_box_indices)):
+            image_levels = self.levels.get(image_index, {})
+            batch_levels[index, :len(box_indices)] = [image_levels.get(box_index, UNCACHED_LEVEL)
+                                                      for box_index in box_indices]
+        return batch_levels
+
+    def update(self, group, batch_box_indices, batch_levels):
+        """
+        Store freshly selected levels.
+
+        Args
+            group: The image indices of the batch.
+            batch_box_indices: List of (n, ) arrays of the box indices of every image, in the order of the gt boxes.
+            batch_levels: (B, max_num_gt_boxes) levels selected by LevelSelect.
+
+        Returns
+            num_compared: The number of boxes which were already cached.
+            num_changed: The number of those boxes whose level changed.
+        """
+        num_compared = 0
+        num_changed = 0
+        for image_index, box_indices, levels in zip(group, batch_box_indices, batch_levels):
+            image_levels = self.levels.setdefault(image_index, {})
+            for box_index, level in zip(box_indices, levels[:len(box_indices)]):
+                level = int(level)
+                if box_index in image_levels:
+                    num_compared += 1
+                    num_changed += int(image_levels[box_index] != level)
+                image_levels[box_index] = level
+        return num_compared, num_changed
@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from configure import STRIDES
+from .anchors import guess_shapes
+from .fsaf import locations_for_shapes
+
+
+def non_max_suppression(boxes, scores, labels, iou_threshold=0.5, max_output_size=None):
+    """
+    Class specific greedy non maximum suppression.
+
+    Args
+        boxes: (n, 4) boxes in (x1, y1, x2, y2) format.
+        scores: (n, ) scores of the boxes.
+        labels: (n, ) labels of the boxes.
+        iou_threshold: The threshold on the intersection over union of two boxes of the same label.
+        max_output_size: Stop once this number of boxes is kept, None keeps all of them.
+
+    Returns
+        The indices of the kept boxes, in decreasing order of score.
+    """
+    # shift the boxes of every label apart so boxes of different labels never overlap
+    offsets = labels.astype(np.float32)[:, None] * (np.max(boxes) + 1) if boxes.shape[0] else 0
+    boxes = boxes + offsets
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores)
+    keep = []
+    while order.shape[0] > 0 and (max_output_size is None or len(keep) < max_output_size):
+        i = order[0]
+        keep.append(i)
+        others = order[1:]
+        iw = np.minimum(boxes[i, 2], boxes[others, 2]) - np.maximum(boxes[i, 0], boxes[others, 0])
+        ih = np.minimum(boxes[i, 3], boxes[others, 3]) - np.maximum(boxes[i, 1], boxes[others, 1])
+        intersection = np.maximum(iw, 0) * np.maximum(ih, 0)
+        iou = intersection / np.maximum(areas[i] + areas[others] - intersection, 1e-8)
+        order = others[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def level_top_k(scores, level_sizes, k):
+    """
+    NumPy counterpart of layers.level_top_k for one image.
+
+    Args
+        scores: (sum(level_sizes), ) best class score of every location.
+        level_sizes: The number of locations of every level.
+        k: The maximum number of locations to keep per level.
+
+    Returns
+        The indices of the selected locations.
+    """
+    indices = []
+    start = 0
+    for level_size in level_sizes:
+        if level_size > k:
+            indices.append(start + np.argpartition(-scores[start:start + level_size], k - 1)[:k])
+        else:
+            indices.append(np.arange(start, start + level_size))
+        start += level_size
+    return np.concatenate(indices, axis=0)
+
+
+def postprocess_detections(
+        batch_shape,
+        regression,
+        classification,
+        feature_shapes,
+        strides=STRIDES,
+        score_threshold=0.05,
+        pre_nms_top_k=1000,
+        nms_threshold=0.5,
+        max_detections=300,
+):
+    """
+    NumPy counterpart of the postprocessing of models.retinanet.fsaf_bbox: select the top-k locations of every level,
+    compute and clip their boxes, then apply the score threshold and the class specific NMS.
+
+    Args
+        batch_shape: The (B, height, width, ...) shape of the input batch.
+        regression: (B, sum(fh * fw), 4) raw regression output.
+        classification: (B, sum(fh * fw), num_classes) raw classification output.
+        feature_shapes: (num_levels, 2) (fh, fw) of every level.
+        strides: The strides mapping to the feature maps.
+        score_threshold: Threshold used to prefilter the boxes with.
+        pre_nms_top_k: Number of best scoring locations of every level to keep before NMS, None keeps all.
+        nms_threshold: Threshold for the IoU value to determine when a box should be suppressed.
+        max_detections: Maximum number of detections to keep.
+
+    Returns
+        [boxes (B, max_detections, 4), scores (B, max_detections), labels (B, max_detections)], padded with -1 like the
+        outputs of layers.FilterDetections.
+    """
+    locations, _ = locations_for_shapes(feature_shapes, strides)
+    level_sizes = [int(fh) * int(fw) for fh, fw in feature_shapes]
+    height, width = batch_shape[1:3]
+    batch_size = regression.shape[0]
+
+    all_boxes = np.full((batch_size, max_detections, 4), -1, dtype=np.float32)
+    all_scores = np.full((batch_size, max_detections), -1, dtype=np.float32)
+    all_labels = np.full((batch_size, max_detections), -1, dtype=np.int32)
+    for b in range(batch_size):
+        if pre_nms_top_k is not None:
+            indices = level_top_k(classification[b].max(axis=1), level_sizes, pre_nms_top_k)
+        else:
+            indices = np.arange(classification.shape[1])
+        image_regression = regression[b, indices] * np.float32(4.0)
+        image_locations = locations[indices]
+        boxes = np.stack([
+            np.clip(image_locations[:, 0] - image_regression[:, 0], 0, width),
+            np.clip(image_locations[:, 1] - image_regression[:, 1], 0, height),
+            np.clip(image_locations[:, 0] + image_regression[:, 2], 0, width),
+            np.clip(image_locations[:, 1] + image_regression[:, 3], 0, height),
+        ], axis=1)
+
+        candidates, labels = np.nonzero(classification[b, indices] > score_threshold)
+        scores = classification[b, indices][candidates, labels]
+        boxes = boxes[candidates]
+        keep = non_max_suppression(boxes, scores, labels, iou_threshold=nms_threshold, max_output_size=max_detections)
+        all_boxes[b, :keep.shape[0]] = boxes[keep]
+        all_scores[b, :keep.shape[0]] = scores[keep]
+        all_labels[b, :keep.shape[0]] = labels[keep]
+    return [all_boxes, all_scores, all_labels]
+
+
+class HostPostprocessor(object):
+    """
+    Run the raw model (see models.retinanet.fsaf_raw) and postprocess its outputs with NumPy in worker threads, so the
+    postprocessing of a batch overlaps with the forward pass of the next one.
+    """
+
+    def __init__(
+            self,
+            model,
+            strides=STRIDES,
+            score_threshold=0.05,
+            pre_nms_top_k=1000,
+            nms_threshold=0.5,
+            max_detections=300,
+            workers=1,
+            compute_shapes=guess_shapes,
+    ):
+        """
+        Initialize the postprocessor.
+
+        Args
+            model: A model which takes an image batch as input and outputs [regression, classification].
+            strides: The strides mapping to the feature maps.
+            score_threshold: Threshold used to prefilter the boxes with.
+            pre_nms_top_k: Number of best scoring locations of every level to keep before NMS, None keeps all.
+            nms_threshold: Threshold for the IoU value to determine when a box should be suppressed.
+            max_detections: Maximum number of detections to keep.
+            workers: Number of postprocessing threads.
+            compute_shapes: Function computing the feature shapes from the image shape and the pyramid levels.
+        """
+        self.model = model
+        self.strides = strides
+        self.score_threshold = score_threshold
+        self.pre_nms_top_k = pre_nms_top_k
+        self.nms_threshold = nms_threshold
+        self.max_detections = max_detections
+        self.compute_shapes = compute_shapes
+        self.pyramid_levels = [int(np.log2(stride)) for stride in strides]
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def postprocess(self, batch_shape, regression, classification):
+        feature_shapes = self.compute_shapes(batch_shape[1:3], self.pyramid_levels)
+        return postprocess_detections(
+            batch_shape,
+            regression,
+            classification,
+            feature_shapes,
+            strides=self.strides,
+            score_threshold=self.score_threshold,
+            pre_nms_top_k=self.pre_nms_top_k,
+            nms_threshold=self.nms_threshold,
+            max_detections=self.max_detections,
+        )
+
+    def submit(self, batch_images):
+        """
+        Run the model on a batch and submit its postprocessing.
+
+        Returns
+            A concurrent.futures.Future of [boxes, scores, labels], like the outputs of models.retinanet.fsaf_bbox.
+        """
+        regression, classification = self.model.predict_on_batch(batch_images)[:2]
+        return self.executor.submit(self.postprocess, batch_images.shape, regression, classification)
+
+    def predict_on_batch(self, batch_images):
+        """
+        Run the model on a batch and postprocess it, without pipelining.
+        """
+        return self.submit(batch_images).result()
@@ -0,0 +1,86 @@
+import collections
+
+import keras
+import keras.backend as K
+import numpy as np
+
+
+class SessionPredictor(object):
+    """
+    Run a keras model through a callable of its session with fixed fetches.
+
+    keras.models.Model.predict_on_batch standardizes its inputs and builds a feed dict on every call, the callable
+    skips both. The predictor has the same predict_on_batch method, so it can replace the model wherever only the
+    predictions are needed (e.g. utils.eval.evaluate, utils.batching.DynamicBatcher).
+    """
+
+    def __init__(self, model, session=None, max_buffers=8):
+        """
+        Build the callable.
+
+        Args
+            model: A keras model with a single input, e.g. the output of models.retinanet.fsaf_bbox or the prediction
+                model of yolo.model.yolo_body.
+            session: The session holding the variables of the model, the keras session by default.
+            max_buffers: The maximum number of input buffers kept by predict_images, the least recently used one is
+                dropped first.
+        """
+        assert len(model.inputs) == 1, 'SessionPredictor only supports models with a single input.'
+        self.model = model
+        self.session = session or K.get_session()
+        feed_list = [model.inputs[0]]
+        self.uses_learning_phase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        if self.uses_learning_phase:
+            feed_list.append(K.learning_phase())
+        self.callable = self.session.make_callable(model.outputs, feed_list=feed_list)
+        # padded input batches by shape, reused by predict_images, least recently used first
+        self.buffers = collections.OrderedDict()
+        self.max_buffers = max_buffers
+
+    def predict_on_batch(self, batch_images):
+        """
+        Run the model on a batch of images.
+
+        Returns
+            List of the numpy outputs of the model.
+        """
+        if self.uses_learning_phase:
+            return self.callable(batch_images, 0)
+        return self.callable(batch_images)
+
+    __call__ = predict_on_batch
+
+    def predict_images(self, image_group, shape=None):
+        """
+        Copy the images to the upper left part of a reused zero padded input buffer and run the model on it.
+
+        One buffer is kept per batch shape for the max_buffers most recent shapes, so the buffers are only reused when
+        the images come in a few shapes, e.g. from utils.buckets. Only the padding around the images is zeroed.
+
+        Args
+            image_group: List of (h, w, c) images.
+            shape: Optional (height, width) of the buffer, e.g. a shape bucket, the shape of the largest image by
+                default.
+
+        Returns
+            List of the numpy outputs of the model.
+        """
+        max_shape = tuple(max(image.shape[x] for image in image_group) for x in range(3))
+        if shape is not None:
+            max_shape = tuple(shape[:2]) + max_shape[2:]
+        key = (len(image_group),) + max_shape
+        batch_images = self.buffers.pop(key, None)
+        if batch_images is None:
+            batch_images = np.empty(key, dtype=keras.backend.floatx())
+        self.buffers[key] = batch_images
+        while len(self.buffers) > self.max_buffers:
+            self.buffers.popitem(last=False)
+        for image_index, image in enumerate(image_group):
+            height, width, channels = image.shape
+            batch_images[image_index, :height, :width, :channels] = image
+            batch_images[image_index, :height, :width, channels:] = 0
+            batch_images[image_index, :height, width:] = 0
+            batch_images[image_index, height:] = 0
+        if keras.backend.image_data_format() == 'channels_first':
+            return self.predict_on_batch(batch_images.transpose((0, 3, 1, 2)))
+        return self.predict_on_batch(batch_images)
@@ -0,0 +1,120 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import numpy as np
+
+# upper edges in milliseconds of the histogram buckets, the last bucket holds everything above
+HISTOGRAM_EDGES_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyRecorder(object):
+    """
+    Thread safe recorder of the latencies of the stages of the inference, e.g. decode, preprocess, resize, forward,
+    postprocess and serialize.
+
+    Every stage keeps a histogram of all its latencies and the most recent ones, the percentiles are computed on the
+    latter.
+    """
+
+    def __init__(self, max_samples=10000, enabled=True):
+        """
+        Initialize the recorder.
+
+        Args
+            max_samples: The number of recent latencies of every stage the percentiles are computed on.
+            enabled: If False, nothing is recorded.
+        """
+        self.max_samples = max_samples
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.max_samples))
+        self.histograms = collections.defaultdict(lambda: np.zeros((len(HISTOGRAM_EDGES_MS) + 1,), dtype=np.int64))
+        self.totals = collections.Counter()
+
+    def record(self, name, seconds):
+        """
+        Record a latency of a stage in seconds.
+        """
+        if not self.enabled:
+            return
+        milliseconds = seconds * 1000.
+        with self.lock:
+            self.samples[name].append(milliseconds)
+            self.histograms[name][np.searchsorted(HISTOGRAM_EDGES_MS, milliseconds)] += 1
+            self.totals[name] += milliseconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager recording the time spent in its block as a latency of a stage.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def summary(self):
+        """
+        Returns
+            A dict mapping every stage to its count, mean, p50, p90 and p99 in milliseconds and its histogram, a dict
+            mapping the upper edge of every bucket to its count.
+        """
+        summary = {}
+        with self.lock:
+            for name, samples in self.samples.items():
+                count = int(self.histograms[name].sum())
+                p50, p90, p99 = np.percentile(np.array(samples), [50, 90, 99])
+                histogram = collections.OrderedDict(
+                    ('{:g}'.format(edge), int(bucket_count)) for edge, bucket_count in
+                    zip(HISTOGRAM_EDGES_MS + (float('inf'),), self.histograms[name]) if bucket_count)
+                summary[name] = {
+                    'count': count,
+                    'mean_ms': self.totals[name] / count,
+                    'p50_ms': float(p50),
+                    'p90_ms': float(p90),
+                    'p99_ms': float(p99),
+                    'histogram_ms': histogram,
+                }
+        return summary
+
+    def dump(self, path):
+        """
+        Write the summary as json.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def format(self):
+        """
+        Returns
+            The percentiles of every stage as text, one line per stage.
+        """
+        return '\n'.join('{:<12} n={:<7d} p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms'.format(
+            name, stage['count'], stage['p50_ms'], stage['p90_ms'], stage['p99_ms'])
+            for name, stage in sorted(self.summary().items()))
+
+
+# default of the functions taking an optional recorder
+NULL_RECORDER = LatencyRecorder(enabled=False)
+
+
+def memory_usage():
+    """
+    Read the resident memory of the current process from /proc/self/status (Linux only).
+
+    Returns
+        A dict with the rss, its private anonymous part, its file backed part and its shared memory part, in bytes.
+    """
+    fields = {'VmRSS': 'rss', 'RssAnon': 'rss_anon', 'RssFile': 'rss_file', 'RssShmem': 'rss_shmem'}
+    usage = dict.fromkeys(fields.values(), 0)
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in fields:
+                # the values are in kB
+                usage[fields[name]] = int(value.split()[0]) * 1024
+    return usage
@@ -0,0 +1,113 @@
+import collections
+import threading
+
+
+def make_rungs(min_sides=(800, 640, 512), min_side=800, max_side=1333):
+    """
+    Build the (min_side, max_side) rungs of a resolution ladder, the max side of every rung keeps the ratio of
+    max_side to min_side.
+
+    Args
+        min_sides: The min sides of the rungs, from the highest resolution to the lowest.
+        min_side: The min side of the full resolution.
+        max_side: The max side of the full resolution.
+    """
+    return [(rung_min_side, int(round(rung_min_side * float(max_side) / min_side))) for rung_min_side in min_sides]
+
+
+class ResolutionLadder(object):
+    """
+    Select the input resolution of the next images from a ladder of (min_side, max_side) rungs, based on the expected
+    latency of a request relative to a deadline.
+
+    The expected latency is a moving average of the time the batches waited in the queue plus the time they took to
+    run. When it rises over high_water * deadline the ladder steps down to a lower resolution, when it falls under
+    low_water * deadline it steps back up. After a step the ladder waits for patience batches, so the averages reflect
+    the new resolution before the next step.
+    """
+
+    def __init__(self, deadline, rungs=None, high_water=0.8, low_water=0.5, smoothing=0.2, patience=4):
+        """
+        Initialize the ladder at its highest resolution.
+
+        Args
+            deadline: The latency target of a request in seconds.
+            rungs: List of (min_side, max_side), from the highest resolution to the lowest, make_rungs() by default.
+            high_water: Fraction of the deadline over which the resolution is lowered.
+            low_water: Fraction of the deadline under which the resolution is raised.
+            smoothing: Weight of the latest batch in the moving averages.
+            patience: Minimum number of batches between two steps.
+        """
+        assert low_water < high_water, 'low_water must be lower than high_water.'
+        self.deadline = deadline
+        self.rungs = [tuple(rung) for rung in (rungs or make_rungs())]
+        self.high_water = high_water
+        self.low_water = low_water
+        self.smoothing = smoothing
+        self.patience = patience
+
+        self.lock = threading.Lock()
+        self.index = 0
+        self.queue_latency = None
+        self.batch_latency = None
+        self.num_switches = 0
+        self.batches_since_switch = 0
+        self.counts = collections.Counter()
+
+    def select(self):
+        """
+        Returns
+            The (min_side, max_side) to resize the next image with.
+        """
+        with self.lock:
+            rung = self.rungs[self.index]
+            self.counts[rung] += 1
+            return rung
+
+    def expected_latency(self):
+        if self.queue_latency is None:
+            return 0.
+        return self.queue_latency + self.batch_latency
+
+    def update(self, queue_latency, batch_latency):
+        """
+        Update the moving averages with a batch and move along the ladder if needed.
+
+        Args
+            queue_latency: The number of seconds the oldest image of the batch waited before the batch ran.
+            batch_latency: The number of seconds the batch took to run.
+        """
+        with self.lock:
+            if self.queue_latency is None:
+                self.queue_latency, self.batch_latency = queue_latency, batch_latency
+            else:
+                self.queue_latency += self.smoothing * (queue_latency - self.queue_latency)
+                self.batch_latency += self.smoothing * (batch_latency - self.batch_latency)
+
+            self.batches_since_switch += 1
+            if self.batches_since_switch < self.patience:
+                return
+            latency = self.expected_latency()
+            if latency > self.high_water * self.deadline and self.index + 1 < len(self.rungs):
+                self.index += 1
+            elif latency < self.low_water * self.deadline and self.index > 0:
+                self.index -= 1
+            else:
+                return
+            self.num_switches += 1
+            self.batches_since_switch = 0
+
+    def report(self):
+        """
+        Returns
+            A dict with the current rung, the expected latency and the number of images resized with every rung.
+        """
+        with self.lock:
+            return {
+                'rung': list(self.rungs[self.index]),
+                'expected_latency_ms': self.expected_latency() * 1000.,
+                'deadline_ms': self.deadline * 1000.,
+                'num_switches': self.num_switches,
+                'counts': collections.OrderedDict(
+                    ('{}x{}'.format(*rung), self.counts[rung]) for rung in self.rungs),
+            }
@@ -0,0 +1,234 @@
+import collections
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+def file_identity(path):
+    """
+    Compute the identity of a weights file, the sha1 of its content.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class DetectionCache(object):
+    """
+    Cache of the detections of images, keyed by the hash of the encoded image, the weights and the parameters of the
+    detections.
+
+    The cache has an in-memory LRU tier and an optional on-disk tier, whose least recently used entries are evicted
+    when it grows over max_disk_bytes.
+
+    The identity of the weights is the one of the weights the model was loaded from, computed once by the caller. If
+    the weights file changes on disk afterwards, the model no longer matches it, so the cache stops looking up and
+    storing detections instead of switching to the identity of weights the model does not run.
+
+    The files of the on-disk tier are read, written and removed outside of the lock, which only guards the indices of
+    the tiers, so a lookup never waits for the file I/O of another request.
+    """
+
+    def __init__(
+            self,
+            identity,
+            snapshot=None,
+            score_threshold=0.05,
+            max_detections=300,
+            capacity=1024,
+            cache_dir=None,
+            max_disk_bytes=1 << 30,
+    ):
+        """
+        Initialize the cache.
+
+        Args
+            identity: The identity of the weights the model was loaded from, see file_identity.
+            snapshot: Optional path to the weights file of the model, checked on every lookup.
+            score_threshold: The score confidence threshold of the detections.
+            max_detections: The maximum number of detections of an image.
+            capacity: The maximum number of entries of the in-memory tier.
+            cache_dir: Optional directory of the on-disk tier.
+            max_disk_bytes: The maximum size of the on-disk tier in bytes.
+        """
+        self.identity = identity.encode('utf-8')
+        self.snapshot = snapshot
+        self.params = '{}:{}'.format(score_threshold, max_detections).encode('utf-8')
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        # key --> size in bytes of the on-disk entries, least recently used first
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        # keys whose on-disk entry is being written
+        self.writing = set()
+        self.stats = collections.Counter()
+
+        self.snapshot_stat = self._snapshot_stat()
+        self.stale = False
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.npz')]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self.disk[entry.name[:-len('.npz')]] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+            self._remove_disk_entries(self._evict_disk())
+
+    def _snapshot_stat(self):
+        if self.snapshot is None:
+            return None
+        try:
+            stat = os.stat(self.snapshot)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _check_snapshot(self):
+        if self.stale or self.snapshot is None:
+            return
+        if self._snapshot_stat() != self.snapshot_stat:
+            # the weights file changed under the running model, reload the model to cache again
+            self.stale = True
+            self.memory.clear()
+
+    def key(self, image_bytes, resolution=(800, 1333)):
+        """
+        Compute the key of an encoded image, once per request, so its lookup and its store use the same key.
+
+        Args
+            image_bytes: The encoded image.
+            resolution: The (min_side, max_side) the image is resized with.
+        """
+        sha1 = hashlib.sha1(image_bytes)
+        sha1.update(self.identity)
+        sha1.update(self.params)
+        sha1.update('{}x{}'.format(*resolution).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _evict_disk(self):
+        """
+        Drop the least recently used entries from the on-disk index, called with the lock held.
+
+        Returns
+            The keys of the evicted entries, whose files are removed by _remove_disk_entries without the lock.
+        """
+        evicted = []
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def _remove_disk_entries(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        """
+        Look up the detections of a key.
+
+        Returns
+            The cached (boxes, scores, labels) or None.
+        """
+        with self.lock:
+            self._check_snapshot()
+            if self.stale:
+                self.stats['bypassed'] += 1
+                return None
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+            if key not in self.disk:
+                self.stats['misses'] += 1
+                return None
+
+        try:
+            with np.load(self._disk_path(key)) as entry:
+                detections = (entry['boxes'], entry['scores'], entry['labels'])
+            # the modification times order the entries when the cache is reopened
+            os.utime(self._disk_path(key))
+        except (OSError, KeyError, ValueError):
+            # the entry was evicted or is corrupted
+            with self.lock:
+                if key in self.disk:
+                    self.disk_bytes -= self.disk.pop(key)
+                self.stats['misses'] += 1
+            return None
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            self._put_memory(key, detections)
+            self.stats['disk_hits'] += 1
+        return detections
+
+    def _put_memory(self, key, detections):
+        self.memory[key] = detections
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def put(self, key, detections):
+        """
+        Store the (boxes, scores, labels) detections of a key.
+        """
+        with self.lock:
+            if self.stale:
+                return
+            self._put_memory(key, detections)
+            if self.cache_dir is None or key in self.disk or key in self.writing:
+                return
+            self.writing.add(key)
+
+        try:
+            boxes, scores, labels = detections
+            path = self._disk_path(key)
+            # write to a temporary file first, so a concurrent reader never sees a partial entry
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, boxes=boxes, scores=scores, labels=labels)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        finally:
+            with self.lock:
+                self.writing.discard(key)
+
+        with self.lock:
+            self.disk[key] = size
+            self.disk_bytes += size
+            evicted = self._evict_disk()
+        self._remove_disk_entries(evicted)
+
+    def statistics(self):
+        """
+        Returns
+            A dict with the hit, miss and bypass counts, whether the weights file changed under the model and the sizes
+            of the tiers.
+        """
+        with self.lock:
+            lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+            return {
+                'memory_hits': self.stats['memory_hits'],
+                'disk_hits': self.stats['disk_hits'],
+                'misses': self.stats['misses'],
+                'hit_rate': (lookups - self.stats['misses']) / float(max(lookups, 1)),
+                'bypassed': self.stats['bypassed'],
+                'stale': self.stale,
+                'memory_entries': len(self.memory),
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+            }
@@ -0,0 +1,124 @@
+import numpy as np
+
+from .inference import pad_images
+from .postprocess import non_max_suppression
+from .profiling import NULL_RECORDER
+
+
+def tile_offsets(size, tile_size, overlap):
+    """
+    Compute the offsets of overlapping tiles along one axis, the last tile ends at the border of the image.
+
+    Args
+        size: The size of the image along the axis.
+        tile_size: The size of a tile.
+        overlap: The number of pixels shared by two neighbouring tiles.
+
+    Returns
+        List of the offsets of the tiles.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError('The overlap ({}) must be non negative and smaller than the tile size ({}).'.format(
+            overlap, tile_size))
+    if size <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    offsets = list(range(0, size - tile_size, step))
+    offsets.append(size - tile_size)
+    return offsets
+
+
+def cut_by_tile(boxes, tile_x, tile_y, tile_width, tile_height, width, height, overlap, margin=1.):
+    """
+    Find the boxes which are cut by an inner border of their tile and lie in the part shared with the neighbouring
+    tile, so the neighbouring tile sees the whole object.
+
+    Args
+        boxes: (n, 4) boxes in the coordinates of the tile.
+        tile_x, tile_y: The offset of the tile in the image.
+        tile_width, tile_height: The size of the tile.
+        width, height: The size of the image.
+        overlap: The number of pixels shared by two neighbouring tiles.
+        margin: The distance in pixels to a border under which a box is considered cut.
+
+    Returns
+        (n, ) boolean mask of the boxes to drop.
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    cut = np.zeros((boxes.shape[0],), dtype=bool)
+    if tile_x > 0:
+        cut |= (x1 <= margin) & (x2 <= overlap)
+    if tile_x + tile_width < width:
+        cut |= (x2 >= tile_width - margin) & (x1 >= tile_width - overlap)
+    if tile_y > 0:
+        cut |= (y1 <= margin) & (y2 <= overlap)
+    if tile_y + tile_height < height:
+        cut |= (y2 >= tile_height - margin) & (y1 >= tile_height - overlap)
+    return cut
+
+
+def detect_tiled(
+        model,
+        image,
+        preprocess_image,
+        tile_size=1024,
+        overlap=128,
+        batch_size=4,
+        score_threshold=0.05,
+        nms_threshold=0.5,
+        max_detections=1000,
+        max_tile_detections=300,
+        recorder=NULL_RECORDER,
+):
+    """
+    Run a model over overlapping tiles of a large image at full resolution.
+
+    Only the tiles of one batch are preprocessed at a time, so the memory besides the image itself is bounded by
+    batch_size * tile_size * tile_size. The boxes cut by a tile border which the neighbouring tile sees whole are
+    dropped, only the max_tile_detections best remaining boxes of every tile are merged with a class specific NMS,
+    which stops after max_detections boxes, so the merge is bounded by the number of tiles rather than by the number
+    of detections.
+
+    Args
+        model: A model which takes an image batch as input and outputs [boxes, scores, labels].
+        image: The (h, w, 3) BGR image.
+        preprocess_image: The preprocessing function of the backbone.
+        tile_size: The size of the square tiles.
+        overlap: The number of pixels shared by two neighbouring tiles, should be larger than the objects to detect.
+        batch_size: The number of tiles of a batch.
+        score_threshold: The score confidence threshold to use.
+        nms_threshold: The threshold of the non maximum suppression merging the detections of all tiles.
+        max_detections: The maximum number of detections of the image.
+        max_tile_detections: The maximum number of detections of a tile which are merged.
+        recorder: utils.profiling.LatencyRecorder of the preprocess, forward and postprocess stages.
+
+    Returns
+        (boxes, scores, labels) of the image, sorted by decreasing score.
+    """
+    height, width = image.shape[:2]
+    # tile_offsets raises on an overlap which is not smaller than the tile size
+    offsets = [(y, x) for y in tile_offsets(height, tile_size, overlap) for x in tile_offsets(width, tile_size, overlap)]
+
+    all_boxes = []
+    all_scores = []
+    all_labels = []
+    for i in range(0, len(offsets), batch_size):
+        batch_offsets = offsets[i:i + batch_size]
+        with recorder.stage('preprocess'):
+            tiles = [preprocess_image(image[y:y + tile_size, x:x + tile_size]) for y, x in batch_offsets]
+        with recorder.stage('forward'):
+            boxes, scores, labels = model.predict_on_batch(pad_images(tiles))[:3]
+        for (y, x), tile, tile_boxes, tile_scores, tile_labels in zip(batch_offsets, tiles, boxes, scores, labels):
+            cut = cut_by_tile(tile_boxes, x, y, tile.shape[1], tile.shape[0], width, height, overlap)
+            indices = np.where((tile_scores > score_threshold) & ~cut)[0]
+            indices = indices[np.argsort(-tile_scores[indices], kind='stable')[:max_tile_detections]]
+            all_boxes.append(tile_boxes[indices] + np.array([x, y, x, y], dtype=tile_boxes.dtype))
+            all_scores.append(tile_scores[indices])
+            all_labels.append(tile_labels[indices])
+
+    with recorder.stage('postprocess'):
+        boxes = np.concatenate(all_boxes, axis=0)
+        scores = np.concatenate(all_scores, axis=0)
+        labels = np.concatenate(all_labels, axis=0)
+        keep = non_max_suppression(boxes, scores, labels, iou_threshold=nms_threshold, max_output_size=max_detections)
+    return boxes[keep], scores[keep], labels[keep]
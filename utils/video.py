@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from .image import resize_image
+from .inference import pad_images, unpack_detections
+
+
+class VideoDetector(object):
+    """
+    Run a model over the frames of a video.
+
+    A decode thread reads, preprocesses and resizes the frames into a bounded queue while the model runs on batches of
+    frames. Optionally the decode thread skips frames when the model falls behind (adaptive_stride) and reuses the
+    detections of the previous frame for frames which barely changed (static_threshold).
+    """
+
+    def __init__(
+            self,
+            model,
+            preprocess_image,
+            batch_size=4,
+            queue_size=16,
+            min_side=800,
+            max_side=1333,
+            score_threshold=0.05,
+            adaptive_stride=False,
+            max_stride=8,
+            static_threshold=None,
+    ):
+        """
+        Initialize the detector.
+
+        Args
+            model: A model which takes an image batch as input and outputs [boxes, scores, labels].
+            preprocess_image: The preprocessing function of the backbone.
+            batch_size: The number of frames of a batch.
+            queue_size: The maximum number of decoded frames waiting for the model.
+            min_side: The image's min side will be equal to min_side after resizing.
+            max_side: If after resizing the image's max side is above max_side, resize until the max side is equal to max_side.
+            score_threshold: The score confidence threshold to use.
+            adaptive_stride: Whether to double the frame stride when the queue is full and halve it when the queue is
+                nearly empty.
+            max_stride: The maximum frame stride.
+            static_threshold: If given, a frame whose mean absolute pixel change (in [0, 1], on a small grayscale
+                thumbnail) to the last detected frame is below it is not run through the model.
+        """
+        self.model = model
+        self.preprocess_image = preprocess_image
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.min_side = min_side
+        self.max_side = max_side
+        self.score_threshold = score_threshold
+        self.adaptive_stride = adaptive_stride
+        self.max_stride = max_stride
+        self.static_threshold = static_threshold
+        self.stats = {}
+
+    @staticmethod
+    def thumbnail(frame):
+        return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 64), interpolation=cv2.INTER_AREA).astype(
+            np.float32) / 255.
+
+    def _decode(self, capture, frames, stop):
+        stride = 1
+        frame_index = -1
+        last_thumbnail = None
+        while not stop.is_set():
+            # grab the skipped frames without decoding them
+            grabbed = True
+            for _ in range(stride - 1):
+                grabbed = capture.grab()
+                if not grabbed:
+                    break
+                frame_index += 1
+                self.stats['num_skipped'] += 1
+            if grabbed:
+                grabbed, frame = capture.read()
+            if not grabbed:
+                self.stats['num_frames'] = frame_index + 1
+                break
+            frame_index += 1
+            self.stats['num_frames'] = frame_index + 1
+
+            if self.static_threshold is not None:
+                thumbnail = self.thumbnail(frame)
+                if last_thumbnail is not None and np.mean(np.abs(thumbnail - last_thumbnail)) < self.static_threshold:
+                    self.stats['num_static'] += 1
+                    frames.put((frame_index, None, None))
+                    continue
+                last_thumbnail = thumbnail
+
+            image = self.preprocess_image(frame)
+            image, scale = resize_image(image, min_side=self.min_side, max_side=self.max_side)
+
+            if self.adaptive_stride:
+                if frames.full():
+                    stride = min(stride * 2, self.max_stride)
+                elif frames.qsize() <= self.queue_size // 4:
+                    stride = max(stride // 2, 1)
+                self.stats['stride'] = stride
+            frames.put((frame_index, image, scale))
+        frames.put(None)
+
+    def _predict(self, batch, last_detections):
+        image_group = [image for _, image, _ in batch if image is not None]
+        if image_group:
+            boxes, scores, labels = self.model.predict_on_batch(pad_images(image_group))[:3]
+            detections = iter(unpack_detections(boxes, scores, labels,
+                                                [scale for _, image, scale in batch if image is not None],
+                                                score_threshold=self.score_threshold))
+        for frame_index, image, _ in batch:
+            if image is not None:
+                last_detections = next(detections)
+            yield frame_index, last_detections, image is None
+
+    def detect(self, video_path):
+        """
+        Run the model over a video.
+
+        Args
+            video_path: Path of a video file readable by OpenCV.
+
+        Returns
+            A generator of (frame_index, (boxes, scores, labels), static) of the detected frames, static is True for
+            the frames which reuse the detections of the previous frame. self.stats holds the number of frames,
+            skipped frames, static frames and the frames per second.
+        """
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise ValueError('Could not open video {}.'.format(video_path))
+        self.stats = {'num_frames': 0, 'num_skipped': 0, 'num_static': 0, 'stride': 1, 'fps': 0.}
+
+        frames = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        decode_thread = threading.Thread(target=self._decode, args=(capture, frames, stop), daemon=True)
+        decode_thread.start()
+
+        start = time.time()
+        last_detections = (np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32),
+                           np.zeros((0,), dtype=np.int32))
+        batch = []
+        try:
+            while True:
+                item = frames.get()
+                if item is not None:
+                    batch.append(item)
+                # static frames wait in the batch, so they are emitted in order
+                if item is None or sum(image is not None for _, image, _ in batch) == self.batch_size:
+                    for frame_index, detections, static in self._predict(batch, last_detections):
+                        last_detections = detections
+                        yield frame_index, detections, static
+                    batch = []
+                    self.stats['fps'] = self.stats['num_frames'] / (time.time() - start)
+                if item is None:
+                    break
+        finally:
+            stop.set()
+            # unblock the decode thread
+            while decode_thread.is_alive():
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    decode_thread.join(0.01)
+            capture.release()
@@ -46,7 +46,7 @@ keras.backend.set_session(get_session())
 
 model_path = 'pascal_18_6.4112_6.5125_0.8319_0.8358.h5'
 
-model, prediction_model = yolo_body(num_classes=20)
+model, prediction_model = yolo_body(num_classes=20, image_shapes=((416, 416),))
 
 prediction_model.load_weights(model_path, by_name=True)
 
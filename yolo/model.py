@@ -4,10 +4,11 @@ from keras.regularizers import l2
 from keras.models import Model
 from functools import reduce
 
-from layers import FilterDetections, ClipBoxes
-from losses import focal_with_mask, iou_with_mask
+from layers import FilterDetections, ClipBoxes, LevelTopK, TopKRegressBoxes
+from losses import focal_with_mask, iou_with_mask, focal_with_labels, iou_with_labels
+from utils.anchors import guess_shapes
 from yolo import config
-from yolo.fsaf_layers import FSAFTarget, LevelSelect, Locations, RegressBoxes
+from yolo.fsaf_layers import FSAFTarget, LevelSelect, HeuristicLevelSelect, Locations, RegressBoxes
 
 
 def compose(*funcs):
@@ -87,13 +88,20 @@ def make_last_layers(x, num_filters, out_filters):
     return x, y
 
 
-def yolo_body(num_classes=20, score_threshold=0.01):
+def yolo_body(num_classes=20, score_threshold=0.01, sparse_targets=False, level_select='online', pre_nms_top_k=1000,
+              fused_postprocess=True, image_shapes=None):
     """
     Create YOLO_V3 model CNN body in Keras.
 
     Args:
         num_classes:
         score_threshold:
+        sparse_targets: If True, train on the per location class labels and the positive regression targets only.
+        level_select: 'online' selects the level of the gt boxes by their losses, 'heuristic' by their size.
+        pre_nms_top_k: Number of best scoring locations of every level to keep before NMS, None keeps all.
+        fused_postprocess: If True and pre_nms_top_k is given, only compute the boxes of the top-k locations.
+        image_shapes: Optional list of known (height, width) of the input images, e.g. ((416, 416), ), the locations
+            of those shapes are precomputed instead of being rebuilt on every forward pass.
 
     Returns:
 
@@ -122,21 +130,40 @@ def yolo_body(num_classes=20, score_threshold=0.01):
 
     gt_boxes_input = Input(shape=(config.MAX_NUM_GT_BOXES, 5), name='gt_boxes_input')
     grid_shapes_input = Input((len(config.STRIDES), 2), dtype='int32', name='grid_shapes_input')
-    batch_gt_box_levels = LevelSelect(name='level_select')(
+    if level_select == 'online':
+        level_select_layer = LevelSelect(name='level_select')
+    elif level_select == 'heuristic':
+        level_select_layer = HeuristicLevelSelect(name='level_select')
+    else:
+        raise ValueError('Level select (\'{}\') is invalid.'.format(level_select))
+    batch_gt_box_levels = level_select_layer(
         [batch_cls_pred, batch_regr_pred, grid_shapes_input, gt_boxes_input])
-    batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask = FSAFTarget(
-        num_classes=num_classes,
-        name='fsaf_target')(
-        [batch_gt_box_levels, grid_shapes_input, gt_boxes_input])
-    focal_loss_graph = focal_with_mask()
-    iou_loss_graph = iou_with_mask()
-    cls_loss = Lambda(focal_loss_graph,
-                      output_shape=(1,),
-                      name="cls_loss")(
-        [batch_cls_target, batch_cls_pred, batch_cls_mask, batch_cls_num_pos])
-    regr_loss = Lambda(iou_loss_graph,
-                       output_shape=(1,),
-                       name="regr_loss")([batch_regr_target, batch_regr_pred, batch_regr_mask])
+    if sparse_targets:
+        batch_cls_labels, batch_regr_target = FSAFTarget(
+            num_classes=num_classes,
+            sparse=True,
+            name='fsaf_target')(
+            [batch_gt_box_levels, grid_shapes_input, gt_boxes_input])
+        cls_loss = Lambda(focal_with_labels(),
+                          output_shape=(1,),
+                          name="cls_loss")([batch_cls_labels, batch_cls_pred])
+        regr_loss = Lambda(iou_with_labels(),
+                           output_shape=(1,),
+                           name="regr_loss")([batch_regr_target, batch_regr_pred, batch_cls_labels])
+    else:
+        batch_cls_target, batch_cls_mask, batch_cls_num_pos, batch_regr_target, batch_regr_mask = FSAFTarget(
+            num_classes=num_classes,
+            name='fsaf_target')(
+            [batch_gt_box_levels, grid_shapes_input, gt_boxes_input])
+        focal_loss_graph = focal_with_mask()
+        iou_loss_graph = iou_with_mask()
+        cls_loss = Lambda(focal_loss_graph,
+                          output_shape=(1,),
+                          name="cls_loss")(
+            [batch_cls_target, batch_cls_pred, batch_cls_mask, batch_cls_num_pos])
+        regr_loss = Lambda(iou_loss_graph,
+                           output_shape=(1,),
+                           name="regr_loss")([batch_regr_target, batch_regr_pred, batch_regr_mask])
     model = Model(inputs=[image_input, gt_boxes_input, grid_shapes_input],
                   outputs=[cls_loss, regr_loss],
                   name='fsaf')
@@ -144,11 +171,25 @@ def yolo_body(num_classes=20, score_threshold=0.01):
     # compute the anchors
     features = [y1, y2, y3]
 
-    locations, strides = Locations(strides=config.STRIDES)(features)
+    feature_shapes = None
+    if image_shapes is not None:
+        # in the order of the features, y1 is downsampled by 32
+        feature_shapes = [[[int(size) for size in shape] for shape in guess_shapes(image_shape, (5, 4, 3))]
+                          for image_shape in image_shapes]
+
+    if pre_nms_top_k is not None and fused_postprocess:
+        # only compute the boxes of the top-k locations of every level
+        boxes, batch_cls_pred = TopKRegressBoxes(strides=config.STRIDES, k=pre_nms_top_k,
+                                                 feature_shapes=feature_shapes, name='top_k_boxes')(
+            [image_input, batch_regr_pred, batch_cls_pred] + features)
+    else:
+        locations, strides = Locations(strides=config.STRIDES, feature_shapes=feature_shapes)(features)
 
-    # apply predicted regression to anchors
-    boxes = RegressBoxes(name='boxes')([locations, strides, batch_regr_pred])
-    boxes = ClipBoxes(name='clipped_boxes')([image_input, boxes])
+        # apply predicted regression to anchors
+        boxes = RegressBoxes(name='boxes')([locations, strides, batch_regr_pred])
+        boxes = ClipBoxes(name='clipped_boxes')([image_input, boxes])
+        if pre_nms_top_k is not None:
+            boxes, batch_cls_pred = LevelTopK(k=pre_nms_top_k, name='level_top_k')([boxes, batch_cls_pred] + features)
 
     # filter detections (apply NMS / score threshold / select top-k)
     detections = FilterDetections(
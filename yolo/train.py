@@ -265,6 +265,11 @@ def parse_args(args):
     parser.add_argument('--random-transform', help='Randomly transform image and annotations.', action='store_true')
     parser.add_argument('--image-size', help='Rescale the image so the smallest side is min_side.', type=int, default=416)
     parser.add_argument('--multi-scale', help='Multi-Scale training', default=False, action='store_true')
+    parser.add_argument('--sparse-targets', help='Build the fsaf targets as per location class labels.',
+                        action='store_true')
+    parser.add_argument('--level-select',
+                        help='Select the level of the gt boxes by their losses (online) or by their size (heuristic).',
+                        choices=['online', 'heuristic'], default='online')
     parser.add_argument('--compute-val-loss', help='Compute validation loss during training', dest='compute_val_loss',
                         action='store_true')
 
@@ -293,7 +298,8 @@ def main(args=None):
     train_generator, validation_generator = create_generators(args)
 
     num_classes = train_generator.num_classes()
-    model, prediction_model = yolo_body(num_classes=num_classes)
+    model, prediction_model = yolo_body(num_classes=num_classes, sparse_targets=args.sparse_targets,
+                                        level_select=args.level_select)
 
     # create the model
     print('Loading model, this may take a second...')